@@ -0,0 +1,22 @@
+#!/usr/bin/python3
+
+# Compile the hm08 mesh metadata (face/vertex tables, vertex groups and mirror table)
+# into a single binary bundle which can be memory mapped at runtime. If the bundle is
+# not shipped, MPFB will compile it into the user cache on first use.
+
+from pathlib import Path
+import os, importlib.util
+
+loc = Path(os.path.abspath(__file__))
+parent = loc.parent.parent.absolute()
+
+metadata_dir = os.path.join(str(parent), "mpfb", "data", "mesh_metadata")
+
+# Load the mesh metadata module directly from its file, since importing the mpfb package
+# requires blender
+meshmetadata_spec = importlib.util.spec_from_file_location("meshmetadata", os.path.join(str(parent), "mpfb", "entities", "meshmetadata.py"))
+meshmetadata = importlib.util.module_from_spec(meshmetadata_spec)
+meshmetadata_spec.loader.exec_module(meshmetadata)
+
+bundle_file = meshmetadata.compile_mesh_metadata(metadata_dir)
+print("Wrote " + str(bundle_file))
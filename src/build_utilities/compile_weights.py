@@ -0,0 +1,30 @@
+#!/usr/bin/python3
+
+# Compile the MHW json weight files of the shipped rigs into binary weight files
+# (.mhw.bin) which can be memory mapped at runtime. If a compiled file is missing or
+# was compiled from other json content, MPFB will compile it into the user cache on first use.
+#
+# Pass --float16 to store the weights with half precision, which makes the files
+# smaller at the cost of about three decimals of precision.
+
+from pathlib import Path
+import os, sys, importlib.util
+
+loc = Path(os.path.abspath(__file__))
+parent = loc.parent.parent.absolute()
+
+rigs_dir = os.path.join(str(parent), "mpfb", "data", "rigs")
+
+# Load the binary weights module directly from its file, since importing the mpfb package
+# requires blender
+binaryweights_spec = importlib.util.spec_from_file_location("binaryweights", os.path.join(str(parent), "mpfb", "entities", "binaryweights.py"))
+binaryweights = importlib.util.module_from_spec(binaryweights_spec)
+binaryweights_spec.loader.exec_module(binaryweights)
+
+weight_dtype = "<f2" if "--float16" in sys.argv else "<f4"
+
+for root, dirs, files in os.walk(rigs_dir):
+    for file in sorted(files):
+        if file.startswith("weights.") and file.endswith(".json"):
+            binary_file = binaryweights.compile_weights_file(os.path.join(root, file), weight_dtype=weight_dtype)
+            print("Wrote " + str(binary_file))
@@ -1,7 +1,7 @@
 #!/usr/bin/python3
 
 from pathlib import Path
-import os, sys, re, pprint, numpy, gzip, shutil, json, fnmatch
+import os, sys, re, pprint, numpy, gzip, shutil, json, fnmatch, importlib.util
 from numpy.polynomial.polyutils import mapparms
 
 if not "TARGETS_DIR" in os.environ:
@@ -12,6 +12,12 @@ loc = Path(os.path.abspath(__file__))
 parent = loc.parent.parent.absolute()
 
 outdir = os.path.join(str(parent), "mpfb", "data", "targets")
+
+# Load the binary target module directly from its file, since importing the mpfb package
+# requires blender
+binarytarget_spec = importlib.util.spec_from_file_location("binarytarget", os.path.join(str(parent), "mpfb", "entities", "binarytarget.py"))
+binarytarget = importlib.util.module_from_spec(binarytarget_spec)
+binarytarget_spec.loader.exec_module(binarytarget)
 imagedir = os.path.join(outdir, "_images") 
 
 targets_dir = os.path.abspath(os.environ["TARGETS_DIR"])
@@ -45,7 +51,14 @@ for file in Path(targets_dir).rglob('*.target'):
     print("Writing " + str(outfile))
     with gzip.open(outfile, "wb") as gzip_file:
         gzip_file.write(bytearray(stripped_target, 'utf8'))
-         
+
+    # Also write a precompiled version of the target, which can be memory mapped
+    # by TargetService.load_target_arrays() instead of parsing the text
+    binfile = binarytarget.binary_target_path(outfile)
+    print("Writing " + str(binfile))
+    indices, deltas = binarytarget.parse_target_string(stripped_target)
+    binarytarget.write_binary_target(binfile, indices, deltas)
+
     print()
 
 for file in Path(targets_dir).rglob('*.png'):
@@ -0,0 +1,129 @@
+"""Reading and writing of precompiled binary targets.
+
+A binary target (.target.bin) contains the same information as a text target, but
+stored as raw arrays which can be used without parsing:
+
+    8 bytes   magic, b"MPFBTRGT"
+    uint32    format version
+    uint32    number of modified vertices, N
+    int32     N vertex indices
+    float32   N * 3 coordinate deltas
+
+All numbers are little endian. The deltas are already converted to blender's axis
+order (x, -z, y), but they are not multiplied with any scale factor.
+
+This module deliberately only depends on numpy, so that it can also be used from
+the build utilities outside of blender.
+"""
+
+import os, io, re, gzip, numpy
+
+BINARY_TARGET_MAGIC = b"MPFBTRGT"
+BINARY_TARGET_VERSION = 1
+BINARY_TARGET_SUFFIX = ".target.bin"
+
+_HEADER_DTYPE = numpy.dtype([("magic", "S8"), ("version", "<u4"), ("count", "<u4")])
+
+# Comment lines, and lines starting with a quote, are ignored in text targets
+_COMMENT_LINES = re.compile(r'^[ \t]*[#"].*$', re.MULTILINE)
+
+
+def binary_target_path(target_path):
+    """Return the path where a compiled version of the given text target would be."""
+    target_path = str(target_path)
+    for suffix in [".target.gz", ".target"]:
+        if target_path.endswith(suffix):
+            return target_path[0:len(target_path)-len(suffix)] + BINARY_TARGET_SUFFIX
+    return target_path + ".bin"
+
+
+def _tokens_per_line(target_bytes):
+    """Return the number of whitespace separated tokens on each non-empty line."""
+    characters = numpy.frombuffer(target_bytes, dtype=numpy.uint8)
+    newlines = characters == ord("\n")
+    separators = newlines | (characters == ord(" ")) | (characters == ord("\t")) | (characters == ord("\r"))
+    token_starts = ~separators
+    token_starts[1:] &= separators[:-1]
+    line_numbers = numpy.cumsum(newlines)
+    counts = numpy.bincount(line_numbers[token_starts])
+    return counts[counts > 0]
+
+
+def parse_target_string(target_string):
+    """Parse the text representation of a target (str or utf-8 bytes) into an int32 index array and a
+    float32 (N, 3) delta array in blender's axis order. The numbers are parsed by numpy rather than
+    line by line in python. Columns after the fourth are ignored."""
+    if isinstance(target_string, bytes):
+        target_string = target_string.decode("utf-8")
+    if "#" in target_string or "\"" in target_string:
+        target_string = _COMMENT_LINES.sub("", target_string)
+    if not target_string.strip():
+        return numpy.zeros(0, dtype=numpy.int32), numpy.zeros((0, 3), dtype=numpy.float32)
+    tokens_per_line = _tokens_per_line(target_string.encode("utf-8"))
+    values = None
+    if numpy.all(tokens_per_line == 4):
+        values = numpy.fromstring(target_string, dtype=numpy.float64, sep=" ")
+    if values is None or len(values) != 4 * len(tokens_per_line):
+        # Some rows do not have exactly four numeric columns, so use the slower column aware parser
+        values = numpy.loadtxt(io.StringIO(target_string), dtype=numpy.float64, usecols=range(4), ndmin=2)
+    data = values.reshape(-1, 4)
+    indices = data[:, 0].astype(numpy.int32)
+    deltas = numpy.empty((len(data), 3), dtype=numpy.float32)
+    deltas[:, 0] = data[:, 1]
+    deltas[:, 1] = -data[:, 3] # XZY order, -Y
+    deltas[:, 2] = data[:, 2]
+    return indices, deltas
+
+
+def write_binary_target(path, indices, deltas):
+    """Write index and delta arrays (blender axis order, unscaled) as a binary target."""
+    indices = numpy.ascontiguousarray(indices, dtype="<i4")
+    deltas = numpy.ascontiguousarray(deltas, dtype="<f4").reshape(-1, 3)
+    if len(indices) != len(deltas):
+        raise ValueError("Index and delta arrays must have the same length")
+    header = numpy.zeros(1, dtype=_HEADER_DTYPE)
+    header["magic"] = BINARY_TARGET_MAGIC
+    header["version"] = BINARY_TARGET_VERSION
+    header["count"] = len(indices)
+    temp_path = str(path) + ".tmp"
+    with open(temp_path, "wb") as binary_file:
+        binary_file.write(header.tobytes())
+        binary_file.write(indices.tobytes())
+        binary_file.write(deltas.tobytes())
+    os.replace(temp_path, path)
+
+
+def read_binary_target(path):
+    """Read a binary target and return read-only index and delta arrays. The file is read in one go
+    rather than memory mapped, since targets are small and a mapping per cached target would keep a
+    file descriptor open for each of them."""
+    with open(path, "rb") as binary_file:
+        data = binary_file.read()
+    header = numpy.frombuffer(data, dtype=_HEADER_DTYPE, count=1) if len(data) >= _HEADER_DTYPE.itemsize else []
+    if len(header) != 1 or header["magic"][0] != BINARY_TARGET_MAGIC:
+        raise ValueError(str(path) + " is not a binary target")
+    if int(header["version"][0]) != BINARY_TARGET_VERSION:
+        raise ValueError(str(path) + " has an unsupported binary target version")
+    count = int(header["count"][0])
+    offset = _HEADER_DTYPE.itemsize
+    if len(data) < offset + 16 * count:
+        raise ValueError(str(path) + " is truncated")
+    indices = numpy.frombuffer(data, dtype="<i4", count=count, offset=offset)
+    deltas = numpy.frombuffer(data, dtype="<f4", count=3 * count, offset=offset + 4 * count).reshape(count, 3)
+    return indices, deltas
+
+
+def compile_target_file(target_path, binary_path=None):
+    """Parse a .target or .target.gz file and write it as a binary target."""
+    target_path = str(target_path)
+    if target_path.endswith(".gz"):
+        with gzip.open(target_path, "rb") as gzip_file:
+            target_string = gzip_file.read().decode("utf-8")
+    else:
+        with open(target_path, "r") as target_file:
+            target_string = target_file.read()
+    if binary_path is None:
+        binary_path = binary_target_path(target_path)
+    indices, deltas = parse_target_string(target_string)
+    write_binary_target(binary_path, indices, deltas)
+    return binary_path
@@ -0,0 +1,163 @@
+"""Reading and writing of compact binary weight files.
+
+A binary weight file (.mhw.bin) contains the same information as a MHW json weight
+file, but with the weights stored as raw arrays which can be memory mapped:
+
+    8 bytes   magic, b"MPFBMHWB"
+    uint32    format version
+    uint32    number of bones, B
+    uint32    number of weights, N
+    uint32    bytes per weight, 2 (float16) or 4 (float32)
+    uint32    length of the info block, L
+    L bytes   utf-8 encoded JSON with the MHW header fields, the bone names and the sha1
+              of the json file the weights were compiled from, if any
+    ...       padding to a 4 byte boundary
+    int32     B + 1 offsets, the weights of bone i are found at offsets[i]:offsets[i+1]
+    int32     N vertex indices
+    float     N weights
+
+All numbers are little endian.
+
+This module deliberately only depends on numpy, so that it can also be used from
+the build utilities outside of blender.
+"""
+
+import os, json, hashlib, numpy
+
+BINARY_WEIGHTS_MAGIC = b"MPFBMHWB"
+BINARY_WEIGHTS_VERSION = 1
+BINARY_WEIGHTS_SUFFIX = ".mhw.bin"
+
+_HEADER_DTYPE = numpy.dtype([("magic", "S8"), ("version", "<u4"), ("bones", "<u4"), ("count", "<u4"), ("weight_size", "<u4"), ("info_length", "<u4")])
+_WEIGHT_DTYPES = {2: "<f2", 4: "<f4"}
+
+
+def binary_weights_path(weights_path):
+    """Return the path where a compiled version of the given json weights file would be."""
+    weights_path = str(weights_path)
+    if weights_path.endswith(".json"):
+        return weights_path[0:len(weights_path)-len(".json")] + BINARY_WEIGHTS_SUFFIX
+    return weights_path + BINARY_WEIGHTS_SUFFIX
+
+
+class BinaryWeights:
+    """Memory mapped view of a binary weight file. The weights of a bone are returned as read-only
+    int32 index and float weight arrays."""
+
+    def __init__(self, path):
+        self.path = str(path)
+        header = numpy.fromfile(self.path, dtype=_HEADER_DTYPE, count=1)
+        if len(header) != 1 or header["magic"][0] != BINARY_WEIGHTS_MAGIC:
+            raise ValueError(self.path + " is not a binary weights file")
+        if int(header["version"][0]) != BINARY_WEIGHTS_VERSION:
+            raise ValueError(self.path + " has an unsupported binary weights version")
+        bones = int(header["bones"][0])
+        count = int(header["count"][0])
+        weight_size = int(header["weight_size"][0])
+        info_length = int(header["info_length"][0])
+        if not weight_size in _WEIGHT_DTYPES:
+            raise ValueError(self.path + " has an unsupported weight size")
+
+        with open(self.path, "rb") as binary_file:
+            binary_file.seek(_HEADER_DTYPE.itemsize)
+            self.info = json.loads(binary_file.read(info_length).decode("utf-8"))
+        self.bone_names = self.info.pop("bones")
+        self.source_sha1 = self.info.pop("source_sha1", None)
+        self._bone_positions = dict([(name, i) for i, name in enumerate(self.bone_names)])
+
+        offset = _HEADER_DTYPE.itemsize + info_length
+        offset = offset + (-offset % 4)
+        self.offsets = numpy.fromfile(self.path, dtype="<i4", count=bones + 1, offset=offset)
+        offset = offset + 4 * (bones + 1)
+        if count == 0:
+            self.indices = numpy.zeros(0, dtype=numpy.int32)
+            self.weights = numpy.zeros(0, dtype=_WEIGHT_DTYPES[weight_size])
+        else:
+            self.indices = numpy.memmap(self.path, dtype="<i4", mode="r", offset=offset, shape=(count,))
+            self.weights = numpy.memmap(self.path, dtype=_WEIGHT_DTYPES[weight_size], mode="r", offset=offset + 4 * count, shape=(count,))
+
+    def __contains__(self, bone_name):
+        return bone_name in self._bone_positions
+
+    def get_bone_weights(self, bone_name):
+        """Return the vertex indices and weights for a bone, or None if the bone is not in the file."""
+        if not bone_name in self._bone_positions:
+            return None
+        i = self._bone_positions[bone_name]
+        start = int(self.offsets[i])
+        end = int(self.offsets[i+1])
+        return self.indices[start:end], self.weights[start:end]
+
+    def to_mhw_dict(self):
+        """Return the contents as a MHW-compatible dict, as would have been loaded from a json weights file."""
+        mhw_dict = dict(self.info)
+        mhw_dict["weights"] = dict()
+        for bone_name in self.bone_names:
+            (indices, weights) = self.get_bone_weights(bone_name)
+            mhw_dict["weights"][bone_name] = [list(pair) for pair in zip(indices.tolist(), weights.astype(numpy.float64).tolist())]
+        return mhw_dict
+
+
+def write_binary_weights(path, mhw_dict, weight_dtype="<f4", source_sha1=None):
+    """Write a MHW-compatible weights dict as a binary weights file. The weights are stored as float32,
+    or as float16 if weight_dtype is "<f2". The sha1 of the json source can be stored for checking if
+    the compiled file is up to date."""
+    weight_dtype = numpy.dtype(weight_dtype).newbyteorder("<")
+    if not weight_dtype.itemsize in _WEIGHT_DTYPES:
+        raise ValueError("Weights must be stored as float16 or float32")
+    weights_per_bone = mhw_dict["weights"]
+    bone_names = list(weights_per_bone.keys())
+
+    offsets = numpy.zeros(len(bone_names) + 1, dtype="<i4")
+    numpy.cumsum([len(weights_per_bone[name]) for name in bone_names], out=offsets[1:])
+    pairs = [pair for name in bone_names for pair in weights_per_bone[name]]
+    pairs = numpy.array(pairs, dtype=numpy.float64).reshape(-1, 2)
+    indices = numpy.ascontiguousarray(pairs[:, 0], dtype="<i4")
+    weights = numpy.ascontiguousarray(pairs[:, 1], dtype=weight_dtype)
+
+    info = dict([(key, value) for key, value in mhw_dict.items() if key != "weights"])
+    info["bones"] = bone_names
+    if source_sha1:
+        info["source_sha1"] = source_sha1
+    info_bytes = json.dumps(info).encode("utf-8")
+
+    header = numpy.zeros(1, dtype=_HEADER_DTYPE)
+    header["magic"] = BINARY_WEIGHTS_MAGIC
+    header["version"] = BINARY_WEIGHTS_VERSION
+    header["bones"] = len(bone_names)
+    header["count"] = len(indices)
+    header["weight_size"] = weight_dtype.itemsize
+    header["info_length"] = len(info_bytes)
+
+    temp_path = str(path) + ".tmp"
+    with open(temp_path, "wb") as binary_file:
+        binary_file.write(header.tobytes())
+        binary_file.write(info_bytes)
+        binary_file.write(b"\0" * (-binary_file.tell() % 4))
+        binary_file.write(offsets.tobytes())
+        binary_file.write(indices.tobytes())
+        binary_file.write(weights.tobytes())
+    os.replace(temp_path, path)
+
+
+def read_binary_weights(path):
+    """Memory map a binary weights file."""
+    return BinaryWeights(path)
+
+
+def weights_file_sha1(weights_path):
+    """Return the sha1 hex digest of the content of a json weights file."""
+    with open(str(weights_path), "rb") as json_file:
+        return hashlib.sha1(json_file.read()).hexdigest()
+
+
+def compile_weights_file(weights_path, binary_path=None, weight_dtype="<f4"):
+    """Parse a json weights file and write it as a binary weights file."""
+    weights_path = str(weights_path)
+    with open(weights_path, "rb") as json_file:
+        content = json_file.read()
+    mhw_dict = json.loads(content.decode("utf-8"))
+    if binary_path is None:
+        binary_path = binary_weights_path(weights_path)
+    write_binary_weights(binary_path, mhw_dict, weight_dtype, source_sha1=hashlib.sha1(content).hexdigest())
+    return binary_path
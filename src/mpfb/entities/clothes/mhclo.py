@@ -1,6 +1,7 @@
 """This module provides and information holder for MHCLO files."""
 
-import bpy, os, sys, json
+import bpy, os, sys, json, hashlib, numpy
+from collections.abc import Mapping
 from mathutils import Vector
 from mpfb.services.objectservice import ObjectService
 from mpfb.services.logservice import LogService
@@ -10,6 +11,39 @@ _LOG = LogService.get_logger("entities.mhclo")
 
 _CONFIG_FILE = None
 
+_MHCLO_CACHE_VERSION = 1
+_MHCLO_CACHE_DIR = LocationService.get_user_cache("mhclo")
+_MHCLO_CACHE_MAX_FILES = 500
+_MHCLO_CACHED_ATTRIBUTES = [
+    "obj_file", "x_scale", "y_scale", "z_scale", "author", "license", "name", "description",
+    "material", "tags", "zdepth", "first", "delete", "uuid"
+    ]
+
+
+class _MhcloVertsView(Mapping):
+    """Read-only view of the vertex arrays of a Mhclo with the same layout as the dict which was
+    previously stored in Mhclo.verts: {vn: {'verts': (v0,v1,v2), 'weights': (w0,w1,w2), 'offsets': Vector}}.
+    The dicts are created on access."""
+
+    def __init__(self, mhclo):
+        self._mhclo = mhclo
+
+    def __getitem__(self, vn):
+        if not isinstance(vn, (int, numpy.integer)) or vn < 0 or vn >= len(self._mhclo.ref_verts):
+            raise KeyError(vn)
+        return {
+            'verts': tuple(int(v) for v in self._mhclo.ref_verts[vn]),
+            'weights': tuple(float(w) for w in self._mhclo.weights[vn]),
+            'offsets': Vector(self._mhclo.offsets[vn].tolist())
+            }
+
+    def __iter__(self):
+        return iter(range(len(self._mhclo.ref_verts)))
+
+    def __len__(self):
+        return len(self._mhclo.ref_verts)
+
+
 class Mhclo:
     """A representation of the values of a MHCLO file."""
 
@@ -27,15 +61,21 @@ class Mhclo:
         self.tags = ""
         self.zdepth = 50
         self.first = 0
-        self.verts = {}
+        # Per clothes vertex: the three reference vertices on the base mesh, their weights and the
+        # offset (in blender's axis order). self.verts is a dict-like view of the same data.
+        self.ref_verts = numpy.zeros((0, 3), dtype=numpy.int32)
+        self.weights = numpy.zeros((0, 3), dtype=numpy.float32)
+        self.offsets = numpy.zeros((0, 3), dtype=numpy.float32)
+        self.verts = _MhcloVertsView(self)
         self.delverts = []
         self.delete = False
         self.delete_group = "Delete"
         self.uuid = None
 
-    def load(self, mhclo_filename):
+    def load(self, mhclo_filename, use_cache=True):
         """Populate settings from contents of a MHCLO file. This will not automatically load the
-        mesh or the materials."""
+        mesh or the materials. The parse result is cached in the user cache directory, keyed by
+        a hash of the file contents."""
 
         if not mhclo_filename:
             raise ValueError('Cannot load empty file name')
@@ -50,17 +90,39 @@ class Mhclo:
         folder = os.path.dirname(realpath)
 
         try:
-            fp = open(mhclo_filename, "r", encoding="utf8", errors="surrogateescape")
+            with open(mhclo_filename, "rb") as fp:
+                contents = fp.read()
         except:
             _LOG.error("Error trying to open file:", sys.exc_info()[0])
             return None
 
-        vn = 0
+        cache_file = None
+        if use_cache:
+            digest = hashlib.sha1(contents)
+            digest.update(str(_MHCLO_CACHE_VERSION).encode("utf-8"))
+            cache_file = os.path.join(_MHCLO_CACHE_DIR, digest.hexdigest() + ".npz")
+            if self._load_cache(cache_file, folder):
+                _LOG.debug("Loaded mhclo from cache", (mhclo_filename, cache_file))
+                try:
+                    # Mark the cache file as recently used, see _prune_cache()
+                    os.utime(cache_file)
+                except OSError:
+                    pass
+                return
+
+        self._parse(contents.decode("utf8", errors="surrogateescape"), folder)
+
+        if cache_file:
+            self._save_cache(cache_file, folder)
+
+    def _parse(self, mhclo_string, folder):
+        ref_verts = []
+        weights = []
+        offsets = []
         status = ""
 
-        for line in fp:
+        for line in mhclo_string.splitlines():
             words= line.split()
-            _LOG.debug("Line", words)
 
             l = len(words)
 
@@ -101,19 +163,13 @@ class Mhclo:
                     continue
                 if l == 1:
                     v = int(words[0])
-                    self.verts[vn] = {'verts': (v,v,v), 'weights': (1,0,0), 'offsets': Vector((0,0,0))}
+                    ref_verts.append((v, v, v))
+                    weights.append((1.0, 0.0, 0.0))
+                    offsets.append((0.0, 0.0, 0.0))
                 else:
-                    v0 = int(words[0])
-                    v1 = int(words[1])
-                    v2 = int(words[2])
-                    w0 = float(words[3])
-                    w1 = float(words[4])
-                    w2 = float(words[5])
-                    d0 = float(words[6])
-                    d1 = float(words[7])
-                    d2 = float(words[8])
-                    self.verts[vn] = {'verts': (v0,v1,v2), 'weights': (w0,w1,w2), 'offsets': Vector((d0,-d2,d1))}
-                vn += 1
+                    ref_verts.append((int(words[0]), int(words[1]), int(words[2])))
+                    weights.append((float(words[3]), float(words[4]), float(words[5])))
+                    offsets.append((float(words[6]), -float(words[8]), float(words[7])))
                 continue
             elif status == 'd':
                 if words[0].isnumeric() is False:
@@ -126,8 +182,7 @@ class Mhclo:
                     else:
                         v1 = int(v)
                         if sequence:
-                            for vn in range(v0,v1+1):
-                                self.delverts.append(vn)
+                            self.delverts.extend(range(v0, v1+1))
                             sequence = False
                         else:
                             self.delverts.append(v1)
@@ -163,10 +218,143 @@ class Mhclo:
                 self.delete = True
                 status = 'd'
 
+        self._set_vertex_arrays(
+            numpy.array(ref_verts, dtype=numpy.int32).reshape(-1, 3),
+            numpy.array(weights, dtype=numpy.float32).reshape(-1, 3),
+            numpy.array(offsets, dtype=numpy.float32).reshape(-1, 3))
+
+        _LOG.debug("Number of clothes vertices", len(self.ref_verts))
+
         if not self.obj_file:
             _LOG.warn("Reaching end of mhclo parsing without finding obj file")
 
-        fp.close
+    def _set_vertex_arrays(self, ref_verts, weights, offsets):
+        self.ref_verts = ref_verts
+        self.weights = weights
+        self.offsets = offsets
+        self.verts = _MhcloVertsView(self)
+
+    def _load_cache(self, cache_file, folder):
+        if not os.path.exists(cache_file):
+            return False
+        try:
+            with numpy.load(cache_file, allow_pickle=False) as cached:
+                info = json.loads(str(cached["info"]))
+                ref_verts = cached["ref_verts"]
+                weights = cached["weights"]
+                offsets = cached["offsets"]
+                delverts = cached["delverts"]
+        except Exception:
+            _LOG.warn("Ignoring unreadable mhclo cache file", (cache_file, sys.exc_info()[1]))
+            return False
+        for key in _MHCLO_CACHED_ATTRIBUTES:
+            value = info[key]
+            if key in ["x_scale", "y_scale", "z_scale"] and value is not None:
+                value = tuple(value)
+            if key in ["obj_file", "material"] and value is not None:
+                value = os.path.join(folder, value)
+            setattr(self, key, value)
+        self.delverts = delverts.tolist()
+        self._set_vertex_arrays(ref_verts, weights, offsets)
+        return True
+
+    def _save_cache(self, cache_file, folder):
+        info = dict()
+        for key in _MHCLO_CACHED_ATTRIBUTES:
+            value = getattr(self, key)
+            if key in ["obj_file", "material"] and value is not None:
+                try:
+                    value = os.path.relpath(value, folder)
+                except ValueError:
+                    # On another drive, so keep the absolute path. os.path.join() in _load_cache() returns it as is.
+                    pass
+            info[key] = value
+        temp_file = cache_file + ".tmp"
+        try:
+            os.makedirs(_MHCLO_CACHE_DIR, exist_ok=True)
+            with open(temp_file, "wb") as npz_file:
+                numpy.savez(npz_file,
+                            info=numpy.array(json.dumps(info)),
+                            ref_verts=self.ref_verts,
+                            weights=self.weights,
+                            offsets=self.offsets,
+                            delverts=numpy.array(self.delverts, dtype=numpy.int32))
+            os.replace(temp_file, cache_file)
+        except OSError:
+            _LOG.warn("Could not write mhclo cache file", (cache_file, sys.exc_info()[1]))
+            return
+        Mhclo._prune_cache()
+
+    @staticmethod
+    def _prune_cache():
+        """Remove the least recently used cache files when there are more than _MHCLO_CACHE_MAX_FILES.
+        Cache files are keyed by content, so files for changed or removed MHCLOs would otherwise stay forever."""
+        try:
+            entries = [entry for entry in os.scandir(_MHCLO_CACHE_DIR) if entry.is_file()]
+        except OSError:
+            return
+        if len(entries) <= _MHCLO_CACHE_MAX_FILES:
+            return
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in entries[0:len(entries) - _MHCLO_CACHE_MAX_FILES]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                _LOG.warn("Could not remove old mhclo cache file", entry.path)
+
+    def load_header(self, mhclo_filename):
+        """Populate only the metadata (uuid, name, obj_file, material, tags and the comment fields)
+        from a MHCLO or proxy file. Parsing stops at the start of the vertex listing, so this is much
+        cheaper than load() for files with many vertices."""
+
+        if not mhclo_filename:
+            raise ValueError('Cannot load empty file name')
+
+        if not os.path.exists(mhclo_filename):
+            raise IOError(mhclo_filename + " does not exist")
+
+        realpath = os.path.realpath(mhclo_filename)
+        folder = os.path.dirname(realpath)
+
+        with open(mhclo_filename, "r", encoding="utf8", errors="surrogateescape") as fp:
+            for line in fp:
+                words = line.split()
+                l = len(words)
+
+                if l == 0:
+                    continue
+
+                if words[0] == '#':
+                    if l > 2:
+                        key = words[1].lower()
+                        if "author" in key:
+                            self.author = words[2]
+                        elif "license" in key:
+                            if "by" in line.lower():
+                                self.license = "CC-BY"
+                            elif "apgl" in line.lower():
+                                self.license = "AGPL"
+                        elif "description" in key:
+                            self.description = " ".join(words[2:])
+                    continue
+
+                key = words[0]
+                if key in ["verts", "delete_verts"]:
+                    break
+                if l < 2:
+                    continue
+                if key == "material":
+                    self.material = os.path.join(folder, words[1])
+                elif key == 'obj_file':
+                    self.obj_file = os.path.join(folder, words[1])
+                elif key == 'name':
+                    self.name = words[1]
+                elif key == 'uuid':
+                    self.uuid = words[1]
+                elif key == 'tag':
+                    if self.tags != "":
+                        self.tags += ","
+                    self.tags += words[1].lower()
 
     def load_mesh(self, context):
 
@@ -0,0 +1,184 @@
+"""Reading and writing of the compiled hm08 mesh metadata bundle.
+
+The bundle contains the base mesh topology, vertex group and mirror information as
+raw arrays which can be memory mapped:
+
+    8 bytes   magic, b"MPFBMESH"
+    uint32    format version
+    uint32    number of arrays, N
+    N *       table entry: 32 bytes name, 8 bytes dtype, uint32 rows, uint32 columns, uint64 offset
+    ...       array data, each array starting at a 16 byte aligned offset
+
+All numbers are little endian. Arrays with zero columns are one dimensional. The
+arrays in the bundle are:
+
+    face_vertex_indptr, face_vertex_indices   CSR table of the vertices of each face
+    vertex_face_indptr, vertex_face_indices   CSR table of the faces of each vertex
+    group_names                               utf-8 encoded JSON list of vertex group names
+    group_range_indptr, group_ranges          per group, the (start, stop) vertex ranges, stop inclusive
+    group_vertex_indptr, group_vertex_indices CSR table of the vertices of each group, ie the expanded ranges
+    mirror_left, mirror_right                 (from, to) vertex pairs for symmetrizing
+    source_sha1                               ascii sha1 hex digest of the source files
+
+This module deliberately only depends on numpy, so that it can also be used from
+the build utilities outside of blender.
+"""
+
+import os, gzip, json, hashlib, numpy
+
+MESH_METADATA_MAGIC = b"MPFBMESH"
+MESH_METADATA_VERSION = 3
+MESH_METADATA_FILE_NAME = "hm08.metadata.bin"
+
+MESH_METADATA_SOURCE_FILES = [
+    "basemesh_face_to_vertex_table.json.gz",
+    "basemesh_vertex_to_face_table.json.gz",
+    "basemesh_vertex_groups.json",
+    "hm08.mirror"
+    ]
+
+_HEADER_DTYPE = numpy.dtype([("magic", "S8"), ("version", "<u4"), ("count", "<u4")])
+_ENTRY_DTYPE = numpy.dtype([("name", "S32"), ("dtype", "S8"), ("rows", "<u4"), ("columns", "<u4"), ("offset", "<u8")])
+_ALIGNMENT = 16
+
+
+class MeshMetadata:
+    """Lazily memory mapped view of a compiled mesh metadata bundle. Arrays are mapped on first access
+    and are read-only."""
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._arrays = dict()
+        header = numpy.fromfile(self.path, dtype=_HEADER_DTYPE, count=1)
+        if len(header) != 1 or header["magic"][0] != MESH_METADATA_MAGIC:
+            raise ValueError(self.path + " is not a mesh metadata bundle")
+        if int(header["version"][0]) != MESH_METADATA_VERSION:
+            raise ValueError(self.path + " has an unsupported mesh metadata version")
+        count = int(header["count"][0])
+        entries = numpy.fromfile(self.path, dtype=_ENTRY_DTYPE, count=count, offset=_HEADER_DTYPE.itemsize)
+        self._entries = dict()
+        for entry in entries:
+            self._entries[entry["name"].decode("utf-8")] = entry
+
+    def names(self):
+        return list(self._entries.keys())
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    def __getitem__(self, name):
+        if not name in self._arrays:
+            entry = self._entries[name]
+            rows = int(entry["rows"])
+            columns = int(entry["columns"])
+            shape = (rows, columns) if columns > 0 else (rows,)
+            if rows == 0:
+                self._arrays[name] = numpy.zeros(shape, dtype=entry["dtype"].decode("utf-8"))
+            else:
+                self._arrays[name] = numpy.memmap(self.path, dtype=entry["dtype"].decode("utf-8"), mode="r", offset=int(entry["offset"]), shape=shape)
+        return self._arrays[name]
+
+    def get_group_names(self):
+        return json.loads(bytes(self["group_names"]).decode("utf-8"))
+
+    def get_source_sha1(self):
+        if not "source_sha1" in self:
+            return None
+        return bytes(self["source_sha1"]).decode("ascii")
+
+
+def write_mesh_metadata(path, arrays):
+    """Write a dict of name -> one or two dimensional numpy array as a mesh metadata bundle."""
+    arrays = [(name, numpy.ascontiguousarray(array)) for name, array in arrays.items()]
+    for name, array in arrays:
+        if array.ndim > 2:
+            raise ValueError("Array " + name + " has more than two dimensions")
+    header = numpy.zeros(1, dtype=_HEADER_DTYPE)
+    header["magic"] = MESH_METADATA_MAGIC
+    header["version"] = MESH_METADATA_VERSION
+    header["count"] = len(arrays)
+    entries = numpy.zeros(len(arrays), dtype=_ENTRY_DTYPE)
+    offset = _HEADER_DTYPE.itemsize + _ENTRY_DTYPE.itemsize * len(arrays)
+    for i, (name, array) in enumerate(arrays):
+        offset = offset + (-offset % _ALIGNMENT)
+        array = array.astype(array.dtype.newbyteorder("<"), copy=False)
+        entries[i] = (name.encode("utf-8"), array.dtype.str.encode("utf-8"), array.shape[0], array.shape[1] if array.ndim == 2 else 0, offset)
+        offset = offset + array.nbytes
+    temp_path = str(path) + ".tmp"
+    with open(temp_path, "wb") as bundle_file:
+        bundle_file.write(header.tobytes())
+        bundle_file.write(entries.tobytes())
+        for entry, (name, array) in zip(entries, arrays):
+            bundle_file.write(b"\0" * (int(entry["offset"]) - bundle_file.tell()))
+            bundle_file.write(array.astype(array.dtype.newbyteorder("<"), copy=False).tobytes())
+    os.replace(temp_path, path)
+
+
+def _nested_list_to_csr(nested):
+    indptr = numpy.zeros(len(nested) + 1, dtype=numpy.int32)
+    numpy.cumsum([len(row) for row in nested], out=indptr[1:])
+    indices = numpy.fromiter((value for row in nested for value in row), dtype=numpy.int32, count=int(indptr[-1]))
+    return indptr, indices
+
+
+def compile_mesh_metadata(metadata_dir, path=None):
+    """Compile the mesh metadata source files in the given directory into a bundle."""
+    metadata_dir = str(metadata_dir)
+    if path is None:
+        path = os.path.join(metadata_dir, MESH_METADATA_FILE_NAME)
+    arrays = dict()
+
+    with gzip.open(os.path.join(metadata_dir, "basemesh_face_to_vertex_table.json.gz"), "rb") as json_file:
+        arrays["face_vertex_indptr"], arrays["face_vertex_indices"] = _nested_list_to_csr(json.load(json_file))
+
+    with gzip.open(os.path.join(metadata_dir, "basemesh_vertex_to_face_table.json.gz"), "rb") as json_file:
+        arrays["vertex_face_indptr"], arrays["vertex_face_indices"] = _nested_list_to_csr(json.load(json_file))
+
+    with open(os.path.join(metadata_dir, "basemesh_vertex_groups.json"), "r") as json_file:
+        groups = json.load(json_file)
+    group_names = list(groups.keys())
+    arrays["group_names"] = numpy.frombuffer(json.dumps(group_names).encode("utf-8"), dtype=numpy.uint8)
+    arrays["group_range_indptr"], ranges = _nested_list_to_csr([[value for start_stop in groups[name] for value in start_stop] for name in group_names])
+    arrays["group_range_indptr"] = arrays["group_range_indptr"] // 2
+    arrays["group_ranges"] = ranges.reshape(-1, 2)
+    arrays["group_vertex_indptr"], arrays["group_vertex_indices"] = _nested_list_to_csr(
+        [[vertex for (start, stop) in groups[name] for vertex in range(start, stop + 1)] for name in group_names])
+
+    mirror = dict(l=[], r=[])
+    with open(os.path.join(metadata_dir, "hm08.mirror"), "r") as mirror_file:
+        for line in mirror_file:
+            parts = line.split(" ", 3)
+            if len(parts) > 2 and parts[2].strip() in mirror:
+                mirror[parts[2].strip()].append((int(parts[0]), int(parts[1])))
+    arrays["mirror_left"] = numpy.array(mirror["l"], dtype=numpy.int32).reshape(-1, 2)
+    arrays["mirror_right"] = numpy.array(mirror["r"], dtype=numpy.int32).reshape(-1, 2)
+
+    arrays["source_sha1"] = numpy.frombuffer(mesh_metadata_source_sha1(metadata_dir).encode("ascii"), dtype=numpy.uint8)
+
+    write_mesh_metadata(path, arrays)
+    return path
+
+
+def mesh_metadata_source_sha1(metadata_dir):
+    """Return a sha1 hex digest over the content of the mesh metadata source files."""
+    digest = hashlib.sha1()
+    for source in MESH_METADATA_SOURCE_FILES:
+        source_path = os.path.join(str(metadata_dir), source)
+        if os.path.exists(source_path):
+            with open(source_path, "rb") as source_file:
+                digest.update(source.encode("utf-8"))
+                digest.update(source_file.read())
+    return digest.hexdigest()
+
+
+def mesh_metadata_is_stale(metadata_dir, path):
+    """Check if the bundle is missing, unreadable, has another format version or was compiled from other
+    content than the current source files. File modification times are not used, since these are not
+    reliable after an addon update."""
+    if not os.path.exists(path):
+        return True
+    try:
+        source_sha1 = MeshMetadata(path).get_source_sha1()
+    except (OSError, ValueError):
+        return True
+    return source_sha1 != mesh_metadata_source_sha1(metadata_dir)
@@ -2,11 +2,17 @@
 
 from mpfb.services.logservice import LogService
 from mpfb.services.rigservice import RigService
+from mpfb.services.meshservice import MeshService
+from mpfb.services.objectservice import ObjectService
 from mpfb.entities.objectproperties import GeneralObjectProperties
-import bpy, math, json, random
+from mathutils.kdtree import KDTree
+import bpy, os, math, json, numpy
 
 _LOG = LogService.get_logger("entities.rig")
 
+# Compiled fitting plans, keyed by rig file, its modification time and the joint groups of the base mesh
+_FITTING_PLANS = dict()
+
 _MAX_ALLOWED_DIST = 0.01
 _MAX_DIST_TO_CONSIDER_EXACT = 0.001
 
@@ -21,17 +27,112 @@ class Rig:
         self.position_info = dict()
         self.rig_definition = dict()
         self.lowest_point = 1000.0
+        self.fitting_plan = None
+        self._vertex_tree = None
 
     @staticmethod
     def from_json_file_and_basemesh(filename, basemesh):
         """Create an instance of Rig and populate it with information from the json file and from the base mesh."""
-        rig = Rig()
         with open(filename, "r") as json_file:
-            rig.rig_definition = json.load(json_file)
+            rig_definition = json.load(json_file)
+        return Rig.from_definition_and_basemesh(rig_definition, basemesh)
+
+    @staticmethod
+    def from_definition_and_basemesh(rig_definition, basemesh):
+        """Create an instance of Rig from an already parsed rig definition and populate it with information
+        from the base mesh. The definition is not modified, so it can be shared between several rigs."""
+        rig = Rig()
+        rig.rig_definition = rig_definition
         rig.basemesh = basemesh
         rig.build_basemesh_position_info()
         return rig
 
+    @staticmethod
+    def from_fitting_plan_and_basemesh(filename, basemesh):
+        """Create an instance of Rig for a rig file via its fitting plan, see get_fitting_plan(). Bone positions
+        are then computed directly from the plan, without building the position info. The rig definition is
+        shared with other rigs using the same plan, so it must not be modified."""
+        rig = Rig()
+        rig.basemesh = basemesh
+        rig.fitting_plan = Rig.get_fitting_plan(filename, basemesh)
+        rig.rig_definition = rig.fitting_plan["rig_definition"]
+        return rig
+
+    @staticmethod
+    def get_fitting_plan(filename, basemesh):
+        """Return the fitting plan for a rig file and base mesh. The plan expresses the head and tail of every
+        bone as a sparse weighted sum of base mesh vertices: one vertex for VERTEX, two halves for MEAN and
+        the vertices of the joint group for CUBE. Endpoints without a usable strategy use their default
+        position. Plans are cached as long as the rig file is unchanged and the base mesh is unmodified."""
+        filename = os.path.abspath(filename)
+        (joint_names, joint_indptr, joint_indices, from_metadata) = Rig._get_joint_group_vertices(basemesh)
+        key = (filename, os.path.getmtime(filename), len(basemesh.data.vertices), tuple(joint_names))
+        if from_metadata and key in _FITTING_PLANS:
+            return _FITTING_PLANS[key]
+
+        with open(filename, "r") as json_file:
+            rig_definition = json.load(json_file)
+
+        cube_positions = dict([(name, i) for i, name in enumerate(joint_names)])
+        bone_names = list(rig_definition.keys())
+        defaults = numpy.zeros((len(bone_names) * 2, 3), dtype=numpy.float64)
+        has_source = numpy.zeros(len(bone_names) * 2, dtype=bool)
+        rows = []
+        columns = []
+        weights = []
+
+        for bone_number, bone_name in enumerate(bone_names):
+            for end_number, end in enumerate(["head", "tail"]):
+                row = bone_number * 2 + end_number
+                info = rig_definition[bone_name][end]
+                defaults[row] = info["default_position"]
+                strategy = info["strategy"]
+                sources = []
+                if strategy == "CUBE" and info["cube_name"] in cube_positions:
+                    i = cube_positions[info["cube_name"]]
+                    cube_vertices = joint_indices[joint_indptr[i]:joint_indptr[i+1]].tolist()
+                    sources = [(vertex, 1.0 / len(cube_vertices)) for vertex in cube_vertices]
+                elif strategy == "CUBE":
+                    _LOG.warn("Using default position since the base mesh has no joint group", info["cube_name"])
+                if strategy == "VERTEX":
+                    sources = [(info["vertex_index"], 1.0)]
+                if strategy == "MEAN":
+                    sources = [(info["vertex_indices"][0], 0.5), (info["vertex_indices"][1], 0.5)]
+                if sources:
+                    has_source[row] = True
+                    for (vertex, weight) in sources:
+                        rows.append(row)
+                        columns.append(vertex)
+                        weights.append(weight)
+
+        plan = dict()
+        plan["rig_definition"] = rig_definition
+        plan["bone_names"] = bone_names
+        plan["defaults"] = defaults
+        plan["has_source"] = has_source
+        plan["rows"] = numpy.array(rows, dtype=numpy.int64)
+        plan["columns"] = numpy.array(columns, dtype=numpy.int64)
+        plan["weights"] = numpy.array(weights, dtype=numpy.float64)
+
+        if from_metadata:
+            _FITTING_PLANS[key] = plan
+        return plan
+
+    def _get_planned_positions(self, take_shape_keys_into_account=True):
+        """Evaluate the fitting plan against the base mesh, returning a (bones * 2, 3) array with the head
+        and tail of each bone, in the order of plan["bone_names"]."""
+        plan = self.fitting_plan
+        if take_shape_keys_into_account:
+            coords = MeshService.get_shaped_coordinates(self.basemesh)
+        else:
+            coords = MeshService.get_vertex_coordinates(self.basemesh)
+        positions = numpy.array(plan["defaults"])
+        positions[plan["has_source"]] = 0.0
+        contributions = numpy.asarray(coords, dtype=numpy.float64)[plan["columns"]] * plan["weights"][:, None]
+        for axis in range(3):
+            positions[:, axis] += numpy.bincount(plan["rows"], weights=contributions[:, axis], minlength=len(positions))
+        return positions
+
     @staticmethod
     def from_given_basemesh_and_armature_as_active_object(basemesh):
         """Create an instance of Rig and populate it with information from the base mesh
@@ -96,14 +197,14 @@ class Rig:
             location = self.position_info["cubes"][name]
         if strategy == "VERTEX":
             index = head_or_tail_info["vertex_index"]
-            location = self.position_info["vertices"][index]
+            location = self.position_info["vertices"][index].tolist()
         if strategy == "MEAN":
             indices = head_or_tail_info["vertex_indices"]
             vertex1 = self.position_info["vertices"][indices[0]]
             vertex2 = self.position_info["vertices"][indices[1]]
             location = [0.0, 0.0, 0.0]
             for i in range(3):
-                location[i] = (vertex1[i] + vertex2[i]) / 2
+                location[i] = float((vertex1[i] + vertex2[i]) / 2)
         if location is None:
             location = head_or_tail_info["default_position"]
         return location
@@ -112,16 +213,27 @@ class Rig:
         """Create the actual bones in the armature object."""
         bpy.ops.object.mode_set(mode='EDIT', toggle=False)
         bones = self.armature_object.data.edit_bones
-        for bone_name in self.rig_definition.keys():
-            bone_info = self.rig_definition[bone_name]
-            bone = bones.new(bone_name)
-            bone.roll = bone_info["roll"]
-            bone.head = self._get_best_location_from_strategy(bone_info["head"])
-            bone.tail = self._get_best_location_from_strategy(bone_info["tail"])
+        if self.fitting_plan:
+            positions = self._get_planned_positions().tolist()
+            for bone_number, bone_name in enumerate(self.fitting_plan["bone_names"]):
+                bone = bones.new(bone_name)
+                bone.roll = self.rig_definition[bone_name]["roll"]
+                bone.head = positions[bone_number * 2]
+                bone.tail = positions[bone_number * 2 + 1]
+        else:
+            for bone_name in self.rig_definition.keys():
+                bone_info = self.rig_definition[bone_name]
+                bone = bones.new(bone_name)
+                bone.roll = bone_info["roll"]
+                bone.head = self._get_best_location_from_strategy(bone_info["head"])
+                bone.tail = self._get_best_location_from_strategy(bone_info["tail"])
         bpy.ops.object.mode_set(mode='OBJECT', toggle=False)
 
     def reposition_edit_bone(self):
         """Reposition bones to fit the current state of the basemesh."""
+        if self.fitting_plan:
+            self._reposition_edit_bones_from_plan()
+            return
         bpy.ops.object.mode_set(mode='EDIT', toggle=False)
         for bone_name in self.rig_definition.keys():
             bone_info = self.rig_definition[bone_name]
@@ -135,6 +247,27 @@ class Rig:
                 _LOG.dump("Rig definition is", self.rig_definition)
         bpy.ops.object.mode_set(mode='OBJECT', toggle=False)
 
+    def _reposition_edit_bones_from_plan(self):
+        positions = self._get_planned_positions()
+        bpy.ops.object.mode_set(mode='EDIT', toggle=False)
+        bones = self.armature_object.data.edit_bones
+        bone_indices = dict([(bone.name, i) for i, bone in enumerate(bones)])
+        heads = numpy.empty(len(bones) * 3, dtype=numpy.float32)
+        tails = numpy.empty(len(bones) * 3, dtype=numpy.float32)
+        bones.foreach_get("head", heads)
+        bones.foreach_get("tail", tails)
+        heads = heads.reshape(-1, 3)
+        tails = tails.reshape(-1, 3)
+        for bone_number, bone_name in enumerate(self.fitting_plan["bone_names"]):
+            if bone_name in bone_indices:
+                heads[bone_indices[bone_name]] = positions[bone_number * 2]
+                tails[bone_indices[bone_name]] = positions[bone_number * 2 + 1]
+            else:
+                _LOG.warn("Tried to refit bone that did not exist in definition", bone_name)
+        bones.foreach_set("head", heads.reshape(-1))
+        bones.foreach_set("tail", tails.reshape(-1))
+        bpy.ops.object.mode_set(mode='OBJECT', toggle=False)
+
     def update_edit_bone_metadata(self):
         """Assign metadata fitting for the edit bones."""
         bpy.ops.object.mode_set(mode='EDIT', toggle=False)
@@ -200,13 +333,43 @@ class Rig:
     def move_basemesh_if_needed(self):
         """Move basemesh so it has feet on ground and apply this transform."""
         self.basemesh.location = (0.0, 0.0, 0.0)
-        for vertex in self.basemesh.data.vertices:
-            if vertex.co[2] < self.lowest_point and vertex.index < 13380:
-                self.lowest_point = vertex.co[2]
+        self.lowest_point = min(self.lowest_point, ObjectService.get_lowest_point(self.basemesh, take_shape_keys_into_account=False))
         if self.lowest_point < -0.0001:
             self.basemesh.location[2] = abs(self.lowest_point)
         bpy.ops.object.transform_apply(location=True, rotation=True, scale=True)
 
+    @staticmethod
+    def _get_joint_group_vertices(basemesh):
+        """Return the names of the joint vertex groups of the base mesh, their vertices as CSR arrays
+        (indptr, indices), and whether this was taken from the precompiled mesh metadata. That is the case
+        for an unmodified base mesh, otherwise the vertex groups of the mesh are read."""
+        joint_names = [str(group.name) for group in basemesh.vertex_groups if "joint" in str(group.name)]
+
+        if len(basemesh.data.vertices) == ObjectService.get_base_mesh_vertex_count():
+            (group_names, indptr, indices) = ObjectService.get_base_mesh_vertex_group_csr()
+            group_positions = dict([(name, i) for i, name in enumerate(group_names)])
+            if all(name in group_positions for name in joint_names):
+                positions = [group_positions[name] for name in joint_names]
+                counts = numpy.array([indptr[i+1] - indptr[i] for i in positions], dtype=numpy.int64)
+                joint_indptr = numpy.zeros(len(positions) + 1, dtype=numpy.int64)
+                numpy.cumsum(counts, out=joint_indptr[1:])
+                joint_indices = numpy.concatenate([indices[indptr[i]:indptr[i+1]] for i in positions] + [numpy.zeros(0, dtype=numpy.int32)])
+                return joint_names, joint_indptr, joint_indices, True
+
+        # The mesh has been modified, so use its actual vertex groups. Transposing the vertex x group
+        # table with a stable sort keeps the vertices of each group in ascending order.
+        (vertex_indptr, group_indices, _weights) = MeshService.get_vertex_group_weight_table(basemesh)
+        vertex_indices = numpy.repeat(numpy.arange(len(vertex_indptr) - 1), numpy.diff(vertex_indptr))
+        joint_group_indices = [basemesh.vertex_groups[name].index for name in joint_names]
+        order = numpy.argsort(group_indices, kind="stable")
+        sorted_groups = group_indices[order]
+        starts = numpy.searchsorted(sorted_groups, joint_group_indices, side="left")
+        ends = numpy.searchsorted(sorted_groups, joint_group_indices, side="right")
+        joint_indptr = numpy.zeros(len(joint_names) + 1, dtype=numpy.int64)
+        numpy.cumsum(ends - starts, out=joint_indptr[1:])
+        joint_indices = numpy.concatenate([vertex_indices[order[start:end]] for start, end in zip(starts, ends)] + [numpy.zeros(0, dtype=numpy.int64)])
+        return joint_names, joint_indptr, joint_indices, False
+
     def build_basemesh_position_info(self, take_shape_keys_into_account=True):
         """Populate the position information hash with positions from the base mesh.
         We will here also extract and store vertex positions and store them in the hash,
@@ -217,53 +380,30 @@ class Rig:
         self.position_info["cubes"] = dict()
         cubes = self.position_info["cubes"]
 
-        self.position_info["vertices"] = []
-        vertices = self.position_info["vertices"]
-
-        cube_groups = dict()
-        group_index_to_name = dict()
+        self._vertex_tree = None
 
         basemesh = self.basemesh
 
-        for group in basemesh.vertex_groups:
-            idx = int(group.index)
-            name = str(group.name)
-            if "joint" in name:
-                cube_groups[name] = []
-                group_index_to_name[idx] = name
-
-        coords = basemesh.data.vertices
-        shape_key = None
-        key_name = None
-        if take_shape_keys_into_account and basemesh.data.shape_keys and basemesh.data.shape_keys.key_blocks and len(basemesh.data.shape_keys.key_blocks) > 0:
-            from mpfb.services.targetservice import TargetService
-            key_name = "temporary_fit_rig_key." + str(random.randrange(1000, 9999))
-            shape_key = TargetService.create_shape_key(basemesh, key_name, also_create_basis=True, create_from_mix=True)
-            coords = shape_key.data
-
-        for vertex in basemesh.data.vertices:
-            vertex_coords = list(coords[vertex.index].co) # Either actual vertex or the corresponding shape key point
-            vertices.append(vertex_coords)
-            for group in vertex.groups:
-                idx = int(group.group)
-                if idx in group_index_to_name:
-                    name = group_index_to_name[idx]
-                    cube_groups[name].append(vertex_coords)
-
-        if shape_key:
-            basemesh.shape_key_remove(shape_key)
-
-        _LOG.dump("cube_groups", cube_groups)
-
-        for name in group_index_to_name.values():
-            group = cube_groups[name]
-            sum_pos = [0.0, 0.0, 0.0]
-            for i in range(len(group)):
-                for n in range(3):
-                    sum_pos[n] = sum_pos[n] + group[i][n]
-            for n in range(3):
-                sum_pos[n] = sum_pos[n] / float(len(group))
-            cubes[name] = sum_pos
+        if take_shape_keys_into_account:
+            coords = MeshService.get_shaped_coordinates(basemesh)
+        else:
+            coords = MeshService.get_vertex_coordinates(basemesh)
+
+        # Either actual vertex or the mixed shape key position
+        vertices = numpy.array(coords, dtype=numpy.float64)
+        self.position_info["vertices"] = vertices
+
+        # The position of a joint cube is the centroid of the vertices in its vertex group
+        (joint_names, joint_indptr, joint_indices, _from_metadata) = Rig._get_joint_group_vertices(basemesh)
+        counts = numpy.diff(joint_indptr)
+        non_empty = counts > 0
+        if numpy.any(non_empty):
+            sums = numpy.add.reduceat(vertices[joint_indices], joint_indptr[:-1][non_empty], axis=0)
+            centroids = sums / counts[non_empty][:, None]
+            for name, centroid in zip(numpy.array(joint_names)[non_empty].tolist(), centroids.tolist()):
+                cubes[name] = centroid
+
+        _LOG.dump("cubes", cubes)
 
     def add_edit_bone_info(self):
         """Extract bone information from the edit bones."""
@@ -424,119 +564,93 @@ class Rig:
 
         return None
 
+    def _get_vertex_tree(self):
+        """Return a KD tree over the vertex positions, building it on first use."""
+        if self._vertex_tree is None:
+            vertices = self.position_info["vertices"]
+            tree = KDTree(len(vertices))
+            for idx, vertex in enumerate(vertices.tolist()):
+                tree.insert(vertex, idx)
+            tree.balance()
+            self._vertex_tree = tree
+        return self._vertex_tree
+
+    def _find_vertices_in_range(self, pos, radius):
+        """Return the indices, in ascending order, of all vertices less than radius away from pos. The KD tree works
+        in single precision, so the range is padded slightly and the caller is expected to check exact distances."""
+        found = self._get_vertex_tree().find_range(pos, radius * 1.001 + 0.000001)
+        return numpy.array(sorted([found_vertex[1] for found_vertex in found]), dtype=numpy.int64)
+
     def _find_closest_vertex(self, pos, max_allowed_dist=_MAX_ALLOWED_DIST, max_dist_to_consider_exact=_MAX_DIST_TO_CONSIDER_EXACT):
 
-        best_match_index = None
-        best_match_dist = 1000.0
+        vertices = self.position_info["vertices"]
+        pos = numpy.array(pos, dtype=numpy.float64)
 
-        # There's no point in calculating exact distances to vertices which are rougly, more than 0.1 points
-        # away from the desired position
-        reasonably_close_vertices = []
-        max_allowed_distsum = max_allowed_dist * 10
-
-        # Make a first sweep to see if we can find an exact match. Three subtractions is a lot faster
-        # than calculating a distance with square roots and whatnot.
-        for idx in range(len(self.position_info["vertices"])):
-            vertex = self.position_info["vertices"][idx]
-            is_close = True
-            distsum = 0.0
-            for i in range(3):
-                dist = abs(vertex[i] - pos[i])
-                if dist > max_dist_to_consider_exact:
-                    is_close = False
-                distsum = distsum + dist
-            if is_close:
-                # We found a vertex which is close enough to be considered an exact match
-                return idx
-            if distsum < max_allowed_distsum:
-                # The vertext is close enough to be relevant to consider when calculating
-                # exact distances
-                reasonably_close_vertices.append(idx)
-
-        # We did not have an exact match. Make secondary sweep
-
-        for idx in reasonably_close_vertices:
-            vertex = self.position_info["vertices"][idx]
-            dist = self._distance(pos, vertex)
-            if dist < best_match_dist:
-                best_match_dist = dist
-                best_match_index = idx
+        # See if we can find an exact match, ie a vertex which is closer than max_dist_to_consider_exact
+        # along every axis. If there are several, the one with the lowest index is used.
+        candidates = self._find_vertices_in_range(pos, max_dist_to_consider_exact * math.sqrt(3.0))
+        if len(candidates) > 0:
+            exact = numpy.all(numpy.abs(vertices[candidates] - pos) <= max_dist_to_consider_exact, axis=1)
+            if numpy.any(exact):
+                return int(candidates[numpy.argmax(exact)])
 
-        if best_match_dist < max_allowed_dist:
-            return best_match_index
+        # We did not have an exact match. Find the closest vertex within the allowed distance
+
+        candidates = self._find_vertices_in_range(pos, max_allowed_dist)
+        if len(candidates) < 1:
+            return None
+
+        distances = numpy.sqrt(numpy.sum(numpy.square(vertices[candidates] - pos), axis=1))
+        best = numpy.argmin(distances)
+        if distances[best] < max_allowed_dist:
+            return int(candidates[best])
 
         return None
 
     def _find_closest_vertex_mean(self, pos, max_allowed_dist=_MAX_ALLOWED_DIST*2, max_dist_to_consider_exact=_MAX_DIST_TO_CONSIDER_EXACT*2):
 
-        within_range_idxs = []
+        vertices = self.position_info["vertices"]
+        pos = numpy.array(pos, dtype=numpy.float64)
 
         # First we'll only include verts which are less than 15% of the total height
         # away from the position along any axis
 
-        highest_z = -1000.0
-        lowest_z = 1000.0
-
-        for idx in range(len(self.position_info["vertices"])):
-            vertex = self.position_info["vertices"][idx]
-            if vertex[2] > highest_z:
-                highest_z = vertex[2]
-            if vertex[2] < lowest_z:
-                lowest_z = vertex[2]
-
-        total_height = abs(highest_z - lowest_z)
+        total_height = abs(float(numpy.max(vertices[:, 2])) - float(numpy.min(vertices[:, 2])))
         _LOG.debug("total height", total_height)
 
         max_axis_distance = 0.15 * total_height
 
-        for idx in range(len(self.position_info["vertices"])):
-            vertex = self.position_info["vertices"][idx]
-            is_close = True
-            for i in range(3):
-                if abs(pos[i] - vertex[i]) > max_axis_distance:
-                    is_close = False
-            if is_close:
-                # This vertex is close enough to be considered at all
-                within_range_idxs.append(idx)
-
-        geometric_means_table = dict()
+        within_range = numpy.all(numpy.abs(vertices - pos) <= max_axis_distance, axis=1)
 
         # The geometric mean should be even closer
         max_allowed_distsum = max_axis_distance / 5
 
-        for idx1 in within_range_idxs:
-            geometric_means_table[idx1] = dict()
-            vertex1 = self.position_info["vertices"][idx1]
-            for idx2 in within_range_idxs:
-                vertex2 = self.position_info["vertices"][idx2]
-                distsum = 0.0
-                vertex_mean = [0.0, 0.0, 0.0]
-                for i in range(3):
-                    vertex_mean[i] = (vertex1[i] + vertex2[i]) / 2.0
-                    distsum = distsum + abs(pos[i] - vertex_mean[i])
-                if distsum < (max_dist_to_consider_exact * 3):
-                    # This is a candidate to check early
-                    actual_dist = self._distance(pos, vertex_mean)
-                    if actual_dist < max_dist_to_consider_exact:
-                        return [idx1, idx2]
-                if distsum < max_allowed_distsum:
-                    geometric_means_table[idx1][idx2] = vertex_mean
-
-        # Within all reason we should already have found a match. But if we haven't, there's no recourse
-        # short of brute forcing the entire table
+        # The mean of vertex1 and vertex2 is within a distance d from pos exactly when vertex2 is within
+        # 2 * d from the reflection of vertex1 through pos. So for each vertex1, a range query gives all
+        # possible partners. Pairs are visited in the same order as a full table scan would, so the
+        # first exact match and ties between best matches are the same.
 
         best_match_idxs = None
         best_match_dist = 1000.0
 
-        for idx1 in within_range_idxs:
-            for idx2 in within_range_idxs:
-                if idx1 in geometric_means_table and idx2 in geometric_means_table[idx1]:
-                    vertex_mean = geometric_means_table[idx1][idx2]
-                    dist = self._distance(pos, vertex_mean)
-                    if dist < max_dist_to_consider_exact:
-                        return [idx1, idx2]
-                    if dist < best_match_dist and dist < max_allowed_dist:
-                        best_match_dist = dist
-                        best_match_idxs = [idx1, idx2]
+        for idx1 in numpy.flatnonzero(within_range).tolist():
+            vertex1 = vertices[idx1]
+            candidates = self._find_vertices_in_range(2.0 * pos - vertex1, 2.0 * max_allowed_dist)
+            if len(candidates) < 1:
+                continue
+            candidates = candidates[within_range[candidates]]
+            if len(candidates) < 1:
+                continue
+            vertex_means = (vertex1 + vertices[candidates]) / 2.0
+            distances = numpy.sqrt(numpy.sum(numpy.square(pos - vertex_means), axis=1))
+            exact = distances < max_dist_to_consider_exact
+            if numpy.any(exact):
+                return [idx1, int(candidates[numpy.argmax(exact)])]
+            distsums = numpy.sum(numpy.abs(pos - vertex_means), axis=1)
+            distances[distsums >= max_allowed_distsum] = numpy.inf
+            best = numpy.argmin(distances)
+            if distances[best] < best_match_dist and distances[best] < max_allowed_dist:
+                best_match_dist = float(distances[best])
+                best_match_idxs = [idx1, int(candidates[best])]
 
         return best_match_idxs
@@ -4,6 +4,7 @@ for more info."""
 
 import gc, numpy
 from mpfb.services.logservice import LogService
+from mpfb.services.meshservice import MeshService
 
 _LOG = LogService.get_logger("socketobject.socketmeshobject")
 
@@ -281,17 +282,12 @@ class SocketMeshObject:
             _LOG.debug("No weights for group:", name)
             return
 
-        # Here we expect that the vertex group already exist with the proper vertices
-        # already added, although with 1.0 as weight for all vertices. We will iterate
-        # over the two parallel arrays constructed in arrange_weights() and pick the
-        # vertex index from one and the weight from the other
-        # Having pre-added all vertices in one operation and then updating the weights
-        # is a lot faster than adding each vertex individually together with its weight.
-        for vertex_index, vertex_weight in zip(self._vertex_groups_by_name[name], self._weights_by_name[name]):
-            vertex = mesh.vertices[vertex_index]
-            for group in vertex.groups:
-                if group.group == vertex_group.index:
-                    group.weight = vertex_weight
+        # The vertex indices and weights are two parallel arrays constructed in arrange_weights().
+        # The vertices are written with one call per distinct weight rather than one per vertex.
+        vertex_indices = self._vertex_groups_by_name[name]
+        weights = self._weights_by_name[name]
+        length = min(len(vertex_indices), len(weights))
+        MeshService.set_vertex_group_weights(vertex_group, vertex_indices[:length], weights[:length])
 
     def create_uv_layer(self, mesh):
         """Create a new UV layer for the mesh, based on the uv and texco information
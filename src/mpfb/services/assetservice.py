@@ -1,17 +1,47 @@
 """This module contains utility functions scanning asset repositories."""
 
-import os, bpy
+import os, bpy, sqlite3
 from pathlib import Path
 from mpfb.services.objectservice import ObjectService
 from mpfb.services.logservice import LogService
 from mpfb.services.locationservice import LocationService
 from mpfb.services.uiservice import UiService
+from mpfb.entities.primitiveprofiler import PrimitiveProfiler
+from mpfb.entities.clothes.mhclo import Mhclo
 
 _LOG = LogService.get_logger("services.assetservice")
 
 _ASSETS = dict()
 _ASSET_THUMBS = None
 
+# The asset catalog is an sqlite database with all files found below the asset roots, so that
+# assets can be resolved without walking the directory trees. The directories are stored with
+# their modification times, so that only changed directories need to be rescanned.
+_CATALOG_FILE = LocationService.get_user_cache("asset_catalog.sqlite")
+_CATALOG_VERSION = 2
+_CATALOG = None
+_CATALOG_VALIDATED = set()
+
+_CATALOG_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS roots (asset_subdir TEXT NOT NULL, root TEXT NOT NULL, PRIMARY KEY (asset_subdir, root))",
+    "CREATE TABLE IF NOT EXISTS directories (asset_subdir TEXT NOT NULL, path TEXT NOT NULL, root TEXT NOT NULL, mtime INTEGER NOT NULL, PRIMARY KEY (asset_subdir, path))",
+    "CREATE TABLE IF NOT EXISTS assets (asset_subdir TEXT NOT NULL, full_path TEXT NOT NULL, root TEXT NOT NULL, directory TEXT NOT NULL, " +
+    "basename TEXT NOT NULL, fragment TEXT NOT NULL, name_without_ext TEXT NOT NULL, asset_type TEXT NOT NULL, thumb_path TEXT, " +
+    "mtime INTEGER NOT NULL, uuid TEXT, name TEXT, obj_file TEXT, material TEXT, tags TEXT, PRIMARY KEY (asset_subdir, full_path))",
+    "CREATE INDEX IF NOT EXISTS assets_basename ON assets (asset_subdir, basename)",
+    "CREATE INDEX IF NOT EXISTS assets_fragment ON assets (asset_subdir, fragment)",
+    "CREATE INDEX IF NOT EXISTS assets_type ON assets (asset_subdir, asset_type)",
+    "CREATE INDEX IF NOT EXISTS assets_uuid ON assets (uuid)",
+    "CREATE INDEX IF NOT EXISTS assets_name ON assets (name)",
+    "CREATE INDEX IF NOT EXISTS assets_directory ON assets (asset_subdir, directory)"
+    ]
+
+_CATALOG_INSERT_ASSET = "INSERT OR REPLACE INTO assets (asset_subdir, full_path, root, directory, basename, fragment, name_without_ext, " + \
+    "asset_type, thumb_path, mtime, uuid, name, obj_file, material, tags) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+
+# Asset types for which metadata is read from the file header
+_CATALOG_HEADER_TYPES = ["mhclo", "proxy"]
+
 ASSET_LIBRARY_SECTIONS = [
         {
             "bl_label": "Topologies library",
@@ -93,6 +123,185 @@ class AssetService:
     def __init__(self):
         raise RuntimeError("You should not instance AssetService. Use its static methods instead.")
 
+    @staticmethod
+    def _get_catalog():
+        global _CATALOG # pylint: disable=W0603
+        if _CATALOG is None:
+            _LOG.debug("Opening asset catalog", _CATALOG_FILE)
+            try:
+                _CATALOG = AssetService._open_catalog(_CATALOG_FILE)
+            except sqlite3.OperationalError as error:
+                # For example an unwritable cache dir, or a database locked by another blender instance
+                _LOG.warn("Asset catalog could not be opened, using an in-memory catalog", error)
+                _CATALOG = AssetService._open_catalog(":memory:")
+            except (sqlite3.DatabaseError, OSError) as error:
+                _LOG.warn("Asset catalog could not be opened, will recreate it", error)
+                try:
+                    if os.path.exists(_CATALOG_FILE):
+                        os.remove(_CATALOG_FILE)
+                    _CATALOG = AssetService._open_catalog(_CATALOG_FILE)
+                except (sqlite3.DatabaseError, OSError) as recreate_error:
+                    _LOG.warn("Asset catalog could not be recreated, using an in-memory catalog", recreate_error)
+                    _CATALOG = AssetService._open_catalog(":memory:")
+        return _CATALOG
+
+    @staticmethod
+    def _open_catalog(catalog_file):
+        """Connect to the catalog database, and (re)create its tables if it is new or has an old format."""
+        if catalog_file != ":memory:":
+            os.makedirs(os.path.dirname(catalog_file), exist_ok=True)
+        catalog = sqlite3.connect(catalog_file, check_same_thread=False)
+        try:
+            version = catalog.execute("PRAGMA user_version").fetchone()[0]
+            if version != _CATALOG_VERSION:
+                _LOG.debug("Asset catalog has an old format, recreating", version)
+                for table in ["roots", "directories", "assets"]:
+                    catalog.execute("DROP TABLE IF EXISTS " + table)
+                for statement in _CATALOG_SCHEMA:
+                    catalog.execute(statement)
+                catalog.execute("PRAGMA user_version = " + str(_CATALOG_VERSION))
+                catalog.commit()
+        except (sqlite3.Error, OSError):
+            catalog.close()
+            raise
+        return catalog
+
+    @staticmethod
+    def _read_asset_header(full_path, asset_type):
+        """Return a (uuid, name, obj_file, material, tags) tuple read from the header of an asset file,
+        without parsing the vertex data."""
+        if not asset_type in _CATALOG_HEADER_TYPES:
+            return None, None, None, None, None
+        mhclo = Mhclo()
+        try:
+            mhclo.load_header(full_path)
+        except OSError as error:
+            _LOG.warn("Could not read asset header", (full_path, error))
+            return None, None, None, None, None
+        return mhclo.uuid, mhclo.name, mhclo.obj_file, mhclo.material, mhclo.tags
+
+    @staticmethod
+    def _catalog_scan_directory(catalog, asset_subdir, root, dirpath, known_directories, visited):
+        """Replace the catalog content for a single directory, and recurse into subdirectories which
+        are not in the catalog yet. Directories whose real path is in the visited set are skipped,
+        so that symlink loops do not recurse forever."""
+        real_path = os.path.realpath(dirpath)
+        if real_path in visited:
+            _LOG.debug("Skipping already scanned asset directory", dirpath)
+            return
+        visited.add(real_path)
+        _LOG.debug("Scanning asset directory", dirpath)
+        stat = os.stat(dirpath)
+        catalog.execute("INSERT OR REPLACE INTO directories (asset_subdir, path, root, mtime) VALUES (?, ?, ?, ?)", (asset_subdir, dirpath, root, stat.st_mtime_ns))
+        catalog.execute("DELETE FROM assets WHERE asset_subdir = ? AND directory = ?", (asset_subdir, dirpath))
+
+        files = []
+        subdirs = []
+        with os.scandir(dirpath) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    subdirs.append(entry.path)
+                elif entry.is_file():
+                    files.append(entry)
+
+        filenames = set([entry.name for entry in files])
+        rows = []
+        for entry in files:
+            basename = entry.name
+            if not "." in basename:
+                continue
+            name_without_ext, asset_type = basename.rsplit(".", 1)
+            thumb_path = None
+            if name_without_ext + ".thumb" in filenames:
+                thumb_path = os.path.join(dirpath, name_without_ext + ".thumb")
+            header = AssetService._read_asset_header(entry.path, asset_type)
+            fragment = os.path.basename(dirpath) + "/" + basename
+            rows.append((asset_subdir, entry.path, root, dirpath, basename, fragment, name_without_ext, asset_type, thumb_path, entry.stat().st_mtime_ns) + header)
+        catalog.executemany(_CATALOG_INSERT_ASSET, rows)
+
+        for subdir in sorted(subdirs):
+            if not subdir in known_directories:
+                AssetService._catalog_scan_directory(catalog, asset_subdir, root, subdir, known_directories, visited)
+
+    @staticmethod
+    def _catalog_forget_directory(catalog, asset_subdir, dirpath):
+        catalog.execute("DELETE FROM directories WHERE asset_subdir = ? AND path = ?", (asset_subdir, dirpath))
+        catalog.execute("DELETE FROM assets WHERE asset_subdir = ? AND directory = ?", (asset_subdir, dirpath))
+
+    @staticmethod
+    def refresh_catalog(asset_subdir="clothes", force=False):
+        """Bring the catalog up to date for the given asset subdir. Only directories whose modification
+        time has changed since the last scan are rescanned. With force, the subdir is rescanned from scratch."""
+        _LOG.enter()
+        profiler = PrimitiveProfiler("AssetService")
+        profiler.enter("refresh_catalog")
+
+        catalog = AssetService._get_catalog()
+        roots = [os.path.abspath(root) for root in AssetService.get_asset_roots(asset_subdir)]
+
+        if force:
+            catalog.execute("DELETE FROM roots WHERE asset_subdir = ?", (asset_subdir,))
+            catalog.execute("DELETE FROM directories WHERE asset_subdir = ?", (asset_subdir,))
+            catalog.execute("DELETE FROM assets WHERE asset_subdir = ?", (asset_subdir,))
+
+        known_roots = set([row[0] for row in catalog.execute("SELECT root FROM roots WHERE asset_subdir = ?", (asset_subdir,))])
+        for root in known_roots:
+            if not root in roots:
+                _LOG.debug("Asset root is no longer relevant", root)
+                catalog.execute("DELETE FROM roots WHERE asset_subdir = ? AND root = ?", (asset_subdir, root))
+                catalog.execute("DELETE FROM directories WHERE asset_subdir = ? AND root = ?", (asset_subdir, root))
+                catalog.execute("DELETE FROM assets WHERE asset_subdir = ? AND root = ?", (asset_subdir, root))
+
+        known_directories = dict()
+        for path, root, mtime in catalog.execute("SELECT path, root, mtime FROM directories WHERE asset_subdir = ?", (asset_subdir,)).fetchall():
+            known_directories[path] = (root, mtime)
+
+        visited = set()
+        for path, (root, mtime) in known_directories.items():
+            if not os.path.isdir(path):
+                AssetService._catalog_forget_directory(catalog, asset_subdir, path)
+            elif os.stat(path).st_mtime_ns != mtime:
+                AssetService._catalog_scan_directory(catalog, asset_subdir, root, path, known_directories, visited)
+
+        for root in roots:
+            if not root in known_roots:
+                catalog.execute("INSERT OR REPLACE INTO roots (asset_subdir, root) VALUES (?, ?)", (asset_subdir, root))
+            if not root in known_directories:
+                AssetService._catalog_scan_directory(catalog, asset_subdir, root, root, known_directories, visited)
+
+        catalog.commit()
+        _CATALOG_VALIDATED.add(asset_subdir)
+        profiler.leave("refresh_catalog")
+
+    @staticmethod
+    def _ensure_catalog(asset_subdir):
+        # The catalog is validated against the file system once per session and asset subdir. After that,
+        # changes are picked up when a lookup misses or when the asset lists are explicitly updated.
+        if not asset_subdir in _CATALOG_VALIDATED:
+            AssetService.refresh_catalog(asset_subdir)
+        return AssetService._get_catalog()
+
+    @staticmethod
+    def _catalog_rows_as_dicts(cursor):
+        columns = [description[0] for description in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    @staticmethod
+    def query_catalog(asset_subdir="clothes", asset_type=None, basename=None, fragment=None, uuid=None, name=None):
+        """Return a list of dicts describing the cataloged assets matching all given criteria. The list is
+        ordered by data root in the same order as get_available_data_roots(), then by path."""
+        catalog = AssetService._ensure_catalog(asset_subdir)
+        sql = "SELECT * FROM assets WHERE asset_subdir = ?"
+        arguments = [asset_subdir]
+        for column, value in [("asset_type", asset_type), ("basename", basename), ("fragment", fragment), ("uuid", uuid), ("name", name)]:
+            if not value is None:
+                sql = sql + " AND " + column + " = ?"
+                arguments.append(value)
+        rows = AssetService._catalog_rows_as_dicts(catalog.execute(sql, arguments))
+        roots = [os.path.abspath(root) for root in AssetService.get_asset_roots(asset_subdir)]
+        rows.sort(key=lambda row: (roots.index(row["root"]) if row["root"] in roots else len(roots), row["full_path"]))
+        return rows
+
     @staticmethod
     def find_asset_files_matching_pattern(asset_roots, pattern="*.mhclo"):
         _LOG.enter()
@@ -104,22 +313,59 @@ class AssetService:
                     found_files.append(path)
         return found_files
 
+    @staticmethod
+    def _catalog_revalidate_rows(asset_subdir, rows):
+        """Drop rows for files which no longer exist and reread the headers of files which have been
+        modified in place, which does not show up as a changed directory."""
+        catalog = AssetService._get_catalog()
+        valid = []
+        changed = False
+        for row in rows:
+            if not os.path.exists(row["full_path"]):
+                continue
+            mtime = os.stat(row["full_path"]).st_mtime_ns
+            if mtime != row["mtime"]:
+                header = AssetService._read_asset_header(row["full_path"], row["asset_type"])
+                row["mtime"] = mtime
+                row["uuid"], row["name"], row["obj_file"], row["material"], row["tags"] = header
+                catalog.execute("UPDATE assets SET mtime = ?, uuid = ?, name = ?, obj_file = ?, material = ?, tags = ? WHERE asset_subdir = ? AND full_path = ?",
+                                (mtime,) + header + (asset_subdir, row["full_path"]))
+                changed = True
+            valid.append(row)
+        if changed:
+            catalog.commit()
+        return valid
+
+    @staticmethod
+    def find_asset_by_uuid(uuid, asset_subdir="clothes", asset_type=None):
+        """Return a list of dicts with catalog information (full_path, fragment, name, obj_file, material,
+        tags...) for all assets in the asset subdir with the given uuid."""
+        _LOG.enter()
+        if not uuid:
+            return []
+        rows = AssetService.query_catalog(asset_subdir, asset_type=asset_type, uuid=uuid)
+        rows = [row for row in AssetService._catalog_revalidate_rows(asset_subdir, rows) if row["uuid"] == uuid]
+        if len(rows) < 1:
+            AssetService.refresh_catalog(asset_subdir)
+            rows = AssetService.query_catalog(asset_subdir, asset_type=asset_type, uuid=uuid)
+        _LOG.debug("Assets matching uuid", (uuid, [row["full_path"] for row in rows]))
+        return rows
+
     @staticmethod
     def find_asset_absolute_path(asset_path_fragment, asset_subdir="clothes"):
         _LOG.enter()
-        roots = AssetService.get_asset_roots(asset_subdir)
         filename = asset_path_fragment
         if "/" in asset_path_fragment:
             filename = os.path.basename(filename)
-        matches = []
         _LOG.debug("Searching for asset with basename", filename)
-        for root in roots:
-            for dirpath, subdirs, files in os.walk(root):
-                _LOG.debug("Looking in directory", dirpath)
-                if filename in files:
-                    full_path = os.path.join(root, dirpath, filename)
-                    _LOG.debug("Found match", full_path)
-                    matches.append(full_path)
+
+        matches = [row["full_path"] for row in AssetService.query_catalog(asset_subdir, basename=filename)]
+        matches = [match for match in matches if os.path.exists(match)]
+
+        if len(matches) < 1:
+            # The catalog might be outdated, so check for changes on disk before giving up
+            AssetService.refresh_catalog(asset_subdir)
+            matches = [row["full_path"] for row in AssetService.query_catalog(asset_subdir, basename=filename)]
 
         if len(matches) < 1:
             # We couldn't find the asset in question
@@ -201,19 +447,19 @@ class AssetService:
 
         global _ASSET_THUMBS
 
-        roots = AssetService.get_asset_roots(asset_subdir)
-        assets = AssetService.find_asset_files_matching_pattern(roots, "*." + asset_type)
+        AssetService.refresh_catalog(asset_subdir)
+        assets = AssetService.query_catalog(asset_subdir, asset_type=asset_type)
 
         asset_list = dict()
 
         for asset in assets:
-            _LOG.debug("Asset", asset)
+            _LOG.debug("Asset", asset["full_path"])
             item = dict()
-            item["full_path"] = str(asset)
-            item["basename"] = os.path.basename(asset)
-            item["dirname"] = os.path.dirname(asset)
-            item["fragment"] = os.path.basename(item["dirname"]) + "/" + item["basename"]
-            item["name_without_ext"] = str(item["basename"]).replace("." + asset_type, "")
+            item["full_path"] = asset["full_path"]
+            item["basename"] = asset["basename"]
+            item["dirname"] = asset["directory"]
+            item["fragment"] = asset["fragment"]
+            item["name_without_ext"] = asset["name_without_ext"]
             item["thumb"] = None
             item["thumb_path"] = None
             label = str(item["name_without_ext"]).lower().replace("_", " ")
@@ -223,15 +469,15 @@ class AssetService:
             if _ASSET_THUMBS is None:
                 _ASSET_THUMBS = bpy.utils.previews.new()
 
-            thumb = os.path.join(os.path.dirname(asset), item["name_without_ext"] + ".thumb")
-            if os.path.exists(thumb):
+            thumb = asset["thumb_path"]
+            if thumb:
                 item["thumb_path"] = thumb
                 _LOG.debug("Will try to load icon", (label, thumb))
                 if not thumb in _ASSET_THUMBS:
                     _ASSET_THUMBS.load(thumb, thumb, 'IMAGE')
                 item["thumb"] = _ASSET_THUMBS[thumb]
             else:
-                _LOG.warn("Missing thumb", thumb)
+                _LOG.warn("Missing thumb", os.path.join(asset["directory"], item["name_without_ext"] + ".thumb"))
 
             _LOG.dump("Item", item)
             asset_list[label] = item
@@ -1,8 +1,8 @@
 """This module contains utility functions for clothes."""
 
-import random, os
-from mathutils import Vector
+import os, numpy
 from mpfb.services.objectservice import ObjectService
+from mpfb.services.meshservice import MeshService
 from mpfb.services.logservice import LogService
 from mpfb.services.assetservice import AssetService
 from mpfb.entities.objectproperties import GeneralObjectProperties
@@ -10,6 +10,10 @@ from mpfb.entities.clothes.mhclo import Mhclo
 
 _LOG = LogService.get_logger("services.clothesservice")
 
+# Interpolated clothes weights are continuous averages which are almost never equal. Rounding them to
+# this many decimals is visually lossless and lets them be written with far fewer vertex group calls.
+_INTERPOLATED_WEIGHT_DECIMALS = 3
+
 class ClothesService:
     """Utility functions for clothes."""
 
@@ -48,21 +52,30 @@ class ClothesService:
                 raise ValueError('There is not enough info to refit this asset, at least asset source and object type is needed')
             mhclo.clothes = clothes
 
-        if not mhclo.verts or len(mhclo.verts.keys()) <1:
+        if mhclo.ref_verts is None or len(mhclo.ref_verts) < 1:
             raise ValueError('There is no vertex info in the MHCLO!?')
 
         # We cannot rely on the vertex position data directly, since it represent positions
         # as they are *before* targets are applied. We want the shape of the mesh *after*
-        # targets are applied.
-        #
-        # We will therefore create a new shape key "from mix". This means it will have the
-        # combined state of all current shape keys. Then we will use that shape key for
-        # getting vertex positions.
-        key_name = "temporary_fitting_key." + str(random.randrange(1000, 9999))
-        basemesh.shape_key_add(name=key_name, from_mix=True)
-        shape_key = basemesh.data.shape_keys.key_blocks[key_name]
-        human_vertices = shape_key.data
-        human_vertices_count = len(human_vertices)
+        # targets are applied, ie the combined state of all current shape keys.
+        human_coordinates = MeshService.get_shaped_coordinates(basemesh)
+
+        ClothesService._fit_clothes_to_coordinates(clothes, basemesh, mhclo, human_coordinates)
+
+        # We need to take into account that the base mesh might be rigged. If it is, we'll want the rig position
+        # rather than the basemesh position
+        if basemesh.parent:
+            clothes.location = (0.0, 0.0, 0.0)
+            clothes.parent = basemesh.parent
+        else:
+            clothes.location = basemesh.location
+
+    @staticmethod
+    def _fit_clothes_to_coordinates(clothes, basemesh, mhclo, human_coordinates):
+        """Move the clothes vertices to the positions given by the mhclo binding to the provided (N, 3)
+        array of base mesh coordinates."""
+        human_vertices_count = len(human_coordinates)
+        human_coordinates = numpy.asarray(human_coordinates, dtype=numpy.float64)
 
         scale_factor = GeneralObjectProperties.get_value("scale_factor", entity_reference=basemesh)
         if not scale_factor:
@@ -78,78 +91,73 @@ class ClothesService:
                 _LOG.warn("Giving up refitting, not inside")
                 raise ValueError("Cannot refit as we are not inside")
 
-            x_size = abs(human_vertices[mhclo.x_scale[0]].co[0] - human_vertices[mhclo.x_scale[1]].co[0]) / mhclo.x_scale[2]
-            y_size = abs(human_vertices[mhclo.y_scale[0]].co[2] - human_vertices[mhclo.y_scale[1]].co[2]) / mhclo.y_scale[2]
-            z_size = abs(human_vertices[mhclo.z_scale[0]].co[1] - human_vertices[mhclo.z_scale[1]].co[1]) / mhclo.z_scale[2]
+            x_size = abs(human_coordinates[mhclo.x_scale[0]][0] - human_coordinates[mhclo.x_scale[1]][0]) / mhclo.x_scale[2]
+            y_size = abs(human_coordinates[mhclo.y_scale[0]][2] - human_coordinates[mhclo.y_scale[1]][2]) / mhclo.y_scale[2]
+            z_size = abs(human_coordinates[mhclo.z_scale[0]][1] - human_coordinates[mhclo.z_scale[1]][1]) / mhclo.z_scale[2]
 
         _LOG.debug("x_scale, y_scale, z_scale", (mhclo.x_scale, mhclo.y_scale, mhclo.z_scale))
         _LOG.debug("x_size, y_size, z_size", (x_size, y_size, z_size))
 
-        clothes_vertices = mhclo.clothes.data.vertices
+        clothes_vertices = clothes.data.vertices
+        clothes_vertices_count = len(clothes_vertices)
 
-        _LOG.debug("About to try to match vertices: ", len(clothes_vertices))
-        _LOG.dump("Verts", mhclo.verts)
+        _LOG.debug("About to try to match vertices: ", clothes_vertices_count)
 
-        for clothes_vertex_number in range(len(clothes_vertices)):
-            vertex_match_info = mhclo.verts[clothes_vertex_number]
-            _LOG.dump("Vertex match info", (clothes_vertex_number, vertex_match_info))
-            (human_vertex1, human_vertex2, human_vertex3) = vertex_match_info["verts"]
+        if clothes_vertices_count > len(mhclo.ref_verts):
+            raise ValueError("The clothes mesh has more vertices than the MHCLO has vertex info for")
 
-            # test if we inside mesh, if not, no chance
-            #
-            if human_vertex1 >= human_vertices_count or human_vertex2 > human_vertices_count or human_vertex3 >= human_vertices_count:
-                continue
+        ref_verts = mhclo.ref_verts[0:clothes_vertices_count]
+        weights = mhclo.weights[0:clothes_vertices_count]
+        offsets = mhclo.offsets[0:clothes_vertices_count]
 
-            offset = [vertex_match_info["offsets"][0]*x_size, vertex_match_info["offsets"][1]*z_size, vertex_match_info["offsets"][2]*y_size]
-            clothes_vertices[clothes_vertex_number].co = \
-                vertex_match_info["weights"][0] * human_vertices[human_vertex1].co + \
-                vertex_match_info["weights"][1] * human_vertices[human_vertex2].co + \
-                vertex_match_info["weights"][2] * human_vertices[human_vertex3].co + \
-                Vector(offset)
+        # Vertices which refer to a base mesh vertex which does not exist (for example a helper
+        # which has been removed) are left where they are
+        inside = numpy.all(ref_verts < human_vertices_count, axis=1)
+        if not numpy.all(inside):
+            _LOG.debug("Number of clothes vertices outside the base mesh", int(numpy.count_nonzero(~inside)))
+            ref_verts = ref_verts[inside]
+            weights = weights[inside]
+            offsets = offsets[inside]
 
-        # We need to take into account that the base mesh might be rigged. If it is, we'll want the rig position
-        # rather than the basemesh position
-        if basemesh.parent:
-            clothes.location = (0.0, 0.0, 0.0)
-            clothes.parent = basemesh.parent
+        # Weighted sum of the three reference vertices plus the offset scaled per axis. Note
+        # that the offsets are in blender's axis order, while the sizes are in makehuman's.
+        fitted = numpy.einsum("ij,ijk->ik", weights, human_coordinates[ref_verts])
+        fitted += offsets * numpy.array([x_size, z_size, y_size])
+
+        if numpy.all(inside):
+            coordinates = fitted
         else:
-            clothes.location = basemesh.location
+            coordinates = MeshService.get_vertex_coordinates(clothes)
+            coordinates[inside] = fitted
 
-        # As we are finished with the combined shape key we can now remove it
-        basemesh.shape_key_remove(shape_key)
+        MeshService.set_vertex_coordinates(clothes, coordinates)
 
     @staticmethod
     def _conservative_mask(basemesh, vertices_list):
+        """Remove vertices from the list (in place) if they belong to a face which has
+        vertices outside the list, so that masking never opens holes in the mesh."""
 
         vertices_list.sort()
 
         _LOG.reset_timer()
 
-        vertex_to_face = ObjectService.get_vertex_to_face_table()
-        face_to_vertex = ObjectService.get_face_to_vertex_table()
+        (indptr, indices) = ObjectService.get_face_to_vertex_csr()
         _LOG.time("loading tables")
         _LOG.reset_timer()
 
-        relevant_faces = set()
-        for vertex_index in vertices_list:
-            for face_index in vertex_to_face[vertex_index]:
-                relevant_faces.add(face_index)
-        _LOG.time("extracting relevant faces")
-        _LOG.reset_timer()
+        vertex_count = max(int(indices.max()) + 1, vertices_list[-1] + 1 if vertices_list else 0)
+        in_list = numpy.zeros(vertex_count, dtype=bool)
+        in_list[vertices_list] = True
 
-        partially_affected_faces = set()
-        for face_index in relevant_faces:
-            for vertex_index in face_to_vertex[face_index]:
-                if not vertex_index in vertices_list:
-                    partially_affected_faces.add(face_index)
-                    break
+        # Faces with vertices outside the list. Faces with no vertex in the list at all will
+        # not remove anything below, so there is no need to single out partially affected faces
+        face_has_outside_vertex = numpy.logical_or.reduceat(~in_list[indices], indptr[:-1])
         _LOG.time("finding faces with non-group vertices")
         _LOG.reset_timer()
 
-        for face_index in partially_affected_faces:
-            for vertex in face_to_vertex[face_index]:
-                if vertex in vertices_list:
-                    vertices_list.remove(vertex)
+        excluded = numpy.zeros(vertex_count, dtype=bool)
+        excluded[indices[numpy.repeat(face_has_outside_vertex, numpy.diff(indptr))]] = True
+        vertices_list[:] = [vertex for vertex, exclude in zip(vertices_list, excluded[vertices_list].tolist()) if not exclude]
 
         _LOG.time("excluding vertices")
 
@@ -255,95 +263,73 @@ class ClothesService:
         """Try to copy rigging weights from the base mesh to the clothes mesh, hopefully
         making the clothes fit the provided rig."""
 
-        # Create an empty outline with placeholders arrays that will contain lists of
-        # vertices + weights per vertex group
-        clothes_weights = dict()
-        for bone in rig.data.bones:
-            # The vertex groups have the same names as the bones
-            clothes_weights[str(bone.name)] = []
-
-        # Build cross reference dicts to easily map between a vertex group index and
-        # a vertex group name
-        group_name_to_index = dict()
+        # Only vertex groups with the same names as bones in the rig are relevant
+        bone_names = [str(bone.name) for bone in rig.data.bones]
         group_index_to_name = dict()
         for group in basemesh.vertex_groups:
-            if str(group.name) in clothes_weights:
-                group_name_to_index[str(group.name)] = group.index
+            if str(group.name) in bone_names:
                 group_index_to_name[int(group.index)] = str(group.name)
 
-        # We will now iterate over the vertices in the clothes. The idea is to then
-        # look up the vertices on the human that the clothes vertex is tied to. This
-        # information is provided in the mhclo object.
-        #
-        # For each mapping of clothes vertex to human vertex we also have a weight,
-        # so that clothes vertex 1 might be 20% tied to human vertex 1 and 40% tied to
-        # human vertex 2 and so on.
-        #
-        # By multiplying that weight with the vertex group weight of the human vertex, we
-        # get the interpolated vertex group weight for the clothes vertex.
-        for vert_number in range(len(mhclo.verts)):
-            clothes_vert = mhclo.verts[vert_number]
-            groups = dict()
-            for match_vert in range(3):
-                # Which human vert is the clothes vert tied to?
-                human_vert = basemesh.data.vertices[clothes_vert["verts"][match_vert]]
-
-                # .. and by how much?
-                assigned_weight = clothes_vert["weights"][match_vert]
-
-                # Iterate over all vertex groups the human vert belongs to
-                for group in human_vert.groups:
-                    idx = group.group
-                    if idx in group_index_to_name:
-                        if not idx in groups:
-                            groups[idx] = []
-                        # Add the calculated weight to the list of found weights
-                        #
-                        # Human vertex group weight * Human vertex weight
-                        groups[idx].append(group.weight * assigned_weight)
-
-            # Iterate over all found vertex groups for the current clothes vertex
-            # and calculcate the average weight for each group
-            for idx in groups.keys():
-                average_weight = sum(groups[idx]) / len(groups[idx])
-                # If the caculated average weight is below 0.001 we will ignore it. This
-                # makes the interpolation much faster later on
-                if average_weight > 0.001:
-                    group_name = group_index_to_name[int(idx)]
-                    clothes_weights[group_name].append([vert_number, average_weight])
-
-        # We now have a finished map with all weights. We will iterate over this
-        # and convert each weight array to a vertex group on the clothes, and then
-        # set the vertex weights in it
-        for group_name in clothes_weights.keys():
-            # Weights is an array looking like [ [vert_index, weight], [vert_index, weight]...]
-            weights = clothes_weights[group_name]
-
-            # No need to create a vertex group if no weights were found for it. For example,
-            # it is unnecessary to have an "upperarm02" group for shoes.
-            if len(weights) > 0:
-                # We want the vertex indices as a list. By using zip we can rotate the array
-                # so that columns become rows
-                rotated = zip(*weights)
-
-                # We can now get the indices from the first column
-                indices = list(rotated)[0]
-
-                # Create a vertex group and add all vertices to it, with a weight of 1.0.
-                # It is much faster to to it like this and then update the weights than
-                # adding the vertices one by one with its weight
-                new_vert_group = clothes.vertex_groups.new(name=str(group_name))
-                new_vert_group.add(indices, 1.0, 'ADD')
-                group_index = new_vert_group.index
-
-                # Iterate over the weights and update the vertex weights in the group
-                for weight_info in weights:
-                    vertex_index = weight_info[0]
-                    weight = weight_info[1]
-                    for group in clothes.data.vertices[vertex_index].groups:
-                        if int(group.group) == group_index:
-                            group.weight = weight
-
+        # The weights of the base mesh as a sparse vertex x group matrix in CSR form, ie the
+        # groups and weights of vertex i are found at indptr[i]:indptr[i+1]
+        (indptr, group_indices, group_weights) = MeshService.get_vertex_group_weight_table(basemesh)
+        relevant_groups = numpy.zeros(len(basemesh.vertex_groups) + 1, dtype=bool)
+        relevant_groups[list(group_index_to_name.keys())] = True
+
+        # Each clothes vertex is tied to three human vertices, with a weight for each. This
+        # is a sparse clothes vertex x human vertex matrix with three entries per row, here
+        # as a flat list of (clothes vertex, human vertex, weight) entries.
+        clothes_vertex_count = len(mhclo.ref_verts)
+        human_vertices = mhclo.ref_verts.reshape(-1)
+        clothes_vertices = numpy.repeat(numpy.arange(clothes_vertex_count), 3)
+        assigned_weights = mhclo.weights.reshape(-1)
+        inside = human_vertices < len(indptr) - 1
+        human_vertices = human_vertices[inside]
+        clothes_vertices = clothes_vertices[inside]
+        assigned_weights = assigned_weights[inside]
+
+        # Multiplying the two matrices, expand each entry to the groups the human vertex belongs to.
+        # Human vertex group weight * Human vertex weight
+        counts = indptr[human_vertices + 1] - indptr[human_vertices]
+        entry_starts = numpy.repeat(indptr[human_vertices] - numpy.cumsum(counts) + counts, counts)
+        entries = entry_starts + numpy.arange(int(counts.sum()))
+        clothes_vertices = numpy.repeat(clothes_vertices, counts)
+        products = group_weights[entries] * numpy.repeat(assigned_weights, counts)
+        groups = group_indices[entries]
+
+        relevant = relevant_groups[groups]
+        clothes_vertices = clothes_vertices[relevant]
+        products = products[relevant]
+        groups = groups[relevant]
+
+        # The clothes weight for a group is the average of the products found for it, ie the sum
+        # divided by how many of the tied human vertices were in the group
+        cells, cell_index = numpy.unique(groups.astype(numpy.int64) * clothes_vertex_count + clothes_vertices, return_inverse=True)
+        sums = numpy.bincount(cell_index, weights=products)
+        numbers = numpy.bincount(cell_index)
+        averages = (sums / numbers).astype(numpy.float32)
+
+        # If the caculated average weight is below 0.001 we will ignore it. This
+        # makes the interpolation much faster later on
+        keep = averages > 0.001
+        cells = cells[keep]
+        averages = averages[keep]
+        cell_groups = cells // clothes_vertex_count
+        cell_vertices = (cells % clothes_vertex_count).astype(numpy.int32)
+
+        # Cells are sorted by group, so each group is a contiguous range. No vertex group is
+        # created for bones without weights. For example, it is unnecessary to have an
+        # "upperarm02" group for shoes.
+        group_name_to_index = dict([(name, index) for index, name in group_index_to_name.items()])
+        for bone_name in bone_names:
+            if not bone_name in group_name_to_index:
+                continue
+            group_index = group_name_to_index[bone_name]
+            start = numpy.searchsorted(cell_groups, group_index, side="left")
+            end = numpy.searchsorted(cell_groups, group_index, side="right")
+            if end > start:
+                new_vert_group = clothes.vertex_groups.new(name=bone_name)
+                MeshService.set_vertex_group_weights(new_vert_group, cell_vertices[start:end], averages[start:end], decimals=_INTERPOLATED_WEIGHT_DECIMALS)
 
     @staticmethod
     def set_makeclothes_object_properties_from_mhclo(clothes_object, mhclo, delete_group_name=None):
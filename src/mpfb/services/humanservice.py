@@ -1,9 +1,10 @@
 """High-level functionality for human objects"""
 
-import os, json, fnmatch, re, bpy, shutil
+import os, json, fnmatch, re, bpy, shutil, time
 from pathlib import Path
 from mpfb.entities.objectproperties import HumanObjectProperties
 from mpfb.services.objectservice import ObjectService
+from mpfb.services.meshservice import MeshService
 from mpfb.services.targetservice import TargetService
 from mpfb.services.assetservice import AssetService
 from mpfb.services.clothesservice import ClothesService
@@ -642,34 +643,40 @@ class HumanService:
 
         _LOG.dump("human_info", human_info)
 
-        macro_detail_dict = human_info["phenotype"]
-        basemesh = HumanService.create_human(mask_helpers, detailed_helpers, extra_vertex_groups, feet_on_ground, scale, macro_detail_dict)
-        if "name" in human_info and human_info["name"]:
-            basemesh.name = human_info["name"] + ".body"
-
-        if subdiv_levels > 0:
-            modifier = basemesh.modifiers.new("Subdivision", 'SUBSURF')
-            modifier.levels = 0
-            modifier.render_levels = subdiv_levels
-
-        HumanService._load_targets(human_info, basemesh)
-        # Do an extra feet_on_ground here, since the one in create_human only
-        # takes macro details into account
-        if feet_on_ground:
-            lowest_point = ObjectService.get_lowest_point(basemesh)
-            basemesh.location = (0.0, 0.0, abs(lowest_point))
-            bpy.ops.object.transform_apply(location=True, rotation=True, scale=True)
-
-        HumanService._check_add_rig(human_info, basemesh)
-        HumanService._check_add_bodyparts(human_info, basemesh, subdiv_levels=subdiv_levels)
-        HumanService._check_add_proxy(human_info, basemesh, subdiv_levels=subdiv_levels)
-        if load_clothes:
-            HumanService._check_add_clothes(human_info, basemesh, subdiv_levels=subdiv_levels)
-        HumanService._set_skin(human_info, basemesh)
-        HumanService._set_eyes(human_info, basemesh)
-
-        # Otherwise all targets will be set to 100% when entering edit mode
-        basemesh.use_shape_key_edit_mode = True
+        # Targets, clothes and the rig all read the mixed shape key coordinates
+        MeshService.begin_shaped_coordinates_cache()
+        try:
+            macro_detail_dict = human_info["phenotype"]
+            basemesh = HumanService.create_human(mask_helpers, detailed_helpers, extra_vertex_groups, feet_on_ground, scale, macro_detail_dict)
+            if "name" in human_info and human_info["name"]:
+                basemesh.name = human_info["name"] + ".body"
+
+            if subdiv_levels > 0:
+                modifier = basemesh.modifiers.new("Subdivision", 'SUBSURF')
+                modifier.levels = 0
+                modifier.render_levels = subdiv_levels
+
+            HumanService._load_targets(human_info, basemesh)
+            # Do an extra feet_on_ground here, since the one in create_human only
+            # takes macro details into account
+            if feet_on_ground:
+                lowest_point = ObjectService.get_lowest_point(basemesh)
+                basemesh.location = (0.0, 0.0, abs(lowest_point))
+                bpy.ops.object.transform_apply(location=True, rotation=True, scale=True)
+                MeshService.invalidate_shaped_coordinates(basemesh)
+
+            HumanService._check_add_rig(human_info, basemesh)
+            HumanService._check_add_bodyparts(human_info, basemesh, subdiv_levels=subdiv_levels)
+            HumanService._check_add_proxy(human_info, basemesh, subdiv_levels=subdiv_levels)
+            if load_clothes:
+                HumanService._check_add_clothes(human_info, basemesh, subdiv_levels=subdiv_levels)
+            HumanService._set_skin(human_info, basemesh)
+            HumanService._set_eyes(human_info, basemesh)
+
+            # Otherwise all targets will be set to 100% when entering edit mode
+            basemesh.use_shape_key_edit_mode = True
+        finally:
+            MeshService.end_shaped_coordinates_cache()
 
         profiler.leave("deserialize_from_dict")
 
@@ -735,6 +742,43 @@ class HumanService:
         profiler.leave("_parse_mhm_modifier_line")
 
 
+    @staticmethod
+    def _find_mhm_asset(asset_subdir, asset_type, name, uuid, perform_deep_search):
+        """Find the fragment of an asset referenced in a MHM file, using the asset catalog rather than parsing
+        the candidate files. Assets are primarily identified by uuid. If several assets share the uuid, the one
+        whose file name best matches the given name is preferred. Only if no asset has the uuid, and a deep
+        search is requested, is the name alone used."""
+        mhclo_name = str(name).lower()
+        mhclo_name_compact = mhclo_name.replace("_", "").replace(" ", "")
+
+        def _name_matches(asset):
+            given_name = str(asset["name_without_ext"]).lower().replace("_", " ")
+            given_name_compact = given_name.replace(" ", "")
+            return mhclo_name in given_name or mhclo_name_compact in given_name_compact
+
+        if uuid:
+            matches = AssetService.find_asset_by_uuid(uuid, asset_subdir, asset_type)
+            for asset in matches:
+                if _name_matches(asset):
+                    _LOG.debug("Matching asset", (asset["full_path"], asset["fragment"]))
+                    return asset["fragment"]
+            if matches:
+                _LOG.debug("Matching asset on uuid only", (matches[0]["full_path"], matches[0]["fragment"]))
+                return matches[0]["fragment"]
+
+        if not perform_deep_search:
+            _LOG.warn("Giving up because asset could not be found", (asset_subdir, name))
+            return None
+
+        _LOG.debug("Searching for asset by name only", (asset_subdir, name))
+        for asset in AssetService.query_catalog(asset_subdir, asset_type=asset_type):
+            label = str(asset["name_without_ext"]).lower().replace("_", " ")
+            if mhclo_name == str(asset["name"]).lower() or mhclo_name == label or mhclo_name == str(asset["name_without_ext"]).lower():
+                _LOG.debug("Matching asset", (asset["full_path"], asset["fragment"]))
+                return asset["fragment"]
+
+        return None
+
     @staticmethod
     def _check_parse_mhm_bodypart_line(human_info, line, perform_deep_search=True):
         profiler = PrimitiveProfiler("HumanService")
@@ -757,53 +801,11 @@ class HumanService:
                     asset_type = "proxy"
                     root_name = "proxymeshes"
 
-                assets = AssetService.get_asset_list(root_name, asset_type)
-                _LOG.dump("Potential assets", assets)
-                # Find asset which match both filename and UUID
-                for asset_name in assets:
-                    asset = assets[asset_name]
-                    given_name = str(asset_name).lower()
-                    mhclo_name = str(name).lower()
-                    _LOG.debug("Checking ", (mhclo_name, given_name))
-                    if mhclo_name in given_name and uuid:
-                        mhclo = Mhclo()
-                        mhclo.load(asset["full_path"])
-                        if mhclo.uuid == uuid:
-                            _LOG.debug("Matching asset", (asset["full_path"], asset["fragment"]))
-                            human_info[bodypart] = asset["fragment"]
-                            profiler.leave("_check_parse_mhm_bodypart_line")
-                            return True
-
-                if not perform_deep_search:
-                    _LOG.warn("Giving up because bodypart could not be found", (bodypart, name))
-                    return False
-
-                _LOG.warn("About to perform deep search for bodypart, which will take a long time", (bodypart, name))
-
-                # Find asset which match only uuid
-                for asset_name in assets:
-                    asset = assets[asset_name]
-                    mhclo = Mhclo()
-                    mhclo.load(asset["full_path"])
-                    if uuid and mhclo.uuid == uuid:
-                        _LOG.debug("Matching asset", (asset["full_path"], asset["fragment"]))
-                        human_info[bodypart] = asset["fragment"]
-                        profiler.leave("_check_parse_mhm_bodypart_line")
-                        return True
-                # Find asset which match only filename
-                for asset_name in assets:
-                    asset = assets[asset_name]
-                    mhclo = Mhclo()
-                    mhclo.load(asset["full_path"])
-                    given_name = str(asset_name).lower()
-                    mhclo_name = str(mhclo.name).lower()
-                    label = asset["label"].lower()
-
-                    if given_name == mhclo_name or given_name == label:
-                        _LOG.debug("Matching asset", (asset["full_path"], asset["fragment"]))
-                        human_info[bodypart] = asset["fragment"]
-                        profiler.leave("_check_parse_mhm_bodypart_line")
-                        return True
+                fragment = HumanService._find_mhm_asset(root_name, asset_type, name, uuid, perform_deep_search)
+                if fragment:
+                    human_info[bodypart] = fragment
+                    profiler.leave("_check_parse_mhm_bodypart_line")
+                    return True
         profiler.leave("_check_parse_mhm_bodypart_line")
         # Give up
         return False
@@ -827,70 +829,11 @@ class HumanService:
         if not "clothes" in human_info:
             human_info["clothes"] = []
 
-        assets = AssetService.get_asset_list(root_name, asset_type)
-
-        _LOG.dump("Potential assets", assets)
-        # Find asset which match both filename and UUID
-        for asset_name in assets:
-            asset = assets[asset_name]
-            given_name = str(asset_name).lower()
-            given_name_compact = str(asset_name).lower().replace(" ", "")
-            given_name_compact = str(given_name_compact).lower().replace("_", "")
-
-            mhclo_name = str(name).lower()
-            mhclo_name_compact = mhclo_name.replace("_", "")
-            mhclo_name_compact = mhclo_name_compact.replace(" ", "")
-
-            _LOG.debug("Checking ", (mhclo_name, given_name, given_name_compact))
-            if (mhclo_name in given_name or mhclo_name_compact in given_name_compact) and uuid:
-                mhclo = Mhclo()
-                mhclo.load(asset["full_path"])
-                if mhclo.uuid == uuid:
-                    _LOG.debug("Matching asset", (asset["full_path"], asset["fragment"]))
-                    human_info["clothes"].append(asset["fragment"])
-                    profiler.leave("_check_parse_mhm_clothes_line")
-                    return True
-
-        if not perform_deep_search:
-            _LOG.warn("Giving up since asset could not be found: ", name)
-            return False
-
-        _LOG.warn("Asset was not found in assets list, it will take time to find it", name)
-
-
-        # Find assets that only match UUID
-        for asset_name in assets:
-            asset = assets[asset_name]
-            mhclo = Mhclo()
-            try:
-                mhclo.load(asset["full_path"])
-                if uuid and mhclo.uuid == uuid:
-                    _LOG.debug("Matching asset", (asset["full_path"], asset["fragment"]))
-                    human_info["clothes"].append(asset["fragment"])
-                    profiler.leave("_check_parse_mhm_clothes_line")
-                    return True
-            except:
-                _LOG.error("Failed to load asset ", asset["full_path"])
-
-        # Find assets that only match filename
-        for asset_name in assets:
-            asset = assets[asset_name]
-            mhclo = Mhclo()
-            try:
-                mhclo.load(asset["full_path"])
-                given_name = str(asset_name).lower()
-                mhclo_name = str(mhclo.name).lower()
-                label = asset["label"].lower()
-
-                if given_name == mhclo_name or given_name == label:
-                    _LOG.debug("Matching asset", (asset["full_path"], asset["fragment"]))
-                    human_info["clothes"].append(asset["fragment"])
-                    profiler.leave("_check_parse_mhm_clothes_line")
-                    return True
-            except:
-                _LOG.error("Failed to load asset ", asset["full_path"])
-
+        fragment = HumanService._find_mhm_asset(root_name, asset_type, name, uuid, perform_deep_search)
         profiler.leave("_check_parse_mhm_clothes_line")
+        if fragment:
+            human_info["clothes"].append(fragment)
+            return True
 
         # Give up
         return False
@@ -957,7 +900,7 @@ class HumanService:
         return basemesh
 
     @staticmethod
-    def create_human(mask_helpers=True, detailed_helpers=True, extra_vertex_groups=True, feet_on_ground=True, scale=0.1, macro_detail_dict=None):
+    def create_human(mask_helpers=True, detailed_helpers=True, extra_vertex_groups=True, feet_on_ground=True, scale=0.1, macro_detail_dict=None, bake_macro_targets=False):
 
         profiler = PrimitiveProfiler("HumanService")
         profiler.enter("create_human")
@@ -992,6 +935,8 @@ class HumanService:
             name = str(key)
             HumanObjectProperties.set_value(name, macro_detail_dict["race"][key], entity_reference=basemesh)
 
+        HumanObjectProperties.set_value("bake_macro_targets", bake_macro_targets, entity_reference=basemesh)
+
         TargetService.reapply_macro_details(basemesh)
 
         if mask_helpers:
@@ -1006,6 +951,7 @@ class HumanService:
             lowest_point = ObjectService.get_lowest_point(basemesh)
             basemesh.location = (0.0, 0.0, abs(lowest_point))
             bpy.ops.object.transform_apply(location=True, rotation=True, scale=True)
+            MeshService.invalidate_shaped_coordinates(basemesh)
 
         profiler.leave("create_human")
         return basemesh
@@ -1015,7 +961,7 @@ class HumanService:
         rigs_dir = LocationService.get_mpfb_data("rigs")
         standard_dir = os.path.join(rigs_dir, "standard")
         rig_file = os.path.join(standard_dir, "rig." + rig_name + ".json")
-        rig = Rig.from_json_file_and_basemesh(rig_file, basemesh)
+        rig = Rig.from_fitting_plan_and_basemesh(rig_file, basemesh)
         armature_object = rig.create_armature_and_fit_to_basemesh()
         basemesh.parent = armature_object
 
@@ -1024,9 +970,7 @@ class HumanService:
 
         if import_weights:
             weights_file = os.path.join(standard_dir, "weights." + rig_name + ".json")
-            weights = dict()
-            with open(weights_file, 'r') as json_file:
-                weights = json.load(json_file)
+            weights = RigService.load_weights(weights_file)
             RigService.apply_weights(armature_object, basemesh, weights)
 
         RigService.normalize_rotation_mode(armature_object)
@@ -1035,27 +979,91 @@ class HumanService:
 
     @staticmethod
     def refit(blender_object):
+        """Refit clothes, bodyparts, proxy and rig to the current shape of the human the object belongs to."""
         _LOG.enter()
-        basemesh = ObjectService.find_object_of_type_amongst_nearest_relatives(blender_object, "Basemesh")
-        rig = ObjectService.find_object_of_type_amongst_nearest_relatives(blender_object, "Skeleton")
+        HumanService.refit_many([blender_object])
 
-        if basemesh is None:
-            raise ValueError('Could not find basemesh as relative of given object')
-
-        parent_object = basemesh
-        if rig:
-            parent_object = rig
-
-        _LOG.dump("basemesh, rig, parent_object", (basemesh, rig, parent_object))
-
-        children = ObjectService.get_list_of_children(parent_object)
-        _LOG.dump("children", children)
+    @staticmethod
+    def _add_timing(timings, stage, before):
+        timings[stage] = timings.get(stage, 0.0) + time.time() - before
 
-        for child in children:
-            object_type = GeneralObjectProperties.get_value("object_type", entity_reference=child)
-            if object_type and not object_type in ["Basemesh", "Skeleton"]:
-                _LOG.debug("Will try to refit child proxy", (object_type, child))
-                ClothesService.fit_clothes_to_human(child, basemesh)
+    @staticmethod
+    def _get_shared_mhclo(child, shared):
+        mhclo_fragment = GeneralObjectProperties.get_value("asset_source", entity_reference=child)
+        object_type = GeneralObjectProperties.get_value("object_type", entity_reference=child)
+        if not mhclo_fragment or not object_type:
+            # Let fit_clothes_to_human complain about the missing info
+            return None
+        key = (mhclo_fragment, str(object_type).lower())
+        if not key in shared:
+            mhclo_path = AssetService.find_asset_absolute_path(mhclo_fragment, str(object_type).lower())
+            if not mhclo_path or not os.path.exists(mhclo_path):
+                return None
+            mhclo = Mhclo()
+            mhclo.load(mhclo_path)
+            shared[key] = mhclo
+        return shared[key]
 
-        if rig:
-            RigService.refit_existing_armature(rig)
+    @staticmethod
+    def refit_many(blender_objects):
+        """Refit clothes, bodyparts, proxies and rigs for several humans. Each object can be any part of a human.
+        Parsed MHCLO files are shared between the humans, rigs are fitted via cached fitting plans, and the mixed shape key
+        coordinates are cached during the refit, so they are computed once per base mesh. Returns a dict with the total number of seconds
+        spent in each stage."""
+        _LOG.enter()
+        timings = {"resolve": 0.0, "load_mhclo": 0.0, "shape_keys": 0.0, "fit_clothes": 0.0, "fit_rig": 0.0}
+        MeshService.begin_shaped_coordinates_cache()
+        try:
+            shared_mhclo = dict()
+            seen_basemeshes = set()
+
+            for blender_object in blender_objects:
+                before = time.time()
+                basemesh = ObjectService.find_object_of_type_amongst_nearest_relatives(blender_object, "Basemesh")
+                rig = ObjectService.find_object_of_type_amongst_nearest_relatives(blender_object, "Skeleton")
+
+                if basemesh is None:
+                    raise ValueError('Could not find basemesh as relative of given object')
+
+                if basemesh.name in seen_basemeshes:
+                    continue
+                seen_basemeshes.add(basemesh.name)
+
+                parent_object = basemesh
+                if rig:
+                    parent_object = rig
+
+                _LOG.dump("basemesh, rig, parent_object", (basemesh, rig, parent_object))
+
+                children = ObjectService.get_list_of_children(parent_object)
+                _LOG.dump("children", children)
+
+                proxies = []
+                for child in children:
+                    object_type = GeneralObjectProperties.get_value("object_type", entity_reference=child)
+                    if object_type and not object_type in ["Basemesh", "Skeleton"]:
+                        proxies.append(child)
+                HumanService._add_timing(timings, "resolve", before)
+
+                before = time.time()
+                MeshService.get_shaped_coordinates(basemesh)
+                HumanService._add_timing(timings, "shape_keys", before)
+
+                for child in proxies:
+                    _LOG.debug("Will try to refit child proxy", child)
+                    before = time.time()
+                    mhclo = HumanService._get_shared_mhclo(child, shared_mhclo)
+                    HumanService._add_timing(timings, "load_mhclo", before)
+                    before = time.time()
+                    ClothesService.fit_clothes_to_human(child, basemesh, mhclo)
+                    HumanService._add_timing(timings, "fit_clothes", before)
+
+                if rig:
+                    before = time.time()
+                    RigService.refit_existing_armature(rig)
+                    HumanService._add_timing(timings, "fit_rig", before)
+        finally:
+            MeshService.end_shaped_coordinates_cache()
+
+        _LOG.debug("Refit timings", timings)
+        return timings
@@ -1,15 +1,236 @@
-# create mesh
+"""Service for bulk access to mesh data as numpy arrays."""
+
+import bpy, random, numpy
+from mpfb.services.logservice import LogService
+
+_LOG = LogService.get_logger("services.meshservice")
+
+# Mixed shape key coordinates per shape key datablock, as {pointer: (signature, coordinates)}. This
+# is only kept while a caching scope is open, see begin_shaped_coordinates_cache()
+_SHAPED_COORDINATES = None
+_SHAPED_COORDINATES_DEPTH = 0
+_SHAPED_COORDINATES_MAX_ENTRIES = 8
 
 # add numpy array as verts to bmesh
 # add numpy array as faces to bmesh
 
-# get verts as numpy array
 # get vertex groups
 # create vertex group
-# add verts to vertex group
 # verts in vertex group
 # delete verts in vertex group
 # delete verts
 
 # recalculate_face_normals
 
+class MeshService:
+
+    def __init__(self):
+        raise RuntimeError("You should not instance MeshService. Use its static methods instead.")
+
+    @staticmethod
+    def get_vertex_coordinates(blender_object):
+        """Return the coordinates of the mesh vertices as a float32 numpy array with shape (N, 3)."""
+        vertices = blender_object.data.vertices
+        coordinates = numpy.empty(len(vertices) * 3, dtype=numpy.float32)
+        vertices.foreach_get("co", coordinates)
+        return coordinates.reshape(-1, 3)
+
+    @staticmethod
+    def set_vertex_coordinates(blender_object, coordinates):
+        """Write all vertex coordinates of a mesh from an array with shape (N, 3)."""
+        vertices = blender_object.data.vertices
+        coordinates = numpy.ascontiguousarray(coordinates, dtype=numpy.float32).reshape(-1)
+        if len(coordinates) != len(vertices) * 3:
+            raise ValueError("Coordinate array does not match the number of vertices in the mesh")
+        vertices.foreach_set("co", coordinates)
+        blender_object.data.update()
+        MeshService.invalidate_shaped_coordinates(blender_object)
+
+    @staticmethod
+    def get_shape_key_coordinates(shape_key):
+        """Return the coordinates of a shape key block as a float32 numpy array with shape (N, 3)."""
+        coordinates = numpy.empty(len(shape_key.data) * 3, dtype=numpy.float32)
+        shape_key.data.foreach_get("co", coordinates)
+        return coordinates.reshape(-1, 3)
+
+    @staticmethod
+    def set_shape_key_coordinates(shape_key, coordinates):
+        """Write all coordinates of a shape key block from an array with shape (N, 3)."""
+        coordinates = numpy.ascontiguousarray(coordinates, dtype=numpy.float32).reshape(-1)
+        if len(coordinates) != len(shape_key.data) * 3:
+            raise ValueError("Coordinate array does not match the number of vertices in the shape key")
+        shape_key.data.foreach_set("co", coordinates)
+        if _SHAPED_COORDINATES is not None:
+            _SHAPED_COORDINATES.pop(shape_key.id_data.as_pointer(), None)
+
+    @staticmethod
+    def _shape_keys_signature(shape_keys):
+        key_blocks = shape_keys.key_blocks
+        # Operations such as transform_apply move all shape keys without touching their settings, so
+        # also include the content of the reference key
+        reference_coordinates = MeshService.get_shape_key_coordinates(shape_keys.reference_key)
+        signature = [shape_keys.use_relative, len(shape_keys.user.vertices), hash(reference_coordinates.tobytes())]
+        for key_block in key_blocks:
+            signature.append((key_block.name, key_block.value, key_block.mute, key_block.relative_key.name, key_block.vertex_group))
+        return tuple(signature)
+
+    @staticmethod
+    def _mix_shape_keys(blender_object):
+        shape_keys = blender_object.data.shape_keys
+        reference_key = shape_keys.reference_key
+        coordinates = dict()
+
+        def _coordinates(key_block):
+            if not key_block.name in coordinates:
+                coordinates[key_block.name] = MeshService.get_shape_key_coordinates(key_block)
+            return coordinates[key_block.name]
+
+        mixed = _coordinates(reference_key).astype(numpy.float64)
+        for key_block in shape_keys.key_blocks:
+            if key_block == reference_key or key_block.mute or key_block.value == 0.0:
+                continue
+            delta = _coordinates(key_block) - _coordinates(key_block.relative_key)
+            if key_block.vertex_group:
+                group_weights = MeshService.get_vertex_group_weights(blender_object, key_block.vertex_group)
+                delta = delta * group_weights[:, None]
+            mixed += key_block.value * delta
+        return mixed.astype(numpy.float32)
+
+    @staticmethod
+    def get_vertex_group_weights(blender_object, vertex_group_name):
+        """Return the weight of every vertex in the named vertex group as a float32 numpy array with
+        one value per vertex, zero for vertices outside the group."""
+        weights = numpy.zeros(len(blender_object.data.vertices), dtype=numpy.float32)
+        vertex_group = blender_object.vertex_groups.get(vertex_group_name)
+        if vertex_group is None:
+            return weights
+        group_index = vertex_group.index
+        for vertex in blender_object.data.vertices:
+            for group in vertex.groups:
+                if group.group == group_index:
+                    weights[vertex.index] = group.weight
+        return weights
+
+    @staticmethod
+    def get_vertex_group_weight_table(blender_object):
+        """Return all vertex group weights of the mesh as a sparse vertex x group matrix in CSR form:
+        a tuple (indptr, group_indices, weights) where the groups and weights of vertex i are found
+        in the slice indptr[i]:indptr[i+1]."""
+        vertices = blender_object.data.vertices
+        counts = numpy.empty(len(vertices), dtype=numpy.int64)
+        group_indices = []
+        weights = []
+        for vertex in vertices:
+            groups = vertex.groups
+            counts[vertex.index] = len(groups)
+            for group in groups:
+                group_indices.append(group.group)
+                weights.append(group.weight)
+        indptr = numpy.zeros(len(vertices) + 1, dtype=numpy.int64)
+        numpy.cumsum(counts, out=indptr[1:])
+        return indptr, numpy.array(group_indices, dtype=numpy.int32), numpy.array(weights, dtype=numpy.float32)
+
+    @staticmethod
+    def set_vertex_group_weights(vertex_group, vertex_indices, weights, decimals=None):
+        """Set the weights of the given vertices in a vertex group, adding the vertices to the group if
+        needed. Vertices are grouped by their weight, so that there is one call to VertexGroup.add() per
+        distinct weight rather than one per vertex. By default weights are kept exactly as stored by blender
+        (float32). If decimals is given, weights are first rounded to that many decimals, which gives far
+        fewer distinct weights for continuous data. If a vertex is listed more than once, its last weight
+        is used."""
+        vertex_indices = numpy.asarray(vertex_indices, dtype=numpy.int64).reshape(-1)
+        weights = numpy.asarray(weights, dtype=numpy.float32).reshape(-1)
+        if decimals is not None:
+            weights = numpy.round(weights, decimals)
+        if len(vertex_indices) != len(weights):
+            raise ValueError("There must be exactly one weight per vertex index")
+        if len(vertex_indices) == 0:
+            return
+
+        # numpy.unique returns the first occurrence, so look at the reversed arrays to keep the last one
+        (vertex_indices, last) = numpy.unique(vertex_indices[::-1], return_index=True)
+        weights = weights[::-1][last]
+
+        (distinct_weights, weight_index) = numpy.unique(weights, return_inverse=True)
+        order = numpy.argsort(weight_index, kind="stable")
+        boundaries = numpy.cumsum(numpy.bincount(weight_index, minlength=len(distinct_weights)))[:-1]
+        for weight, indices in zip(distinct_weights.tolist(), numpy.split(vertex_indices[order], boundaries)):
+            vertex_group.add(indices.tolist(), weight, 'REPLACE')
+
+    @staticmethod
+    def get_shaped_coordinates(blender_object):
+        """Return the vertex coordinates of the mesh with all shape keys mixed in, as a read-only float32
+        numpy array with shape (N, 3). This is the same as what a shape key created "from mix" would contain,
+        but for relative shape keys it is computed without modifying the mesh. Inside a caching scope, see
+        begin_shaped_coordinates_cache(), the result is reused until shape key values change."""
+        shape_keys = blender_object.data.shape_keys
+        if not shape_keys or not shape_keys.key_blocks or len(shape_keys.key_blocks) < 1:
+            coordinates = MeshService.get_vertex_coordinates(blender_object)
+            coordinates.setflags(write=False)
+            return coordinates
+
+        if not shape_keys.use_relative:
+            # Absolute shape keys are interpolated by blender, so let it do the mixing
+            coordinates = MeshService._get_coordinates_from_mix(blender_object)
+            coordinates.setflags(write=False)
+            return coordinates
+
+        if _SHAPED_COORDINATES is None:
+            coordinates = MeshService._mix_shape_keys(blender_object)
+            coordinates.setflags(write=False)
+            return coordinates
+
+        pointer = shape_keys.as_pointer()
+        signature = MeshService._shape_keys_signature(shape_keys)
+        cached = _SHAPED_COORDINATES.get(pointer)
+        if cached and cached[0] == signature:
+            return cached[1]
+
+        _LOG.debug("Computing shaped coordinates for", blender_object.name)
+        coordinates = MeshService._mix_shape_keys(blender_object)
+        coordinates.setflags(write=False)
+        _SHAPED_COORDINATES.pop(pointer, None)
+        while len(_SHAPED_COORDINATES) >= _SHAPED_COORDINATES_MAX_ENTRIES:
+            del _SHAPED_COORDINATES[next(iter(_SHAPED_COORDINATES))]
+        _SHAPED_COORDINATES[pointer] = (signature, coordinates)
+        return coordinates
+
+    @staticmethod
+    def _get_coordinates_from_mix(blender_object):
+        key_name = "temporary_mix_key." + str(random.randrange(1000, 9999))
+        active_index = blender_object.active_shape_key_index
+        shape_key = blender_object.shape_key_add(name=key_name, from_mix=True)
+        coordinates = MeshService.get_shape_key_coordinates(shape_key)
+        blender_object.shape_key_remove(shape_key)
+        blender_object.active_shape_key_index = active_index
+        return coordinates
+
+    @staticmethod
+    def begin_shaped_coordinates_cache():
+        """Start caching mixed shape key coordinates, for an operation which reads them several times, such as
+        loading or refitting a human. Shape key data edited outside of MeshService and TargetService is not
+        detected, so the scope should not outlive the operation. Must be paired with end_shaped_coordinates_cache()
+        in a finally clause. Scopes can be nested."""
+        global _SHAPED_COORDINATES, _SHAPED_COORDINATES_DEPTH # pylint: disable=W0603
+        if _SHAPED_COORDINATES is None:
+            _SHAPED_COORDINATES = dict()
+        _SHAPED_COORDINATES_DEPTH = _SHAPED_COORDINATES_DEPTH + 1
+
+    @staticmethod
+    def end_shaped_coordinates_cache():
+        """End a caching scope started with begin_shaped_coordinates_cache(). The cache is dropped when the
+        outermost scope ends."""
+        global _SHAPED_COORDINATES, _SHAPED_COORDINATES_DEPTH # pylint: disable=W0603
+        _SHAPED_COORDINATES_DEPTH = max(0, _SHAPED_COORDINATES_DEPTH - 1)
+        if _SHAPED_COORDINATES_DEPTH == 0:
+            _SHAPED_COORDINATES = None
+
+    @staticmethod
+    def invalidate_shaped_coordinates(blender_object=None):
+        """Drop the cached mixed shape key coordinates for an object, or for all objects if none is given."""
+        if _SHAPED_COORDINATES is None:
+            return
+        if blender_object is None:
+            _SHAPED_COORDINATES.clear()
+        elif blender_object.data and blender_object.data.shape_keys:
+            _SHAPED_COORDINATES.pop(blender_object.data.shape_keys.as_pointer(), None)
@@ -1,16 +1,17 @@
-import bpy, os, json, random, gzip
+import bpy, os, random, numpy
 from mpfb.services.logservice import LogService
 from mpfb.services.locationservice import LocationService
 from mpfb.entities.objectproperties import GeneralObjectProperties
 from mpfb.entities.socketobject import BASEMESH_EXTRA_GROUPS
+from mpfb.entities.meshmetadata import MeshMetadata, MESH_METADATA_FILE_NAME, compile_mesh_metadata, mesh_metadata_is_stale
 
 _LOG = LogService.get_logger("services.objectservice")
 
-_BASEMESH_VERTEX_GROUPS_UNEXPANDED = None
 _BASEMESH_VERTEX_GROUPS_EXPANDED = None
 
 _BASEMESH_FACE_TO_VERTEX_TABLE = None
 _BASEMESH_VERTEX_TO_FACE_TABLE = None
+_MESH_METADATA = None
 
 class ObjectService:
 
@@ -207,45 +208,61 @@ class ObjectService:
                 vertex_group = blender_object.vertex_groups.new(name=group_name)
                 vertex_group.add(vertex_group_definition[group_name], 1.0, 'ADD')
 
+    @staticmethod
+    def get_mesh_metadata():
+        """Return the compiled hm08 metadata bundle, with face/vertex adjacency, vertex group ranges and
+        mirror pairs as lazily memory mapped numpy arrays. A bundle shipped in the mesh_metadata directory
+        is used if it is up to date, otherwise one is compiled into the user cache."""
+        global _MESH_METADATA # pylint: disable=W0603
+        if _MESH_METADATA is None:
+            meta_data_dir = LocationService.get_mpfb_data("mesh_metadata")
+            bundle_file = os.path.join(meta_data_dir, MESH_METADATA_FILE_NAME)
+            if mesh_metadata_is_stale(meta_data_dir, bundle_file):
+                bundle_file = LocationService.get_user_cache(MESH_METADATA_FILE_NAME)
+                if mesh_metadata_is_stale(meta_data_dir, bundle_file):
+                    _LOG.debug("Compiling mesh metadata bundle", bundle_file)
+                    compile_mesh_metadata(meta_data_dir, bundle_file)
+            _MESH_METADATA = MeshMetadata(bundle_file)
+        return _MESH_METADATA
+
     @staticmethod
     def get_base_mesh_vertex_group_definition():
         global _BASEMESH_VERTEX_GROUPS_EXPANDED # pylint: disable=W0603
-        global _BASEMESH_VERTEX_GROUPS_UNEXPANDED # pylint: disable=W0603
         if _BASEMESH_VERTEX_GROUPS_EXPANDED is None:
-            meta_data_dir = LocationService.get_mpfb_data("mesh_metadata")
-            definition_file = os.path.join(meta_data_dir, "basemesh_vertex_groups.json")
-            with open(definition_file, "r") as json_file:
-                _BASEMESH_VERTEX_GROUPS_UNEXPANDED = json.load(json_file)
+            (group_names, indptr, indices) = ObjectService.get_base_mesh_vertex_group_csr()
             _BASEMESH_VERTEX_GROUPS_EXPANDED = dict()
-            for group in _BASEMESH_VERTEX_GROUPS_UNEXPANDED.keys():
-                group_name = str(group)
-                _BASEMESH_VERTEX_GROUPS_EXPANDED[group_name] = []
-                for start_stop in _BASEMESH_VERTEX_GROUPS_UNEXPANDED[group]:
-                    _BASEMESH_VERTEX_GROUPS_EXPANDED[group_name].extend(range(start_stop[0], start_stop[1]+1))
+            for i, group_name in enumerate(group_names):
+                _BASEMESH_VERTEX_GROUPS_EXPANDED[str(group_name)] = indices[indptr[i]:indptr[i+1]].tolist()
             _BASEMESH_VERTEX_GROUPS_EXPANDED.update(BASEMESH_EXTRA_GROUPS)
         # Return a copy so it doesn't get accidentally modified
         return dict(_BASEMESH_VERTEX_GROUPS_EXPANDED)
 
+    @staticmethod
+    def get_base_mesh_vertex_group_csr():
+        """Return the vertex groups of the unmodified base mesh as a tuple (group_names, indptr, indices), where
+        the vertices of group i are indices[indptr[i]:indptr[i+1]]. The extra vertex groups are not included."""
+        metadata = ObjectService.get_mesh_metadata()
+        return (metadata.get_group_names(), metadata["group_vertex_indptr"], metadata["group_vertex_indices"])
+
+    @staticmethod
+    def get_base_mesh_vertex_count():
+        """Return the number of vertices in the unmodified base mesh, including helpers."""
+        return len(ObjectService.get_mesh_metadata()["vertex_face_indptr"]) - 1
+
     @staticmethod
     def get_lowest_point(basemesh, take_shape_keys_into_account=True):
+        from .meshservice import MeshService
+        if take_shape_keys_into_account:
+            coordinates = MeshService.get_shaped_coordinates(basemesh)
+        else:
+            coordinates = MeshService.get_vertex_coordinates(basemesh)
+
+        # Only consider the body, not the helpers
+        body_coordinates = coordinates[0:13380]
+
         lowest_point = 1000.0
-        vertex_data = basemesh.data.vertices
-        shape_key = None
-        key_name = None
-        if take_shape_keys_into_account and basemesh.data.shape_keys and basemesh.data.shape_keys.key_blocks and len(basemesh.data.shape_keys.key_blocks) > 0:
-            from .targetservice import TargetService
-            key_name = "temporary_lowest_point_key." + str(random.randrange(1000, 9999))
-            shape_key = TargetService.create_shape_key(basemesh, key_name, also_create_basis=True, create_from_mix=True)
-            vertex_data = shape_key.data
-
-        index = 0
-        for vertex in vertex_data:
-            if vertex.co[2] < lowest_point and index < 13380:
-                lowest_point = vertex.co[2]
-            index = index + 1
-
-        if shape_key:
-            basemesh.shape_key_remove(shape_key)
+        if len(body_coordinates) > 0:
+            lowest_point = min(lowest_point, float(body_coordinates[:, 2].min()))
 
         return lowest_point
 
@@ -253,28 +270,36 @@ class ObjectService:
     def get_face_to_vertex_table():
         global _BASEMESH_FACE_TO_VERTEX_TABLE # pylint: disable=W0603
 
-        meta_data_dir = LocationService.get_mpfb_data("mesh_metadata")
-        definition_file = os.path.join(meta_data_dir, "basemesh_face_to_vertex_table.json.gz")
-
         if _BASEMESH_FACE_TO_VERTEX_TABLE is None:
-            with gzip.open(definition_file, "rb") as json_file:
-                _BASEMESH_FACE_TO_VERTEX_TABLE = json.load(json_file)
+            (indptr, indices) = ObjectService.get_face_to_vertex_csr()
+            _BASEMESH_FACE_TO_VERTEX_TABLE = [row.tolist() for row in numpy.split(indices, indptr[1:-1])]
 
         return _BASEMESH_FACE_TO_VERTEX_TABLE
 
+    @staticmethod
+    def get_face_to_vertex_csr():
+        """Return the face to vertex table of the base mesh as CSR arrays (indptr, indices), where the
+        vertices of face i are indices[indptr[i]:indptr[i+1]]."""
+        metadata = ObjectService.get_mesh_metadata()
+        return (metadata["face_vertex_indptr"], metadata["face_vertex_indices"])
+
     @staticmethod
     def get_vertex_to_face_table():
         global _BASEMESH_VERTEX_TO_FACE_TABLE # pylint: disable=W0603
 
-        meta_data_dir = LocationService.get_mpfb_data("mesh_metadata")
-        definition_file = os.path.join(meta_data_dir, "basemesh_vertex_to_face_table.json.gz")
-
         if _BASEMESH_VERTEX_TO_FACE_TABLE is None:
-            with gzip.open(definition_file, "rb") as json_file:
-                _BASEMESH_VERTEX_TO_FACE_TABLE = json.load(json_file)
+            (indptr, indices) = ObjectService.get_vertex_to_face_csr()
+            _BASEMESH_VERTEX_TO_FACE_TABLE = [row.tolist() for row in numpy.split(indices, indptr[1:-1])]
 
         return _BASEMESH_VERTEX_TO_FACE_TABLE
 
+    @staticmethod
+    def get_vertex_to_face_csr():
+        """Return the vertex to face table of the base mesh as CSR arrays (indptr, indices), where the
+        faces of vertex i are indices[indptr[i]:indptr[i+1]]."""
+        metadata = ObjectService.get_mesh_metadata()
+        return (metadata["vertex_face_indptr"], metadata["vertex_face_indices"])
+
     @staticmethod
     def extract_vertex_group_to_new_object(existing_object, vertex_group_name):
 
@@ -1,17 +1,21 @@
 """Service for working with rigs, bones and weights."""
 
-import bpy, os, fnmatch, shutil
+import bpy, os, json, fnmatch, shutil, hashlib, numpy
 from bpy.types import PoseBone
 from mathutils import Matrix, Vector
 from mathutils import Vector
 from mpfb.services.locationservice import LocationService
 from mpfb.services.logservice import LogService
 from mpfb.services.targetservice import TargetService
+from mpfb.services.meshservice import MeshService
 from .objectservice import ObjectService
 from mpfb.entities.objectproperties import GeneralObjectProperties
+from mpfb.entities.binaryweights import BinaryWeights, BINARY_WEIGHTS_SUFFIX, binary_weights_path, read_binary_weights, compile_weights_file, weights_file_sha1
 
 _LOG = LogService.get_logger("services.rigservice")
 
+_WEIGHTS_CACHE_DIR = LocationService.get_user_cache("weights")
+
 _RADIAN = 0.0174532925
 
 
@@ -429,44 +433,92 @@ class RigService:
 
         return weights
 
+    @staticmethod
+    def load_weights(weights_file):
+        """Load a weights file for use with apply_weights(). A binary (.mhw.bin) file is memory mapped. For a
+        json file, a compiled binary version next to it is used if it was compiled from the same content,
+        otherwise one is compiled into the user cache. If that is not possible, the json file is parsed
+        into a MHW dict."""
+        weights_file = str(weights_file)
+        if weights_file.endswith(BINARY_WEIGHTS_SUFFIX):
+            return read_binary_weights(weights_file)
+
+        digest = weights_file_sha1(weights_file)
+        binary_file = binary_weights_path(weights_file)
+        weights = RigService._read_compiled_weights(binary_file, digest)
+        if weights:
+            return weights
+
+        # The cache file is named by path and content, so changed json files never match an old compiled version
+        path_digest = hashlib.sha1(os.path.abspath(weights_file).encode("utf-8")).hexdigest()[0:12]
+        stem = os.path.basename(binary_file)[0:-len(BINARY_WEIGHTS_SUFFIX)] + "." + path_digest
+        binary_file = os.path.join(_WEIGHTS_CACHE_DIR, stem + "." + digest + BINARY_WEIGHTS_SUFFIX)
+        weights = RigService._read_compiled_weights(binary_file, digest)
+        if weights:
+            return weights
+
+        _LOG.debug("Compiling weights", (weights_file, binary_file))
+        try:
+            os.makedirs(_WEIGHTS_CACHE_DIR, exist_ok=True)
+            RigService._remove_compiled_weights(stem)
+            compile_weights_file(weights_file, binary_file)
+            return read_binary_weights(binary_file)
+        except (OSError, ValueError) as err:
+            _LOG.warn("Could not compile weights, using json", (weights_file, err))
+            with open(weights_file, "r") as json_file:
+                return json.load(json_file)
+
+    @staticmethod
+    def _read_compiled_weights(binary_file, source_sha1):
+        # Return the compiled weights if they exist, are readable and were compiled from the given content
+        if not os.path.exists(binary_file):
+            return None
+        try:
+            weights = read_binary_weights(binary_file)
+        except (OSError, ValueError) as err:
+            _LOG.warn("Ignoring unreadable compiled weights", (binary_file, err))
+            return None
+        if weights.source_sha1 != source_sha1:
+            return None
+        return weights
+
+    @staticmethod
+    def _remove_compiled_weights(stem):
+        # Remove compiled versions of older content of the same weights file from the user cache
+        for name in os.listdir(_WEIGHTS_CACHE_DIR):
+            if name.startswith(stem + ".") and name.endswith(BINARY_WEIGHTS_SUFFIX):
+                try:
+                    os.remove(os.path.join(_WEIGHTS_CACHE_DIR, name))
+                except OSError as err:
+                    _LOG.warn("Could not remove old compiled weights", (name, err))
+
+    @staticmethod
+    def _get_bone_weights(weights, bone_name):
+        # Return (vertex indices, weights) for a bone from either a MHW dict or a BinaryWeights, or None
+        if isinstance(weights, BinaryWeights):
+            return weights.get_bone_weights(bone_name)
+        if not bone_name in weights["weights"]:
+            return None
+        # Weights is array of [vertex_index, weight] pairs
+        weight_array = numpy.array(weights["weights"][bone_name], dtype=numpy.float64).reshape(-1, 2)
+        return weight_array[:, 0].astype(numpy.int64), weight_array[:, 1]
+
     @staticmethod
     def apply_weights(armature_object, basemesh, mhw_dict):
-        weights = mhw_dict["weights"]
+        """Assign weights to the basemesh, from either a MHW-compatible dict or a BinaryWeights instance
+        as returned by load_weights()."""
 
         for bone in armature_object.data.bones:
-            if bone.name in weights:
-                # Weights is array of [vertex_index, weight] pairs. Use zip to rotate it
-                # so we can get an array of the values of the first column
-                weight_array = weights[bone.name]
-                if len(weight_array) > 0:
-                    columns = list(zip(*weight_array))
-                    vertex_indices = columns[0]
-                else:
-                    vertex_indices = []
-
+            bone_weights = RigService._get_bone_weights(mhw_dict, bone.name)
+            if bone_weights is not None:
                 if not bone.name in basemesh.vertex_groups:
                     basemesh.vertex_groups.new(name=bone.name)
 
                 vertex_group = basemesh.vertex_groups.get(bone.name)
-                if len(vertex_indices) > 0:
-                    vertex_group.add(vertex_indices, 1.0, 'ADD')
-
-        vertex_group_name_to_index = dict()
 
-        for vertex_group in basemesh.vertex_groups:
-            vertex_group_name_to_index[vertex_group.name] = vertex_group.index
-
-        for bone in armature_object.data.bones:
-            if bone.name in weights and bone.name in basemesh.vertex_groups:
-                for vertex_weight in weights[bone.name]:
-                    vertex_index = vertex_weight[0]
-                    weight = vertex_weight[1]
-                    vertex = basemesh.data.vertices[vertex_index]
-                    group_index = vertex_group_name_to_index[bone.name]
-                    for group in vertex.groups:
-                        if group.group == group_index:
-                            group.weight = weight
-                            break
+                (vertex_indices, weights) = bone_weights
+                if len(vertex_indices) > 0:
+                    MeshService.set_vertex_group_weights(vertex_group, vertex_indices, weights)
 
     @staticmethod
     def identify_rig(armature_object):
@@ -669,6 +721,8 @@ class RigService:
 
     @staticmethod
     def refit_existing_armature(armature_object):
+        """Move the bones of the armature so that they fit the current shape of its basemesh, using the
+        compiled fitting plan of the rig."""
 
         from mpfb.entities.rig import Rig
         _LOG.reset_timer()
@@ -700,7 +754,7 @@ class RigService:
         rigfile = os.path.join(rigdir, "rig." + rig_type + ".json")
         _LOG.debug("Rig file", rigfile)
 
-        rig = Rig.from_json_file_and_basemesh(rigfile, basemesh)
+        rig = Rig.from_fitting_plan_and_basemesh(rigfile, basemesh)
         rig.armature_object = armature_object
 
         rig.reposition_edit_bone()
@@ -1,12 +1,17 @@
 """Module for managing targets and shape keys."""
 
-import os, gzip, bpy, json, bmesh, random
-from pathlib import Path
+import os, gzip, bpy, json, bmesh, random, numpy, time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import threading
 from mpfb.services.logservice import LogService
 from mpfb.services.locationservice import LocationService
+from mpfb.services.meshservice import MeshService
+from mpfb.services.objectservice import ObjectService
 from mpfb.entities.objectproperties import GeneralObjectProperties
 from mpfb.entities.objectproperties import HumanObjectProperties
 from mpfb.entities.primitiveprofiler import PrimitiveProfiler
+from mpfb.entities.binarytarget import binary_target_path, parse_target_string, read_binary_target
 
 _LOG = LogService.get_logger("services.targetservice")
 
@@ -29,6 +34,24 @@ _MACRO_FILE = os.path.join(_TARGETS_DIR, "macrodetails", "macro.json")
 with open(_MACRO_FILE, "r") as json_file:
     _MACRO_CONFIG = json.load(json_file)
 
+# The macro combinations of _MACRO_CONFIG compiled into arrays, see _get_macro_table()
+_MACRO_TABLE = None
+
+# Index of target name -> absolute path. The per-root scan info (including directory
+# modification times) is persisted so that later sessions need not walk the tree again.
+_TARGET_INDEX = None
+_TARGET_INDEX_ROOTS = None
+_TARGET_INDEX_VERSION = 1
+_TARGET_INDEX_FILE = LocationService.get_user_cache("target_index.json")
+
+# How target data is written to shape keys. "numpy" reads and writes whole coordinate arrays via
+# foreach_get/foreach_set, "bmesh" is the original per-vertex approach.
+SHAPE_KEY_WRITE_STRATEGIES = ["numpy", "bmesh"]
+_SHAPE_KEY_WRITE_STRATEGY = "numpy"
+
+# Number of threads used for reading and decoding targets in bulk_load_targets
+_TARGET_DECODE_WORKERS = max(1, min(8, os.cpu_count() or 1))
+
 _LOADER = LogService.get_logger("target loader")
 #_LOADER.set_level(LogService.DUMP)
 
@@ -53,6 +76,76 @@ _SHAPEKEY_ENCODING = [
     ["child", "$ch"],
     ]
 
+class _TargetArrayCache:
+    """Size bounded LRU cache of decoded target arrays, keyed by path and modification time.
+    It is shared by all characters and may be accessed from the decoding threads."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits = self.hits + 1
+                return self._entries[key][0]
+            self.misses = self.misses + 1
+            return None
+
+    def put(self, key, arrays):
+        size = sum([array.nbytes for array in arrays])
+        if size > self.max_bytes:
+            return
+        for array in arrays:
+            if isinstance(array, numpy.ndarray) and not isinstance(array, numpy.memmap):
+                array.flags.writeable = False
+        with self._lock:
+            if key in self._entries:
+                self._bytes = self._bytes - self._entries.pop(key)[1]
+            self._entries[key] = (arrays, size)
+            self._bytes = self._bytes + size
+            self._evict()
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._entries:
+            self._bytes = self._bytes - self._entries.popitem(last=False)[1][1]
+
+    def set_max_bytes(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes
+                }
+
+# The complete set of macro targets is about 80 MB when decoded
+_TARGET_CACHE = _TargetArrayCache(128 * 1024 * 1024)
+
+# Name of the shape key holding all macro targets when these are baked
+MACRO_COMBINED_SHAPE_KEY = "$md-combined"
+
+# Per mesh cache of shape key name -> key_blocks index, see _get_shape_key_index()
+_SHAPE_KEY_INDEX = dict()
+
 _OPPOSITES = [
     "decr-incr",
     "down-up",
@@ -84,6 +177,7 @@ class TargetService:
             basemesh.shape_key_remove(key)
 
         basemesh.shape_key_remove(shape_key)
+        TargetService.invalidate_shape_key_index(basemesh)
 
     @staticmethod
     def translate_mhm_target_line_to_target_fragment(mhm_line):
@@ -112,15 +206,145 @@ class TargetService:
         profiler.leave("translate_mhm_target_line_to_target_fragment")
         return { "target": name, "value": weight }
 
+    @staticmethod
+    def get_target_roots():
+        """Return a list of all existing directories which may contain targets. These are the
+        "targets" and "custom" subdirectories of the mpfb data, makehuman user data and mpfb user
+        data roots, in that order."""
+        roots = []
+        for data_root in [LocationService.get_mpfb_data(), LocationService.get_mh_user_data(), LocationService.get_user_data()]:
+            if data_root:
+                for subdir in ["targets", "custom"]:
+                    root = os.path.abspath(os.path.join(data_root, subdir))
+                    if os.path.isdir(root) and not root in roots:
+                        roots.append(root)
+        return roots
+
+    @staticmethod
+    def _target_name_from_path(path):
+        name = str(path).replace("\\", "/")
+        for suffix in [".target.gz", ".target"]:
+            if name.endswith(suffix):
+                return name[0:len(name)-len(suffix)]
+        return name
+
+    @staticmethod
+    def _scan_target_root(root):
+        """Walk a target root and return a dict with the modification time of each directory and
+        with the target name -> path mapping of all targets found below it."""
+        profiler = PrimitiveProfiler("TargetService")
+        profiler.enter("_scan_target_root")
+        _LOG.debug("Scanning target root", root)
+        root_info = {"dirs": dict(), "targets": dict()}
+        for dirpath, subdirs, files in os.walk(root):
+            subdirs.sort()
+            root_info["dirs"][dirpath] = os.stat(dirpath).st_mtime
+            relative_dir = os.path.relpath(dirpath, root).replace("\\", "/")
+            for filename in sorted(files):
+                if not filename.endswith(".target.gz") and not filename.endswith(".target"):
+                    continue
+                full_path = os.path.join(dirpath, filename)
+                name = TargetService._target_name_from_path(filename)
+                # Targets can be referenced both by plain name ("nose-trans-up") and by a name which
+                # includes the path relative to the root ("macrodetails/height/female-young-...")
+                keys = [name]
+                if relative_dir != ".":
+                    keys.append(relative_dir + "/" + name)
+                for key in keys:
+                    if not key in root_info["targets"]:
+                        root_info["targets"][key] = full_path
+        profiler.leave("_scan_target_root")
+        return root_info
+
+    @staticmethod
+    def _target_root_is_unchanged(root_info):
+        # Adding or removing a file or a subdirectory updates the modification time of the parent
+        # directory, so it is enough to compare the times of the directories we saw last time.
+        for dirpath, mtime in root_info["dirs"].items():
+            if not os.path.isdir(dirpath) or os.stat(dirpath).st_mtime != mtime:
+                return False
+        return True
+
+    @staticmethod
+    def _refresh_target_index():
+        global _TARGET_INDEX # pylint: disable=W0603
+        global _TARGET_INDEX_ROOTS # pylint: disable=W0603
+
+        profiler = PrimitiveProfiler("TargetService")
+        profiler.enter("_refresh_target_index")
+
+        if _TARGET_INDEX_ROOTS is None:
+            _TARGET_INDEX_ROOTS = dict()
+            if os.path.exists(_TARGET_INDEX_FILE):
+                try:
+                    with open(_TARGET_INDEX_FILE, "r") as json_file:
+                        cached = json.load(json_file)
+                    if cached.get("version") == _TARGET_INDEX_VERSION:
+                        _TARGET_INDEX_ROOTS = cached["roots"]
+                except Exception as exception: # pylint: disable=W0703
+                    _LOG.warn("Could not read the cached target index, will rebuild it", exception)
+
+        changed = False
+        roots = TargetService.get_target_roots()
+
+        for root in list(_TARGET_INDEX_ROOTS.keys()):
+            if not root in roots:
+                _LOG.debug("Target root is no longer relevant", root)
+                del _TARGET_INDEX_ROOTS[root]
+                changed = True
+
+        for root in roots:
+            if not root in _TARGET_INDEX_ROOTS or not TargetService._target_root_is_unchanged(_TARGET_INDEX_ROOTS[root]):
+                _TARGET_INDEX_ROOTS[root] = TargetService._scan_target_root(root)
+                changed = True
+
+        if changed or _TARGET_INDEX is None:
+            _TARGET_INDEX = dict()
+            # Iterate in reverse so that roots earlier in the list take precedence
+            for root in reversed(roots):
+                _TARGET_INDEX.update(_TARGET_INDEX_ROOTS[root]["targets"])
+
+        if changed:
+            _LOG.debug("Writing target index", _TARGET_INDEX_FILE)
+            try:
+                with open(_TARGET_INDEX_FILE, "w") as json_file:
+                    json.dump({"version": _TARGET_INDEX_VERSION, "roots": _TARGET_INDEX_ROOTS}, json_file)
+            except Exception as exception: # pylint: disable=W0703
+                _LOG.warn("Could not write the target index cache", exception)
+
+        profiler.leave("_refresh_target_index")
+
+    @staticmethod
+    def get_target_index(refresh=False):
+        """Return a dict mapping target names to absolute paths for all targets in the
+        known target roots. The index is cached on disk and only rescanned for the roots
+        where a directory has changed."""
+        if refresh or _TARGET_INDEX is None:
+            TargetService._refresh_target_index()
+        return _TARGET_INDEX
+
     @staticmethod
     def target_full_path(target_name):
         _LOG.enter()
-        targets_dir = LocationService.get_mpfb_data("targets")
-        _LOG.debug("Target dir:", targets_dir)
-        for name in Path(targets_dir).rglob("*.target.gz"):
-            _LOG.dump("matching vs file", name)
-            if target_name in str(name):
-                return str(name)
+        if not target_name:
+            return None
+        name = TargetService._target_name_from_path(target_name)
+
+        index = TargetService.get_target_index()
+        if name in index and os.path.exists(index[name]):
+            return index[name]
+
+        # The target is either new, has been removed or is given with a partial name.
+        # Check if something has changed on disk before giving up on an exact match
+        index = TargetService.get_target_index(refresh=True)
+        if name in index:
+            return index[name]
+
+        for path in index.values():
+            if target_name in path:
+                _LOG.debug("Found partial match for target", (target_name, path))
+                return path
+
         _LOG.warn("Did not find matching target for", target_name)
         return None
 
@@ -136,6 +360,7 @@ class TargetService:
 
         shape_key = blender_object.shape_key_add(name=shape_key_name, from_mix=create_from_mix)
         shape_key.value = 1.0
+        TargetService.invalidate_shape_key_index(blender_object)
 
         _LOG.debug("shape key", shape_key)
 
@@ -279,38 +504,16 @@ class TargetService:
         return info
 
     @staticmethod
-    def target_string_to_shape_key(target_string, shape_key_name, blender_object):
+    def target_string_to_shape_key(target_string, shape_key_name, blender_object, strategy=None):
         _LOG.enter()
         _LOG.reset_timer()
         profiler = PrimitiveProfiler("TargetService")
         profiler.enter("target_string_to_shape_key_info")
         TargetService.create_shape_key(blender_object, shape_key_name)
-        shape_key_info = TargetService._target_string_to_shape_key_info(target_string, shape_key_name, blender_object)
+        indices, deltas = parse_target_string(target_string)
 
         profiler.enter("- apply_shape_key_info")
-
-        profiler.enter("-- setup_bmesh")
-        mesh = bmesh.new()
-        mesh.from_mesh(blender_object.data)
-        profiler.leave("-- setup_bmesh")
-        profiler.enter("-- ensure_lookup_table")
-        mesh.verts.ensure_lookup_table()
-        profiler.leave("-- ensure_lookup_table")
-
-        target = mesh.verts.layers.shape[shape_key_name]
-        _LOG.debug("bmesh, target", (mesh, target))
-
-        profiler.enter("-- apply_verts")
-        for vertex in shape_key_info["vertices"]:
-            index = vertex["index"]
-            mesh.verts[index][target] = vertex["target_coordinates"]
-        profiler.leave("-- apply_verts")
-
-        profiler.enter("-- apply_bmesh")
-        mesh.to_mesh(blender_object.data)
-        mesh.free()
-        profiler.leave("-- apply_bmesh")
-
+        TargetService._write_targets_to_shape_keys(blender_object, [(shape_key_name, indices, deltas)], strategy=strategy)
         profiler.leave("- apply_shape_key_info")
 
         _LOG.time("Target was loaded in")
@@ -319,40 +522,26 @@ class TargetService:
 
     @staticmethod
     def _load_mirror_table():
-        global _MIRROR_LEFT
-        global _MIRROR_RIGHT
+        global _MIRROR_LEFT # pylint: disable=W0603
+        global _MIRROR_RIGHT # pylint: disable=W0603
 
         if not _MIRROR_LEFT is None and not _MIRROR_RIGHT is None:
             return
 
-        profiler = PrimitiveProfiler("TargetService")
-        profiler.enter("_load_mirror_table")
-
-        _MIRROR_LEFT = []
-        _MIRROR_RIGHT = []
-
-        metadata_dir = LocationService.get_mpfb_data("mesh_metadata")
-        mirror_file = os.path.join(metadata_dir, "hm08.mirror")
-        mirror_text = Path(mirror_file).read_text()
-        mirror_lines = str(mirror_text).splitlines(False)
-        for line in mirror_lines:
-            if line:
-                parts = str(line).split(" ", 3)
-                from_idx = int(parts[0])
-                to_idx = int(parts[1])
-                side = str(parts[2])
-                if side == "l":
-                    _MIRROR_LEFT.append([from_idx, to_idx])
-                if side == "r":
-                    _MIRROR_RIGHT.append([from_idx, to_idx])
-
-        profiler.leave("_load_mirror_table")
-
+        metadata = ObjectService.get_mesh_metadata()
+        _MIRROR_LEFT = metadata["mirror_left"]
+        _MIRROR_RIGHT = metadata["mirror_right"]
 
     @staticmethod
     def symmetrize_shape_key(blender_object, shape_key_name, copy_left_to_right=True):
-        global _MIRROR_LEFT
-        global _MIRROR_RIGHT
+        TargetService.symmetrize_shape_keys(blender_object, [shape_key_name], copy_left_to_right)
+
+    @staticmethod
+    def symmetrize_shape_keys(blender_object, shape_key_names=None, copy_left_to_right=True):
+        """Make one side of each of the given shape keys a mirrored copy of the other side. If no names
+        are given, all shape keys except the basis are symmetrized."""
+        global _MIRROR_LEFT # pylint: disable=W0603
+        global _MIRROR_RIGHT # pylint: disable=W0603
 
         object_type = GeneralObjectProperties.get_value("object_type", entity_reference=blender_object)
         if object_type != "Basemesh":
@@ -362,12 +551,22 @@ class TargetService:
         if copy_left_to_right:
             mirror = _MIRROR_LEFT
 
-        target = blender_object.data.shape_keys.key_blocks[shape_key_name]
+        key_blocks = blender_object.data.shape_keys.key_blocks
+        if shape_key_names is None:
+            reference_key = blender_object.data.shape_keys.reference_key
+            shape_key_names = [key_block.name for key_block in key_blocks if key_block != reference_key]
 
-        for (from_idx, to_idx) in mirror:
-            target.data[to_idx].co[0] = -target.data[from_idx].co[0]
-            target.data[to_idx].co[1] = target.data[from_idx].co[1]
-            target.data[to_idx].co[2] = target.data[from_idx].co[2]
+        from_indices = mirror[:, 0]
+        to_indices = mirror[:, 1]
+        flip_x = numpy.array([-1.0, 1.0, 1.0], dtype=numpy.float32)
+
+        for shape_key_name in shape_key_names:
+            target = key_blocks[shape_key_name]
+            coordinates = MeshService.get_shape_key_coordinates(target)
+            coordinates[to_indices] = coordinates[from_indices] * flip_x
+            MeshService.set_shape_key_coordinates(target, coordinates)
+
+        blender_object.data.update()
 
     @staticmethod
     def get_target_stack(blender_object, exclude_starts_with=None, exclude_ends_with=None):
@@ -402,31 +601,89 @@ class TargetService:
         profiler.leave("get_target_stack")
         return stack
 
+    @staticmethod
+    def _get_shape_key_index(blender_object):
+        """Return a (names, aliases) tuple of dicts mapping shape key names respectively decoded shape key
+        names to indices in key_blocks, or None if the object has no shape keys. The index is cached per mesh
+        and is rebuilt when the number of shape keys or the names at the ends of the list change."""
+        keys = blender_object.data.shape_keys
+        if keys is None or keys.key_blocks is None or len(keys.key_blocks) < 1:
+            return None
+        key_blocks = keys.key_blocks
+        mesh_pointer = blender_object.data.as_pointer()
+        signature = (keys.as_pointer(), len(key_blocks), key_blocks[0].name, key_blocks[-1].name)
+        cached = _SHAPE_KEY_INDEX.get(mesh_pointer)
+        if cached is not None and cached["signature"] == signature:
+            return cached["names"], cached["aliases"]
+
+        profiler = PrimitiveProfiler("TargetService")
+        profiler.enter("_get_shape_key_index")
+        names = dict()
+        aliases = dict()
+        for idx, shape_key in enumerate(key_blocks):
+            name = shape_key.name
+            if "basis" in str(name).lower():
+                continue
+            names[name] = idx
+            decoded = TargetService.decode_shapekey_name(name)
+            if decoded != name and not decoded in aliases:
+                aliases[decoded] = idx
+        _SHAPE_KEY_INDEX[mesh_pointer] = {"signature": signature, "names": names, "aliases": aliases}
+        profiler.leave("_get_shape_key_index")
+        return names, aliases
+
+    @staticmethod
+    def invalidate_shape_key_index(blender_object=None):
+        """Drop the cached shape key name index for an object, or for all objects if none is given. This is
+        done automatically when shape keys are added or removed via TargetService, but code that renames
+        shape keys directly should call it."""
+        if blender_object is None:
+            _SHAPE_KEY_INDEX.clear()
+        elif blender_object.data:
+            _SHAPE_KEY_INDEX.pop(blender_object.data.as_pointer(), None)
+
+    @staticmethod
+    def get_shape_key(blender_object, target_name, also_check_for_encoded=False):
+        """Return the shape key block matching the target name, or None. Basis keys are never returned."""
+        if blender_object is None or target_name is None or not target_name:
+            return None
+        index = TargetService._get_shape_key_index(blender_object)
+        if index is None:
+            return None
+        names, aliases = index
+        idx = names.get(target_name)
+        if idx is None and also_check_for_encoded:
+            idx = aliases.get(target_name)
+        if idx is None:
+            return None
+        key_blocks = blender_object.data.shape_keys.key_blocks
+        shape_key = key_blocks[idx]
+        if shape_key.name != target_name and TargetService.decode_shapekey_name(shape_key.name) != target_name:
+            # A key has been renamed behind our back
+            TargetService.invalidate_shape_key_index(blender_object)
+            return TargetService.get_shape_key(blender_object, target_name, also_check_for_encoded)
+        return shape_key
+
     @staticmethod
     def has_target(blender_object, target_name, also_check_for_encoded=True):
         if blender_object is None or target_name is None or not target_name:
             _LOG.debug("Empty object or target", (blender_object, target_name))
             return False
-        encoded_name = TargetService.encode_shapekey_name(target_name)
-        stack = TargetService.get_target_stack(blender_object)
-        for target in stack:
-            if target["target"] == target_name:
-                return True
-            if also_check_for_encoded and target["target"] == encoded_name:
-                return True
-        return False
+        if blender_object.type != 'MESH':
+            raise ValueError('Must provide a valid mesh object')
+        return TargetService.get_shape_key(blender_object, target_name, also_check_for_encoded) is not None
 
     @staticmethod
     def get_target_value(blender_object, target_name):
         if blender_object is None or target_name is None or not target_name:
             _LOG.debug("Empty object or target", (blender_object, target_name))
             return 0.0
-        stack = TargetService.get_target_stack(blender_object)
-        for target in stack:
-            _LOG.debug("Target", target)
-            if target["target"] == target_name:
-                return target["value"]
-        return 0.0
+        if blender_object.type != 'MESH':
+            raise ValueError('Must provide a valid mesh object')
+        shape_key = TargetService.get_shape_key(blender_object, target_name)
+        if shape_key is None:
+            return 0.0
+        return shape_key.value
 
     @staticmethod
     def set_target_value(blender_object, target_name, value, delete_target_on_zero=False):
@@ -440,18 +697,206 @@ class TargetService:
             _LOG.error("Object does not have any shape keys")
             raise ValueError('Empty object or target')
 
-        for shape_key in keys.key_blocks:
-            if shape_key.name == target_name:
-                shape_key.value = value
-                if value < 0.0001 and delete_target_on_zero:
-                    # TODO: This simply assumes that the blender_object is also the context active object.
-                    # If this is not the case, this might cause a bit of pain...
-                    shape_key_idx = blender_object.data.shape_keys.key_blocks.find(shape_key.name)
-                    blender_object.active_shape_key_index = shape_key_idx
-                    bpy.ops.object.shape_key_remove()
+        shape_key = TargetService.get_shape_key(blender_object, target_name)
+        if shape_key is not None:
+            shape_key.value = value
+            if value < 0.0001 and delete_target_on_zero:
+                TargetService.remove_shape_keys(blender_object, [shape_key.name])
+
+    @staticmethod
+    def remove_shape_keys(blender_object, shape_key_names):
+        """Remove the named shape keys from the object. Unlike bpy.ops.object.shape_key_remove(), this does
+        not need the object to be active and only triggers a single update at the end. Names which do not
+        exist are ignored. Return the number of removed keys."""
+        if blender_object is None or not blender_object.data.shape_keys:
+            return 0
+        profiler = PrimitiveProfiler("TargetService")
+        profiler.enter("remove_shape_keys")
+        removed = 0
+        for name in shape_key_names:
+            # Look up each key anew, since removing a key block invalidates references to the others
+            shape_key = blender_object.data.shape_keys.key_blocks.get(name)
+            if shape_key is not None:
+                blender_object.shape_key_remove(shape_key)
+                removed = removed + 1
+        if removed > 0:
+            TargetService.invalidate_shape_key_index(blender_object)
+            if blender_object.data.shape_keys:
+                last_index = len(blender_object.data.shape_keys.key_blocks) - 1
+                if blender_object.active_shape_key_index > last_index:
+                    blender_object.active_shape_key_index = last_index
+            blender_object.data.update()
+        profiler.leave("remove_shape_keys")
+        return removed
+
+    @staticmethod
+    def _decode_target_arrays(full_path):
+        # This is called from worker threads, so it must not touch bpy data, the profiler or the log
+        full_path = str(full_path)
+        if full_path.endswith(".bin"):
+            binary_path = full_path
+        else:
+            binary_path = binary_target_path(full_path)
+            if os.path.exists(binary_path) and os.path.exists(full_path) and os.stat(binary_path).st_mtime < os.stat(full_path).st_mtime:
+                # The compiled target is stale
+                binary_path = None
+
+        if binary_path and os.path.exists(binary_path):
+            return read_binary_target(binary_path)
+
+        if not os.path.exists(full_path):
+            raise IOError(full_path + " does not exist")
+        if full_path.endswith(".gz"):
+            with gzip.open(full_path, "rb") as gzip_file:
+                target_bytes = gzip_file.read()
+        else:
+            with open(full_path, "rb") as target_file:
+                target_bytes = target_file.read()
+        return parse_target_string(target_bytes)
 
     @staticmethod
-    def bulk_load_targets(blender_object, target_stack, encode_target_names=False):
+    def _target_cache_key(full_path):
+        full_path = str(full_path)
+        key = [full_path]
+        for path in [full_path, binary_target_path(full_path)]:
+            if os.path.exists(path):
+                stat = os.stat(path)
+                key.append((stat.st_mtime_ns, stat.st_size))
+            else:
+                key.append(None)
+        return tuple(key)
+
+    @staticmethod
+    def _get_target_arrays(full_path):
+        # Like _decode_target_arrays, but going via the cache. Also safe to call from worker threads.
+        key = TargetService._target_cache_key(full_path)
+        arrays = _TARGET_CACHE.get(key)
+        if arrays is None:
+            arrays = TargetService._decode_target_arrays(full_path)
+            _TARGET_CACHE.put(key, arrays)
+        return arrays
+
+    @staticmethod
+    def get_target_cache_stats():
+        """Return a dict with hits, misses, entries, bytes and max_bytes of the decoded target cache."""
+        return _TARGET_CACHE.stats()
+
+    @staticmethod
+    def set_target_cache_limit(max_bytes):
+        """Set the maximum memory the decoded target cache may use. Zero effectively disables the cache."""
+        _TARGET_CACHE.set_max_bytes(max_bytes)
+
+    @staticmethod
+    def clear_target_cache():
+        _TARGET_CACHE.clear()
+
+    @staticmethod
+    def load_target_arrays(full_path):
+        """Return the modified vertex indices (int32) and coordinate deltas (float32, shape (N, 3), blender
+        axis order, not scaled) of a target. If a compiled .target.bin exists next to the text target and is
+        not older than it, it is read directly. Otherwise the text target is parsed. Decoded arrays are kept
+        in a shared LRU cache and must be treated as read-only."""
+        profiler = PrimitiveProfiler("TargetService")
+        profiler.enter("load_target_arrays")
+        try:
+            return TargetService._get_target_arrays(full_path)
+        finally:
+            profiler.leave("load_target_arrays")
+
+    @staticmethod
+    def load_target_arrays_parallel(full_paths, max_workers=None):
+        """Decode several targets concurrently. Return a list of (indices, deltas) tuples in the same
+        order as the given paths. Reading, decompression and parsing do not need bpy, so a thread pool is
+        used. File reads and gzip decompression release the GIL and overlap between threads. Parsing runs in
+        numpy's C text parser, which is much faster than a python loop but holds the GIL, so it does not
+        overlap. Compiled .target.bin files avoid parsing altogether. Process pools are avoided since they
+        do not play well with blender."""
+        profiler = PrimitiveProfiler("TargetService")
+        profiler.enter("load_target_arrays_parallel")
+
+        full_paths = list(full_paths)
+        if max_workers is None:
+            max_workers = _TARGET_DECODE_WORKERS
+        max_workers = min(max_workers, len(full_paths))
+
+        if max_workers < 2:
+            results = [TargetService._get_target_arrays(full_path) for full_path in full_paths]
+        else:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                results = list(executor.map(TargetService._get_target_arrays, full_paths))
+
+        profiler.leave("load_target_arrays_parallel")
+        return results
+
+    @staticmethod
+    def get_shape_key_write_strategy():
+        """Return the default strategy used when writing target data to shape keys, either "numpy" or "bmesh"."""
+        return _SHAPE_KEY_WRITE_STRATEGY
+
+    @staticmethod
+    def set_shape_key_write_strategy(strategy):
+        global _SHAPE_KEY_WRITE_STRATEGY # pylint: disable=W0603
+        if not strategy in SHAPE_KEY_WRITE_STRATEGIES:
+            raise ValueError("Unknown shape key write strategy: " + str(strategy))
+        _SHAPE_KEY_WRITE_STRATEGY = strategy
+
+    @staticmethod
+    def _get_scale_factor(blender_object, scale_factor=None):
+        if scale_factor is None:
+            scale_factor = GeneralObjectProperties.get_value("scale_factor", entity_reference=blender_object)
+        if not scale_factor or scale_factor < 0.0001:
+            scale_factor = 1.0
+        return scale_factor
+
+    @staticmethod
+    def _write_target_arrays_bmesh(blender_object, mesh, shape_key_name, indices, deltas, scale_factor):
+        target = mesh.verts.layers.shape[shape_key_name]
+        vertices = blender_object.data.vertices
+        scaled_deltas = (numpy.asarray(deltas, dtype=numpy.float64) * scale_factor).tolist()
+        for index, delta in zip(numpy.asarray(indices).tolist(), scaled_deltas):
+            bco = vertices[index].co
+            mesh.verts[index][target] = (bco[0] + delta[0], bco[1] + delta[1], bco[2] + delta[2])
+
+    @staticmethod
+    def _write_target_arrays_numpy(blender_object, shape_key_name, indices, deltas, scale_factor, vertex_coordinates):
+        shape_key = blender_object.data.shape_keys.key_blocks[shape_key_name]
+        coordinates = MeshService.get_shape_key_coordinates(shape_key)
+        coordinates[indices] = vertex_coordinates[indices] + numpy.asarray(deltas, dtype=numpy.float32) * scale_factor
+        MeshService.set_shape_key_coordinates(shape_key, coordinates)
+
+    @staticmethod
+    def _write_targets_to_shape_keys(blender_object, targets, scale_factor=None, strategy=None):
+        """Write a list of (shape_key_name, indices, deltas) tuples to already created shape keys."""
+        profiler = PrimitiveProfiler("TargetService")
+        if strategy is None:
+            strategy = _SHAPE_KEY_WRITE_STRATEGY
+        scale_factor = TargetService._get_scale_factor(blender_object, scale_factor)
+
+        if strategy == "numpy":
+            profiler.enter("- write_shape_keys_numpy")
+            vertex_coordinates = MeshService.get_vertex_coordinates(blender_object)
+            for shape_key_name, indices, deltas in targets:
+                TargetService._write_target_arrays_numpy(blender_object, shape_key_name, indices, deltas, scale_factor, vertex_coordinates)
+            blender_object.data.update()
+            profiler.leave("- write_shape_keys_numpy")
+            return
+
+        if strategy != "bmesh":
+            raise ValueError("Unknown shape key write strategy: " + str(strategy))
+
+        profiler.enter("- write_shape_keys_bmesh")
+        mesh = bmesh.new()
+        mesh.from_mesh(blender_object.data)
+        mesh.verts.ensure_lookup_table()
+        for shape_key_name, indices, deltas in targets:
+            TargetService._write_target_arrays_bmesh(blender_object, mesh, shape_key_name, indices, deltas, scale_factor)
+        mesh.to_mesh(blender_object.data)
+        mesh.free()
+        MeshService.invalidate_shaped_coordinates(blender_object)
+        profiler.leave("- write_shape_keys_bmesh")
+
+    @staticmethod
+    def bulk_load_targets(blender_object, target_stack, encode_target_names=False, strategy=None):
         profiler = PrimitiveProfiler("TargetService")
         profiler.enter("bulk_load_targets")
 
@@ -460,7 +905,7 @@ class TargetService:
         load_info = dict()
         load_info["parsed_target_stack"] = []
 
-        profiler.enter(" -- bulk load -> load string data")
+        profiler.enter(" -- bulk load -> resolve target paths")
         for target in target_stack:
             _LOG.debug("Listed target", target)
             target_full_path = TargetService.target_full_path(target["target"])
@@ -470,13 +915,6 @@ class TargetService:
                 parsed_target["full_path"] = target_full_path
                 parsed_target["name"] = target["target"]
                 parsed_target["value"] = target["value"]
-                if str(target_full_path).endswith(".gz"):
-                    with gzip.open(target_full_path, "rb") as gzip_file:
-                        raw_data = gzip_file.read()
-                        parsed_target["target_string"] = raw_data.decode('utf-8')
-                else:
-                    with open(target_full_path, "r") as target_file:
-                        parsed_target["target_string"] = target_file.read()
                 name = os.path.basename(target_full_path)
                 name = name.replace(".target.gz", "")
                 name = name.replace(".target", "")
@@ -484,34 +922,26 @@ class TargetService:
                 load_info["parsed_target_stack"].append(parsed_target)
             else:
                 _LOG.warn("Skipping target because it could not be resolved to a path", target)
-        profiler.leave(" -- bulk load -> load string data")
+        profiler.leave(" -- bulk load -> resolve target paths")
+
+        profiler.enter(" -- bulk load -> decode target data")
+        full_paths = [parsed_target["full_path"] for parsed_target in load_info["parsed_target_stack"]]
+        decoded = TargetService.load_target_arrays_parallel(full_paths)
+        for parsed_target, arrays in zip(load_info["parsed_target_stack"], decoded):
+            parsed_target["indices"], parsed_target["deltas"] = arrays
+        profiler.leave(" -- bulk load -> decode target data")
 
         profiler.enter(" -- bulk load -> shape key placeholders")
         for target in load_info["parsed_target_stack"]:
             TargetService.create_shape_key(blender_object, target["shape_key_name"])
         profiler.leave(" -- bulk load -> shape key placeholders")
 
-        profiler.enter(" -- bulk load -> setup bmesh")
-        mesh = bmesh.new()
-        mesh.from_mesh(blender_object.data)
-        mesh.verts.ensure_lookup_table()
-        profiler.leave(" -- bulk load -> setup bmesh")
-
         profiler.enter(" -- bulk load -> populate shape keys")
+        targets = []
         for target_info in load_info["parsed_target_stack"]:
-            shape_key_info = TargetService._target_string_to_shape_key_info(target_info["target_string"], target_info["shape_key_name"], blender_object)
-            target = mesh.verts.layers.shape[target_info["shape_key_name"]]
-            _LOG.debug("bmesh, target", (mesh, target))
-            for vertex in shape_key_info["vertices"]:
-                index = vertex["index"]
-                mesh.verts[index][target] = vertex["target_coordinates"]
+            targets.append((target_info["shape_key_name"], target_info["indices"], target_info["deltas"]))
+        TargetService._write_targets_to_shape_keys(blender_object, targets, strategy=strategy)
         profiler.leave(" -- bulk load -> populate shape keys")
-        profiler.enter("- apply_shape_key_info")
-
-        profiler.enter(" -- bulk load -> apply bmesh")
-        mesh.to_mesh(blender_object.data)
-        mesh.free()
-        profiler.leave(" -- bulk load -> apply bmesh")
 
         profiler.enter(" -- bulk load -> set target values")
         for target_info in load_info["parsed_target_stack"]:
@@ -521,7 +951,37 @@ class TargetService:
         profiler.leave("bulk_load_targets")
 
     @staticmethod
-    def load_target(blender_object, full_path, weight=0.0, name=None):
+    def benchmark_shape_key_write_strategies(basemesh, target_stack=None, iterations=3):
+        """Load a target stack (per default the full macro stack of the basemesh) onto temporary copies of the
+        basemesh using each of the shape key write strategies. Return a dict with the best time in seconds
+        per strategy."""
+        if target_stack is None:
+            macro_info = TargetService.get_macro_info_dict_from_basemesh(basemesh)
+            target_stack = []
+            for target in TargetService.calculate_target_stack_from_macro_info_dict(macro_info):
+                target_stack.append({"target": target[0], "value": target[1]})
+        _LOG.debug("Benchmarking with target stack", target_stack)
+
+        results = dict()
+        for strategy in SHAPE_KEY_WRITE_STRATEGIES:
+            timings = []
+            for iteration in range(iterations):
+                mesh_copy = basemesh.data.copy()
+                object_copy = basemesh.copy()
+                object_copy.data = mesh_copy
+                if object_copy.data.shape_keys:
+                    object_copy.shape_key_clear()
+                before = time.time()
+                TargetService.bulk_load_targets(object_copy, target_stack, strategy=strategy)
+                timings.append(time.time() - before)
+                bpy.data.objects.remove(object_copy, do_unlink=True)
+                bpy.data.meshes.remove(mesh_copy, do_unlink=True)
+            results[strategy] = min(timings)
+            _LOG.info("Shape key write strategy " + strategy + ", " + str(len(target_stack)) + " targets, best of " + str(iterations), results[strategy])
+        return results
+
+    @staticmethod
+    def load_target(blender_object, full_path, weight=0.0, name=None, strategy=None):
 
         profiler = PrimitiveProfiler("TargetService")
         profiler.enter("load_target")
@@ -532,8 +992,6 @@ class TargetService:
             raise ValueError("Must specify a valid path - null or none was given")
         if not os.path.exists(full_path):
             raise IOError(full_path + " does not exist")
-        target_string = None
-        shape_key = None
 
         if name is None:
             name = os.path.basename(full_path)
@@ -541,23 +999,15 @@ class TargetService:
             name = name.replace(".target", "")
 
         _LOADER.reset_timer()
-        if str(full_path).endswith(".gz"):
-            profiler.enter("load_target_gzip")
-            with gzip.open(full_path, "rb") as gzip_file:
-                raw_data = gzip_file.read()
-                target_string = raw_data.decode('utf-8')
-                profiler.leave("load_target_gzip")
-                if not target_string is None:
-                    shape_key = TargetService.target_string_to_shape_key(target_string, name, blender_object)
-                    shape_key.value = weight
-        else:
-            profiler.enter("load_target_plain")
-            with open(full_path, "r") as target_file:
-                target_string = target_file.read()
-                profiler.leave("load_target_plain")
-                if not target_string is None:
-                    shape_key = TargetService.target_string_to_shape_key(target_string, name, blender_object)
-                    shape_key.value = weight
+        indices, deltas = TargetService.load_target_arrays(full_path)
+
+        profiler.enter("load_target_apply")
+        TargetService.create_shape_key(blender_object, name)
+        TargetService._write_targets_to_shape_keys(blender_object, [(name, indices, deltas)], strategy=strategy)
+        shape_key = blender_object.data.shape_keys.key_blocks[name]
+        shape_key.value = weight
+        profiler.leave("load_target_apply")
+
         _LOADER.time(str(full_path) + " " + str(weight))
         profiler.leave("load_target")
 
@@ -637,6 +1087,81 @@ class TargetService:
         return components
 
 
+    @staticmethod
+    def _get_macro_table():
+        """Compile macro.json into arrays describing the interpolation parts of each macro and the name
+        tensors of each macro target family. This is done once, the first time it is needed."""
+        global _MACRO_TABLE # pylint: disable=W0603
+        if not _MACRO_TABLE is None:
+            return _MACRO_TABLE
+
+        profiler = PrimitiveProfiler("TargetService")
+        profiler.enter("_get_macro_table")
+
+        macros = dict()
+        for macro_name, macrotarget in _MACRO_CONFIG["macrotargets"].items():
+            levels = []
+            for parts in macrotarget["parts"]:
+                for level in [parts["low"], parts["high"]]:
+                    if level and not level in levels:
+                        levels.append(level)
+            macros[macro_name] = {
+                "levels": levels,
+                "lowest": numpy.array([parts["lowest"] for parts in macrotarget["parts"]], dtype=numpy.float64),
+                "highest": numpy.array([parts["highest"] for parts in macrotarget["parts"]], dtype=numpy.float64),
+                "low": [levels.index(parts["low"]) if parts["low"] else -1 for parts in macrotarget["parts"]],
+                "high": [levels.index(parts["high"]) if parts["high"] else -1 for parts in macrotarget["parts"]]
+                }
+
+        def _names(prefix, level_lists):
+            names = numpy.array([prefix], dtype=object)
+            for separator, levels in level_lists:
+                names = numpy.add.outer(names, numpy.array([separator + level for level in levels], dtype=object))
+            return names.reshape(-1)
+
+        levels = dict([(macro_name, macros[macro_name]["levels"]) for macro_name in macros])
+        age_muscle_weight = [("-", levels["age"]), ("-", levels["muscle"]), ("-", levels["weight"])]
+
+        # The order of the axes, and thus of the resulting target list, is the same as the loop order
+        # of the original nested implementation
+        families = dict()
+        families["universal"] = _names("macrodetails/universal", [("-", levels["gender"])] + age_muscle_weight)
+        families["height"] = _names("macrodetails/height/", [("", levels["gender"])] + age_muscle_weight + [("-", levels["height"])])
+        families["breast"] = _names("breast/female", age_muscle_weight + [("-", levels["cupsize"]), ("-", levels["firmness"])])
+        families["proportions"] = _names("macrodetails/proportions/", [("", levels["gender"])] + age_muscle_weight + [("-", levels["proportions"])])
+
+        # There are no targets for the average cup and average firmness combination
+        breast_allowed = numpy.array(["averagecup-averagefirmness" not in name for name in families["breast"]])
+
+        _MACRO_TABLE = {
+            "macros": macros,
+            "families": families,
+            "breast_allowed": breast_allowed,
+            "female_index": levels["gender"].index("female")
+            }
+
+        profiler.leave("_get_macro_table")
+        return _MACRO_TABLE
+
+    @staticmethod
+    def _macro_component_weights(macro, value):
+        """Return arrays with the interpolated weight of each level of a compiled macro, and with whether
+        the level is part of the interpolation at all (it can be so with a rounded weight of zero)."""
+        weights = numpy.zeros(len(macro["levels"]), dtype=numpy.float64)
+        present = numpy.zeros(len(macro["levels"]), dtype=bool)
+        inside = (value > macro["lowest"]) & (value < macro["highest"])
+        position_pct = (value - macro["lowest"]) / (macro["highest"] - macro["lowest"])
+        for part in numpy.nonzero(inside)[0]:
+            low = macro["low"][part]
+            high = macro["high"][part]
+            if low >= 0:
+                weights[low] = round(1 - float(position_pct[part]), 4)
+                present[low] = True
+            if high >= 0:
+                weights[high] = round(float(position_pct[part]), 4)
+                present[high] = True
+        return weights, present
+
     @staticmethod
     def calculate_target_stack_from_macro_info_dict(macro_info, cutoff=0.01):
 
@@ -646,148 +1171,57 @@ class TargetService:
         if macro_info is None:
             macro_info = TargetService.get_default_macro_info_dict()
 
-        components = dict()
+        table = TargetService._get_macro_table()
+
+        weights = dict()
+        female_present = False
         for macro_name in ["gender", "age", "muscle", "weight", "proportions", "height", "cupsize", "firmness"]:
-            value = macro_info[macro_name]
-            components[macro_name] = TargetService._interpolate_macro_components(macro_name, value)
+            weights[macro_name], present = TargetService._macro_component_weights(table["macros"][macro_name], macro_info[macro_name])
+            if macro_name == "gender":
+                female_present = bool(present[table["female_index"]])
+
+        _LOG.dump("weights", weights)
 
-        _LOG.dump("components", components)
+        def _append(targets, names, weight_tensor, mask=None):
+            flat = weight_tensor.reshape(-1)
+            selected = flat > cutoff
+            if not mask is None:
+                selected = selected & mask
+            for idx in numpy.nonzero(selected)[0]:
+                targets.append([names[idx], float(flat[idx])])
 
         targets = []
 
-        # Targets for race-gender-age
+        # Targets for race-gender-age. The race names come from the macro info, so these are not precompiled.
+        gender_levels = table["macros"]["gender"]["levels"]
+        age_levels = table["macros"]["age"]["levels"]
         for race in macro_info["race"].keys():
-            _LOG.debug("race", (race, macro_info["race"][race]))
-            if macro_info["race"][race] > 0.0001:
-                for age_component in components["age"]:
-                    _LOG.debug("age", age_component)
-                    for gender_component in components["gender"]:
-                        _LOG.debug("gender", gender_component)
-                        if gender_component[0] != "universal":
-                            _LOG.debug("components", ([race, macro_info["race"][race]], gender_component, age_component))
-                            complete_name = "macrodetails/" + race + "-" + gender_component[0] + "-" + age_component[0]
-                            weight = macro_info["race"][race] * gender_component[1] * age_component[1]
-                            if weight > cutoff:
-                                _LOG.debug("Appending race-gender-age target", [complete_name, weight])
-                                targets.append([complete_name, weight])
+            race_weight = macro_info["race"][race]
+            if race_weight > 0.0001:
+                race_age_gender = numpy.multiply.outer(race_weight * weights["gender"], weights["age"]).T
+                for age_idx, gender_idx in zip(*numpy.nonzero(race_age_gender > cutoff)):
+                    if gender_levels[gender_idx] == "universal":
+                        continue
+                    complete_name = "macrodetails/" + race + "-" + gender_levels[gender_idx] + "-" + age_levels[age_idx]
+                    targets.append([complete_name, float(race_age_gender[age_idx, gender_idx])])
+
+        gender_age_muscle_weight = numpy.multiply.outer(numpy.multiply.outer(numpy.multiply.outer(weights["gender"], weights["age"]), weights["muscle"]), weights["weight"])
 
         # Targets for (universal)-gender-age-muscle-weight
-        for gender_component in components["gender"]:
-            _LOG.debug("gender", gender_component)
-            for age_component in components["age"]:
-                _LOG.debug("age", age_component)
-                for muscle_component in components["muscle"]:
-                    _LOG.debug("muscle", muscle_component)
-                    for weight_component in components["weight"]:
-                        _LOG.debug("weight", weight_component)
-                        complete_name = "macrodetails/universal"
-                        complete_name = complete_name + "-" + gender_component[0]
-                        complete_name = complete_name + "-" + age_component[0]
-                        complete_name = complete_name + "-" + muscle_component[0]
-                        complete_name = complete_name + "-" + weight_component[0]
-                        weight = 1.0
-                        weight = weight * gender_component[1]
-                        weight = weight * age_component[1]
-                        weight = weight * muscle_component[1]
-                        weight = weight * weight_component[1]
-                        if weight > cutoff:
-                            _LOG.debug("Appending universal-gender-age-muscle-weight target", [complete_name, weight])
-                            targets.append([complete_name, weight])
-                        else:
-                            _LOG.debug("Not appending universal-gender-age-muscle-weight target", [complete_name, weight])
+        _append(targets, table["families"]["universal"], gender_age_muscle_weight)
 
         # Targets for gender-age-muscle-weight-height
-        for gender_component in components["gender"]:
-            _LOG.debug("gender", gender_component)
-            for age_component in components["age"]:
-                _LOG.debug("age", age_component)
-                for muscle_component in components["muscle"]:
-                    _LOG.debug("muscle", muscle_component)
-                    for weight_component in components["weight"]:
-                        _LOG.debug("weight", weight_component)
-                        for height_component in components["height"]:
-                            complete_name = "macrodetails/height/"
-                            complete_name = complete_name + gender_component[0]
-                            complete_name = complete_name + "-" + age_component[0]
-                            complete_name = complete_name + "-" + muscle_component[0]
-                            complete_name = complete_name + "-" + weight_component[0]
-                            complete_name = complete_name + "-" + height_component[0]
-                            weight = 1.0
-                            weight = weight * gender_component[1]
-                            weight = weight * age_component[1]
-                            weight = weight * muscle_component[1]
-                            weight = weight * weight_component[1]
-                            weight = weight * height_component[1]
-                            if weight > cutoff:
-                                _LOG.debug("Appending gender-age-muscle-weight-height target", [complete_name, weight])
-                                targets.append([complete_name, weight])
-                            else:
-                                _LOG.debug("Not appending gender-age-muscle-weight-height target", [complete_name, weight])
-
-        # Targets for gender-age-muscle-weight-cupsize-firmness
-        for gender_component in components["gender"]:
-            _LOG.debug("gender", gender_component)
-            if gender_component[0] == "female":
-                for age_component in components["age"]:
-                    _LOG.debug("age", age_component)
-                    for muscle_component in components["muscle"]:
-                        _LOG.debug("muscle", muscle_component)
-                        for weight_component in components["weight"]:
-                            _LOG.debug("weight", weight_component)
-                            for cup_component in components["cupsize"]:
-                                _LOG.debug("cupsize", cup_component)
-                                for firmness_component in components["firmness"]:
-                                    _LOG.debug("firmness", firmness_component)
-                                    complete_name = "breast/"
-                                    complete_name = complete_name + gender_component[0]
-                                    complete_name = complete_name + "-" + age_component[0]
-                                    complete_name = complete_name + "-" + muscle_component[0]
-                                    complete_name = complete_name + "-" + weight_component[0]
-                                    complete_name = complete_name + "-" + cup_component[0]
-                                    complete_name = complete_name + "-" + firmness_component[0]
-                                    weight = 1.0
-                                    #weight = weight * gender_component[1]    <-- there are no male complementary targets
-                                    weight = weight * age_component[1]
-                                    weight = weight * muscle_component[1]
-                                    weight = weight * weight_component[1]
-                                    weight = weight * cup_component[1]
-                                    weight = weight * firmness_component[1]
-                                    if weight > cutoff:
-                                        if "averagecup-averagefirmness" in complete_name:
-                                            _LOG.debug("Excluding forbidden breast modifier combination", complete_name)
-                                        else:
-                                            _LOG.debug("Appending gender-age-muscle-weight-cupsize-firmness target", [complete_name, weight])
-                                            targets.append([complete_name, weight])
-                                    else:
-                                        _LOG.debug("Not appending gender-age-muscle-weight-cupsize-firmness target", [complete_name, weight])
+        _append(targets, table["families"]["height"], numpy.multiply.outer(gender_age_muscle_weight, weights["height"]))
+
+        # Targets for gender-age-muscle-weight-cupsize-firmness. There are no male complementary targets, so
+        # the gender weight is not used. The targets are only included if female is part of the mix at all.
+        if female_present:
+            age_muscle_weight = numpy.multiply.outer(numpy.multiply.outer(weights["age"], weights["muscle"]), weights["weight"])
+            breast = numpy.multiply.outer(numpy.multiply.outer(age_muscle_weight, weights["cupsize"]), weights["firmness"])
+            _append(targets, table["families"]["breast"], breast, table["breast_allowed"])
 
         # Targets for gender-age-muscle-weight-proportions
-        for gender_component in components["gender"]:
-            _LOG.debug("gender", gender_component)
-            for age_component in components["age"]:
-                _LOG.debug("age", age_component)
-                for muscle_component in components["muscle"]:
-                    _LOG.debug("muscle", muscle_component)
-                    for weight_component in components["weight"]:
-                        _LOG.debug("weight", weight_component)
-                        for proportions_component in components["proportions"]:
-                            complete_name = "macrodetails/proportions/"
-                            complete_name = complete_name + gender_component[0]
-                            complete_name = complete_name + "-" + age_component[0]
-                            complete_name = complete_name + "-" + muscle_component[0]
-                            complete_name = complete_name + "-" + weight_component[0]
-                            complete_name = complete_name + "-" + proportions_component[0]
-                            weight = 1.0
-                            weight = weight * gender_component[1]
-                            weight = weight * age_component[1]
-                            weight = weight * muscle_component[1]
-                            weight = weight * weight_component[1]
-                            weight = weight * proportions_component[1]
-                            if weight > cutoff:
-                                _LOG.debug("Appending gender-age-muscle-weight-proportions target", [complete_name, weight])
-                                targets.append([complete_name, weight])
-                            else:
-                                _LOG.debug("Not appending gender-age-muscle-weight-proportions target", [complete_name, weight])
+        _append(targets, table["families"]["proportions"], numpy.multiply.outer(gender_age_muscle_weight, weights["proportions"]))
 
         _LOG.dump("targets", targets)
         profiler.leave("calculate_target_stack_from_macro_info_dict")
@@ -801,12 +1235,32 @@ class TargetService:
                 name = shape_key.name
                 if decode_names:
                     name = TargetService.decode_shapekey_name(name)
-                if str(shape_key.name).startswith("$md"):
+                if str(shape_key.name).startswith("$md") and shape_key.name != MACRO_COMBINED_SHAPE_KEY:
                     macro_targets.append(name)
         return macro_targets
 
     @staticmethod
-    def reapply_macro_details(basemesh, remove_zero_weight_targets=True):
+    def reapply_macro_details(basemesh, remove_zero_weight_targets=True, incremental=False, bake=None):
+        """Make the macrodetail shape keys of the basemesh match its macro properties. In incremental mode, the
+        currently loaded macro targets are diffed against the required ones, so that only targets which are new,
+        have a changed weight or are no longer needed are touched. This is meant for interactive use, such as
+        when dragging a slider.
+
+        If bake is true, all macro targets are instead summed into a single shape key. If bake is None, the
+        bake_macro_targets property of the basemesh decides."""
+        if bake is None:
+            bake = HumanObjectProperties.get_value("bake_macro_targets", entity_reference=basemesh)
+
+        if bake:
+            TargetService.bake_macro_details(basemesh)
+            return
+
+        TargetService.remove_shape_keys(basemesh, [MACRO_COMBINED_SHAPE_KEY])
+
+        if incremental:
+            TargetService._reapply_macro_details_incremental(basemesh, remove_zero_weight_targets)
+            return
+
         profiler = PrimitiveProfiler("TargetService")
         profiler.enter("reapply_macro_details")
 
@@ -836,16 +1290,98 @@ class TargetService:
 
         if remove_zero_weight_targets and basemesh.data.shape_keys:
             _LOG.debug("Checking for targets to remove")
+            to_remove = []
             for shape_key in basemesh.data.shape_keys.key_blocks:
                 _LOG.debug("Checking shape key", (shape_key.name, shape_key.value))
-                if str(shape_key.name).startswith("$md") and shape_key.value < 0.0001:
+                if str(shape_key.name).startswith("$md") and shape_key.name != MACRO_COMBINED_SHAPE_KEY and shape_key.value < 0.0001:
                     _LOG.debug("Will remove macrodetail target", TargetService.decode_shapekey_name(shape_key.name))
-                    shape_key_idx = basemesh.data.shape_keys.key_blocks.find(shape_key.name)
-                    basemesh.active_shape_key_index = shape_key_idx
-                    bpy.ops.object.shape_key_remove()
+                    to_remove.append(shape_key.name)
+            TargetService.remove_shape_keys(basemesh, to_remove)
 
         profiler.leave("reapply_macro_details")
 
+    @staticmethod
+    def bake_macro_details(basemesh):
+        """Compute the weighted sum of all macro targets required by the macro properties of the basemesh and
+        store it as a single shape key, replacing any individual macrodetail shape keys. The macro properties
+        are left as they are, so the bake can be redone whenever they change."""
+        profiler = PrimitiveProfiler("TargetService")
+        profiler.enter("bake_macro_details")
+
+        macro_info = TargetService.get_macro_info_dict_from_basemesh(basemesh)
+        required_macro_targets = TargetService.calculate_target_stack_from_macro_info_dict(macro_info)
+        targets_dir = LocationService.get_mpfb_data("targets")
+        full_paths = [os.path.join(targets_dir, target[0] + ".target.gz") for target in required_macro_targets]
+
+        profiler.enter("- bake_macro_details_sum")
+        vertex_coordinates = MeshService.get_vertex_coordinates(basemesh)
+        combined = numpy.zeros(vertex_coordinates.shape, dtype=numpy.float64)
+        for target, (indices, deltas) in zip(required_macro_targets, TargetService.load_target_arrays_parallel(full_paths)):
+            numpy.add.at(combined, indices, numpy.asarray(deltas, dtype=numpy.float64) * target[1])
+        combined = vertex_coordinates + combined * TargetService._get_scale_factor(basemesh)
+        profiler.leave("- bake_macro_details_sum")
+
+        TargetService.remove_shape_keys(basemesh, TargetService.get_current_macro_targets(basemesh, decode_names=False))
+
+        if basemesh.data.shape_keys and MACRO_COMBINED_SHAPE_KEY in basemesh.data.shape_keys.key_blocks:
+            shape_key = basemesh.data.shape_keys.key_blocks[MACRO_COMBINED_SHAPE_KEY]
+        else:
+            shape_key = TargetService.create_shape_key(basemesh, MACRO_COMBINED_SHAPE_KEY)
+        MeshService.set_shape_key_coordinates(shape_key, combined)
+        shape_key.value = 1.0
+        basemesh.data.update()
+
+        profiler.leave("bake_macro_details")
+
+    @staticmethod
+    def _reapply_macro_details_incremental(basemesh, remove_zero_weight_targets=True):
+        profiler = PrimitiveProfiler("TargetService")
+        profiler.enter("reapply_macro_details_incremental")
+
+        macro_info = TargetService.get_macro_info_dict_from_basemesh(basemesh)
+        required = dict()
+        for target in TargetService.calculate_target_stack_from_macro_info_dict(macro_info):
+            name = str(TargetService.macrodetail_filename_to_shapekey_name(target[0], encode_name=True)).strip()
+            required[name] = target
+
+        current = dict()
+        if basemesh.data.shape_keys:
+            for shape_key in basemesh.data.shape_keys.key_blocks:
+                if str(shape_key.name).startswith("$md") and shape_key.name != MACRO_COMBINED_SHAPE_KEY:
+                    current[shape_key.name] = shape_key
+
+        to_load = []
+        for name, target in required.items():
+            if name in current:
+                if abs(current[name].value - target[1]) > 0.000001:
+                    current[name].value = target[1]
+            else:
+                to_load.append(name)
+
+        to_remove = []
+        for name, shape_key in current.items():
+            if not name in required:
+                if shape_key.value != 0.0:
+                    shape_key.value = 0.0
+                if remove_zero_weight_targets:
+                    to_remove.append(name)
+
+        _LOG.debug("Incremental macro update, loading and removing", (to_load, to_remove))
+
+        if to_load:
+            targets_dir = LocationService.get_mpfb_data("targets")
+            full_paths = [os.path.join(targets_dir, required[name][0] + ".target.gz") for name in to_load]
+            decoded = TargetService.load_target_arrays_parallel(full_paths)
+            for name in to_load:
+                TargetService.create_shape_key(basemesh, name)
+            TargetService._write_targets_to_shape_keys(basemesh, [(name, arrays[0], arrays[1]) for name, arrays in zip(to_load, decoded)])
+            for name in to_load:
+                basemesh.data.shape_keys.key_blocks[name].value = required[name][1]
+
+        TargetService.remove_shape_keys(basemesh, to_remove)
+
+        profiler.leave("reapply_macro_details_incremental")
+
 
     @staticmethod
     def encode_shapekey_name(original_name):
@@ -48,7 +48,7 @@ class MPFB_OT_AddRigifyRigOperator(bpy.types.Operator):
 
         rig_file = os.path.join(rigify_dir, "rig.human.json")
 
-        rig = Rig.from_json_file_and_basemesh(rig_file, basemesh)
+        rig = Rig.from_fitting_plan_and_basemesh(rig_file, basemesh)
         armature_object = rig.create_armature_and_fit_to_basemesh()
 
         if hasattr(armature_object.data, 'rigify_rig_basename'):
@@ -94,9 +94,7 @@ class MPFB_OT_AddRigifyRigOperator(bpy.types.Operator):
 
         if import_weights:
             weights_file = os.path.join(rigify_dir, "weights.human.json")
-            weights = dict()
-            with open(weights_file, 'r') as json_file:
-                weights = json.load(json_file)
+            weights = RigService.load_weights(weights_file)
             RigService.apply_weights(armature_object, basemesh, weights)
 
         self.report({'INFO'}, "A rig was added")
@@ -1,6 +1,6 @@
 """Operator for adding a standard rig."""
 
-import bpy, os, json
+import bpy, os
 from mpfb.services.logservice import LogService
 from mpfb.services.objectservice import ObjectService
 from mpfb.services.locationservice import LocationService
@@ -42,16 +42,14 @@ class MPFB_OT_AddStandardRigOperator(bpy.types.Operator):
 
         rig_file = os.path.join(standard_dir, "rig." + standard_rig + ".json")
 
-        rig = Rig.from_json_file_and_basemesh(rig_file, basemesh)
+        rig = Rig.from_fitting_plan_and_basemesh(rig_file, basemesh)
         armature_object = rig.create_armature_and_fit_to_basemesh()
 
         basemesh.parent = armature_object
 
         if import_weights:
             weights_file = os.path.join(standard_dir, "weights." + standard_rig + ".json")
-            weights = dict()
-            with open(weights_file, 'r') as json_file:
-                weights = json.load(json_file)
+            weights = RigService.load_weights(weights_file)
             RigService.apply_weights(armature_object, basemesh, weights)
 
         RigService.normalize_rotation_mode(armature_object)
@@ -84,6 +84,10 @@ class MPFB_PT_Developer_Panel(bpy.types.Panel):
         box.operator("mpfb.load_weights")
         box.operator("mpfb.save_weights")
 
+    def _performance(self, layout):
+        box = self._create_box(layout, "Performance")
+        box.operator("mpfb.benchmark_shape_keys")
+
     def draw(self, context):
         _LOG.enter()
         layout = self.layout
@@ -93,6 +97,7 @@ class MPFB_PT_Developer_Panel(bpy.types.Panel):
         self._nodes(layout)
         self._rig(scene, layout)
         self._weights(layout)
+        self._performance(layout)
 
 
 ClassManager.add_class(MPFB_PT_Developer_Panel)
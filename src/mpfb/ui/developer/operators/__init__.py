@@ -16,6 +16,7 @@ from .saveweights import MPFB_OT_Save_Weights_Operator
 from .loadweights import MPFB_OT_Load_Weights_Operator
 from .saverigifylayers import MPFB_OT_Save_Rigify_Layers_Operator
 from .loadrigifylayers import MPFB_OT_Load_Rigify_Layers_Operator
+from .benchmarkshapekeys import MPFB_OT_Benchmark_Shape_Keys_Operator
 
 __all__ = [
     "MPFB_OT_List_Log_Levels_Operator",
@@ -28,5 +29,6 @@ __all__ = [
     "MPFB_OT_Save_Weights_Operator",
     "MPFB_OT_Load_Weights_Operator",
     "MPFB_OT_Load_Rigify_Layers_Operator",
-    "MPFB_OT_Save_Rigify_Layers_Operator"
+    "MPFB_OT_Save_Rigify_Layers_Operator",
+    "MPFB_OT_Benchmark_Shape_Keys_Operator"
     ]
@@ -0,0 +1,35 @@
+"""Functionality for comparing the speed of the shape key write strategies"""
+
+from mpfb.services.logservice import LogService
+from mpfb.services.objectservice import ObjectService
+from mpfb.services.targetservice import TargetService
+from mpfb._classmanager import ClassManager
+import bpy
+
+_LOG = LogService.get_logger("developer.operators.benchmarkshapekeys")
+
+class MPFB_OT_Benchmark_Shape_Keys_Operator(bpy.types.Operator):
+    """Load the full macro target stack of the selected basemesh with each shape key write strategy and print the timings to the console"""
+    bl_idname = "mpfb.benchmark_shape_keys"
+    bl_label = "Benchmark shape keys"
+    bl_options = {'REGISTER'}
+
+    @classmethod
+    def poll(cls, context):
+        _LOG.enter()
+        if context.object is None:
+            return False
+        return ObjectService.object_is_basemesh(context.object)
+
+    def execute(self, context):
+        _LOG.enter()
+
+        results = TargetService.benchmark_shape_key_write_strategies(context.object)
+        for strategy in results:
+            print(strategy.ljust(40, '.') + ": " + str(round(results[strategy], 4)) + " s")
+
+        self.report({"INFO"}, "Timings were printed to the console")
+        return {'FINISHED'}
+
+
+ClassManager.add_class(MPFB_OT_Benchmark_Shape_Keys_Operator)
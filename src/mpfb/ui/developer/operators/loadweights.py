@@ -3,6 +3,7 @@ from mpfb.services.materialservice import MaterialService
 from mpfb.services.objectservice import ObjectService
 from mpfb.services.rigservice import RigService
 from mpfb.entities.rig import Rig
+from mpfb.entities.binaryweights import BINARY_WEIGHTS_SUFFIX
 from mpfb._classmanager import ClassManager
 import bpy, json, math
 from bpy.types import StringProperty
@@ -11,7 +12,7 @@ from bpy_extras.io_utils import ImportHelper
 _LOG = LogService.get_logger("developer.operators.loadweights")
 
 class MPFB_OT_Load_Weights_Operator(bpy.types.Operator, ImportHelper):
-    """Load weights from definition in json. NOTE that the base mesh must have the rig in question as a parent for this to work."""
+    """Load weights from definition in json or compiled binary (.mhw.bin) format. NOTE that the base mesh must have the rig in question as a parent for this to work."""
     bl_idname = "mpfb.load_weights"
     bl_label = "Load weights"
     bl_options = {'REGISTER', 'UNDO'}
@@ -51,11 +52,13 @@ class MPFB_OT_Load_Weights_Operator(bpy.types.Operator, ImportHelper):
         absolute_file_path = bpy.path.abspath(self.filepath)
         _LOG.debug("absolute_file_path", absolute_file_path)
 
-        weights = dict()
-        with open(absolute_file_path, 'r') as json_file:
-            weights = json.load(json_file)
-
-        _LOG.dump("Weights", weights)
+        if absolute_file_path.endswith(BINARY_WEIGHTS_SUFFIX):
+            weights = RigService.load_weights(absolute_file_path)
+        else:
+            weights = dict()
+            with open(absolute_file_path, 'r') as json_file:
+                weights = json.load(json_file)
+            _LOG.dump("Weights", weights)
 
         RigService.apply_weights(rig, basemesh, weights)
 
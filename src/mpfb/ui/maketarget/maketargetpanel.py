@@ -31,8 +31,9 @@ class MPFB_PT_MakeTarget_Panel(Abstract_Panel):
         box.operator('mpfb.write_maketarget_target')
         box.operator('mpfb.write_maketarget_ptarget')
 
-    def _symmetrize_target(self, scene, layout):
+    def _symmetrize_target(self, blender_object, layout):
         box = self._create_box(layout, "Symmetrize", "TOOL_SETTINGS")
+        MakeTargetObjectProperties.draw_properties(blender_object, box, ["symmetrize_all"])
         box.operator('mpfb.symmetrize_maketarget_left')
         box.operator('mpfb.symmetrize_maketarget_right')
 
@@ -57,7 +58,7 @@ class MPFB_PT_MakeTarget_Panel(Abstract_Panel):
             else:
                 self._save_target(scene, layout)
                 if object_type == "Basemesh":
-                    self._symmetrize_target(scene, layout)
+                    self._symmetrize_target(blender_object, layout)
                 self._debug_target(scene, layout)
 
 
@@ -4,6 +4,7 @@ import bpy
 from mpfb.services.logservice import LogService
 from mpfb.services.objectservice import ObjectService
 from mpfb.services.targetservice import TargetService
+from mpfb.ui.maketarget import MakeTargetObjectProperties
 from mpfb import ClassManager
 
 _LOG = LogService.get_logger("maketarget.symmetrizeleft")
@@ -25,7 +26,10 @@ class MPFB_OT_SymmetrizeLeftOperator(bpy.types.Operator):
     def execute(self, context):
 
         blender_object = context.active_object
-        TargetService.symmetrize_shape_key(blender_object, "PrimaryTarget", False)
+        shape_key_names = ["PrimaryTarget"]
+        if MakeTargetObjectProperties.get_value("symmetrize_all", entity_reference=blender_object):
+            shape_key_names = None
+        TargetService.symmetrize_shape_keys(blender_object, shape_key_names, False)
 
         self.report({'INFO'}, "Target symmetrized")
         return {'FINISHED'}
@@ -76,7 +76,7 @@ def _general_set_target_value(name, value):
     _LOG.trace("_general_set_target_value", (name, value))
     basemesh = bpy.context.object
     HumanObjectProperties.set_value(name, value, entity_reference=basemesh)
-    TargetService.reapply_macro_details(basemesh)
+    TargetService.reapply_macro_details(basemesh, incremental=True)
     #===========================================================================
     # macro_info = TargetService.get_macro_info_dict_from_basemesh(basemesh)
     # _LOG.debug("macro_info", macro_info)
@@ -27,6 +27,7 @@ class MPFB_PT_Model_Panel(bpy.types.Panel):
     def _general(self, scene, layout):
         box = self._create_box(layout, "General")
         box.operator('mpfb.refit_human')
+        box.operator('mpfb.refit_all_humans')
 
     def draw(self, context):
         _LOG.enter()
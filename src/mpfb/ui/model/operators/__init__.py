@@ -5,7 +5,9 @@ _LOG = _LogService.get_logger("model.operators")
 _LOG.trace("initializing model operators module")
 
 from .refithuman import MPFB_OT_RefitHumanOperator
+from .refitallhumans import MPFB_OT_RefitAllHumansOperator
 
 __all__ = [
-    "MPFB_OT_RefitHumanOperator"
+    "MPFB_OT_RefitHumanOperator",
+    "MPFB_OT_RefitAllHumansOperator"
 ]
@@ -0,0 +1,31 @@
+"""Operator for refitting all humans in the scene."""
+
+import bpy
+from mpfb.services.logservice import LogService
+from mpfb.services.humanservice import HumanService
+from mpfb.services.objectservice import ObjectService
+from mpfb import ClassManager
+
+_LOG = LogService.get_logger("model.refitallhumans")
+
+class MPFB_OT_RefitAllHumansOperator(bpy.types.Operator):
+    """Refit clothes, bodyparts, proxies and rigs for all humans in the scene. This is needed if you have changed modeling sliders after having added such assets."""
+    bl_idname = "mpfb.refit_all_humans"
+    bl_label = "Refit all humans"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    def execute(self, context):
+
+        basemeshes = [obj for obj in context.scene.objects if ObjectService.object_is_basemesh(obj)]
+        if not basemeshes:
+            self.report({'ERROR'}, "There are no humans in the scene")
+            return {'FINISHED'}
+
+        timings = HumanService.refit_many(basemeshes)
+
+        summary = ", ".join([stage + " " + str(round(seconds, 2)) + "s" for stage, seconds in timings.items()])
+        _LOG.info("Refit timings", timings)
+        self.report({'INFO'}, "Refitted " + str(len(basemeshes)) + " humans (" + summary + ")")
+        return {'FINISHED'}
+
+ClassManager.add_class(MPFB_OT_RefitAllHumansOperator)
@@ -34,7 +34,8 @@ class MPFB_PT_NewHuman_Panel(bpy.types.Panel):
             "scale_factor",
             "detailed_helpers",
             "extra_vertex_groups",
-            "mask_helpers"
+            "mask_helpers",
+            "bake_macro_targets"
             ])
         box.operator('mpfb.create_human')
 
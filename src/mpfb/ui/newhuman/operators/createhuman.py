@@ -36,6 +36,7 @@ class MPFB_OT_CreateHumanOperator(bpy.types.Operator):
             scale = 10.0
 
         mask_helpers = NEW_HUMAN_PROPERTIES.get_value("mask_helpers", entity_reference=context.scene)
+        bake_macro_targets = NEW_HUMAN_PROPERTIES.get_value("bake_macro_targets", entity_reference=context.scene)
         add_phenotype = NEW_HUMAN_PROPERTIES.get_value("add_phenotype", entity_reference=context.scene)
         macro_details = None
 
@@ -147,7 +148,8 @@ class MPFB_OT_CreateHumanOperator(bpy.types.Operator):
                 extra_vertex_groups=extra_vertex_groups,
                 feet_on_ground=True,
                 scale=scale,
-                macro_detail_dict=macro_details)
+                macro_detail_dict=macro_details,
+                bake_macro_targets=bake_macro_targets)
             self.report({'INFO'}, "Human created. You can adjust the phenotype values on the modeling panel.")
         else:
             basemesh = HumanService.create_human(
@@ -155,7 +157,8 @@ class MPFB_OT_CreateHumanOperator(bpy.types.Operator):
                 detailed_helpers=detailed_helpers,
                 extra_vertex_groups=extra_vertex_groups,
                 feet_on_ground=True,
-                scale=scale)
+                scale=scale,
+                bake_macro_targets=bake_macro_targets)
             self.report({'INFO'}, "Human created.")
 
         _LOG.debug("Basemesh", basemesh)